@@ -0,0 +1,244 @@
+"""
+向量存储格式基准测试：截断维度 (Matryoshka) 对索引大小、检索延迟和召回的影响，以及量化 (float16 / int8) 的精度模拟。
+
+使用与 retrieval_benchmark.py 相同的合成语料和标注问题集。所有文档和问题只向量化一次，
+然后对每一种 (维度, 量化) 组合用 quantization.transform_vectors 变换后各建一个临时 Chroma 集合，
+只测向量检索这一路 (不含关键词检索和重排)，报告：
+
+- chroma_bytes: Chroma 集合实际占用的磁盘空间
+- vector_bytes: 向量真正按该格式存储时的理论数据体积。Chroma 内部始终以 float32 存储，
+  量化组合只是精度模拟 (chroma_bytes 与 none 相同)，入库流程也不提供量化选项
+- p50/p95: 单次向量检索的延迟 (含查询向量的变换)
+- overlap@5: 与完整精度基线的前 5 个结果的重合比例
+- recall@5: 目标片段出现在前 5 个结果中的比例
+
+用法:
+    python benchmarks/quantization_benchmark.py
+    python benchmarks/quantization_benchmark.py --backend local --dims 0,256,128
+    EMBEDDING_BACKEND=gemini python benchmarks/quantization_benchmark.py --backend gemini --dims 0,1536,768
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.retrieval_benchmark import (
+    DEFAULT_SEED,
+    directory_bytes,
+    generate_corpus,
+    load_questions,
+    percentile,
+)
+from src.agent import telemetry
+from src.db.chunk_ids import compute_chunk_id
+from src.db.embeddings import DEFAULT_EMBEDDING_MODELS, create_embeddings
+from src.db.ingest import BATCH_SIZE
+from src.db.quantization import QUANTIZATION_MODES, transform_vectors, vector_bytes
+
+# --- 配置参数 ---
+DEFAULT_DOCS = 3000
+TOP_K = 5
+
+
+def embed_corpus(embeddings, docs, questions):
+    """文档和问题各向量化一次，所有存储格式共用同一份完整精度的向量"""
+    doc_vectors = []
+    for i in range(0, len(docs), BATCH_SIZE):
+        batch = docs[i : i + BATCH_SIZE]
+        doc_vectors.extend(embeddings.embed_documents([d.page_content for d in batch]))
+    query_vectors = [embeddings.embed_query(q["question"]) for q in questions]
+    return doc_vectors, query_vectors
+
+
+def build_collection(path, docs, ids, vectors):
+    """用已变换的向量建一个 Chroma 集合 (与 ingest.py 一样直接写入向量)"""
+    import chromadb
+
+    client = chromadb.PersistentClient(path=str(path))
+    collection = client.get_or_create_collection("dnd_rules")
+    for i in range(0, len(docs), BATCH_SIZE):
+        collection.upsert(
+            ids=ids[i : i + BATCH_SIZE],
+            embeddings=vectors[i : i + BATCH_SIZE],
+            documents=[doc.page_content for doc in docs[i : i + BATCH_SIZE]],
+            metadatas=[doc.metadata for doc in docs[i : i + BATCH_SIZE]],
+        )
+    return collection
+
+
+def measure(collection, query_vectors, dimensions, quantization, rounds):
+    """返回 (每个问题的前 TOP_K 个 ID, 延迟列表)，延迟包含查询向量的变换"""
+    top_ids = []
+    latencies = []
+    for vector in query_vectors:
+        for round_index in range(rounds):
+            start = time.perf_counter()
+            query = transform_vectors([vector], dimensions, quantization)
+            result = collection.query(query_embeddings=query.tolist(), n_results=TOP_K)
+            latencies.append(time.perf_counter() - start)
+        top_ids.append(result["ids"][0])
+    return top_ids, latencies
+
+
+def run_benchmark(
+    total_docs=DEFAULT_DOCS,
+    dims=None,
+    quantizations=QUANTIZATION_MODES,
+    rounds=3,
+    seed=DEFAULT_SEED,
+    backend="hash",
+):
+    """对每种 (维度, 量化) 组合建索引并测量，返回报告字典"""
+    questions = load_questions()
+    docs = generate_corpus(questions, total_docs, seed)
+    ids = [compute_chunk_id(doc.page_content, doc.metadata) for doc in docs]
+    # generate_corpus 把目标片段放在最前面，与问题一一对应
+    gold_ids = ids[: len(questions)]
+
+    embeddings = create_embeddings(backend)
+    start = time.perf_counter()
+    doc_vectors, query_vectors = embed_corpus(embeddings, docs, questions)
+    embed_seconds = time.perf_counter() - start
+    full_dim = len(doc_vectors[0])
+    if not dims:
+        dims = [0, full_dim // 2, full_dim // 4]
+
+    rows = []
+    baseline = None
+    with tempfile.TemporaryDirectory(prefix="dnd_quantization_") as tmp:
+        for dimensions in dims:
+            for quantization in quantizations:
+                name = f"{dimensions or full_dim}d-{quantization}"
+                stored = transform_vectors(doc_vectors, dimensions, quantization)
+                path = Path(tmp) / name
+                collection = build_collection(path, docs, ids, stored.tolist())
+                # 预热：第一次查询会加载 HNSW 索引
+                collection.query(
+                    query_embeddings=transform_vectors(
+                        query_vectors[:1], dimensions, quantization
+                    ).tolist(),
+                    n_results=TOP_K,
+                )
+                top_ids, latencies = measure(
+                    collection, query_vectors, dimensions, quantization, rounds
+                )
+                if baseline is None:
+                    # 第一个组合 (完整维度 + none) 作为基线
+                    baseline = top_ids
+                latencies_ms = [value * 1000 for value in latencies]
+                rows.append(
+                    {
+                        "config": name,
+                        "dimensions": stored.shape[1],
+                        "quantization": quantization,
+                        "chroma_bytes": directory_bytes(path),
+                        "vector_bytes": vector_bytes(
+                            len(docs), stored.shape[1], quantization
+                        ),
+                        "p50_ms": round(percentile(latencies_ms, 50), 3),
+                        "p95_ms": round(percentile(latencies_ms, 95), 3),
+                        f"overlap@{TOP_K}": round(
+                            sum(
+                                len(set(a) & set(b)) / TOP_K
+                                for a, b in zip(top_ids, baseline)
+                            )
+                            / len(top_ids),
+                            4,
+                        ),
+                        f"recall@{TOP_K}": round(
+                            sum(
+                                1 for gold, top in zip(gold_ids, top_ids) if gold in top
+                            )
+                            / len(top_ids),
+                            4,
+                        ),
+                    }
+                )
+
+    return {
+        "corpus": {
+            "docs": len(docs),
+            "questions": len(questions),
+            "seed": seed,
+            "embedding": f"{backend} / {DEFAULT_EMBEDDING_MODELS[backend]}",
+            "full_dimensions": full_dim,
+            "embed_seconds": round(embed_seconds, 2),
+        },
+        "rounds": rounds,
+        "results": rows,
+    }
+
+
+def print_report(report):
+    corpus = report["corpus"]
+    print(
+        f"语料: {corpus['docs']} 条片段 | {corpus['questions']} 个问题 | "
+        f"Embedding: {corpus['embedding']} ({corpus['full_dimensions']} 维)"
+    )
+    header = (
+        f"{'格式':<16}{'Chroma(MB)':>12}{'向量(MB)':>10}{'p50(ms)':>10}"
+        f"{'p95(ms)':>10}{f'O@{TOP_K}':>8}{f'R@{TOP_K}':>8}"
+    )
+    print(header)
+    for row in report["results"]:
+        print(
+            f"{row['config']:<16}"
+            f"{row['chroma_bytes'] / 1024 / 1024:>12.2f}"
+            f"{row['vector_bytes'] / 1024 / 1024:>10.2f}"
+            f"{row['p50_ms']:>10}{row['p95_ms']:>10}"
+            f"{row[f'overlap@{TOP_K}']:>8}{row[f'recall@{TOP_K}']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="向量截断与量化精度模拟的基准测试")
+    parser.add_argument(
+        "--docs", type=int, default=DEFAULT_DOCS, help="合成集合的片段总数"
+    )
+    parser.add_argument(
+        "--dims",
+        help="逗号分隔的截断维度，0 表示完整维度 (默认: 完整、1/2、1/4)",
+    )
+    parser.add_argument(
+        "--quantization",
+        default=",".join(QUANTIZATION_MODES),
+        help="逗号分隔的量化精度模拟方式 (none / float16 / int8)",
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="每个查询重复测量延迟的次数"
+    )
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="随机种子")
+    parser.add_argument(
+        "--backend",
+        choices=["hash", "local", "gemini"],
+        default="hash",
+        help="Embedding 后端 (hash 完全离线；gemini 需要 API Key，且会按语料大小消耗配额)",
+    )
+    parser.add_argument("--output", type=Path, help="把报告写入 JSON 文件")
+    args = parser.parse_args()
+
+    telemetry.logger.setLevel(logging.WARNING)
+
+    dims = [int(value) for value in args.dims.split(",")] if args.dims else None
+    if dims and dims[0] != 0:
+        # 第一个组合作为基线，必须是完整维度
+        dims = [0] + dims
+    quantizations = [value.strip() for value in args.quantization.split(",")]
+    if quantizations[0] != "none":
+        quantizations = ["none"] + [q for q in quantizations if q != "none"]
+
+    report = run_benchmark(
+        args.docs, dims, quantizations, args.rounds, args.seed, args.backend
+    )
+    print_report(report)
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入: {args.output}")
@@ -0,0 +1,463 @@
+"""
+离线检索基准测试。
+
+默认用确定性的本地 Embedding (HashEmbeddings) 构建一个合成的 dnd_rules 集合：
+benchmarks/questions.jsonl 中每个问题附带一段标注好的目标片段，再混入大量
+按固定随机种子生成的干扰片段 (其中一部分会提到目标片段的名称)。
+随后测量：
+
+- 入库速度 (docs/s，与 ingest.py 使用同一条 EmbeddingPipeline)
+- search_rules 的延迟 (p50/p95，关闭检索缓存)
+- 内存峰值 (RSS) 与索引占用的磁盘空间
+- 不同书目过滤规模下的 recall@k
+
+全程不访问网络，也不读写项目中的 chroma_db_data / index_data。
+可以用 --min-recall / --max-p95-ms 作为回归门槛，不达标时以非零状态码退出。
+
+用法:
+    python benchmarks/retrieval_benchmark.py
+    python benchmarks/retrieval_benchmark.py --docs 5000 --output report.json
+    python benchmarks/retrieval_benchmark.py --min-recall 0.8 --max-p95-ms 200
+    python benchmarks/retrieval_benchmark.py --backend local  # 测量本地 Embedding 模型
+    python benchmarks/retrieval_benchmark.py --partition  # 按书分区检索 (对比全局集合 + 过滤)
+"""
+
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import statistics
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from langchain_core.documents import Document
+
+from src.agent import telemetry
+from src.agent import tools
+from src.db.chunk_ids import compute_chunk_id
+from src.db.embeddings import DEFAULT_EMBEDDING_MODELS, create_embeddings
+from src.db.ingest import BATCH_SIZE, COLLECTION_NAME, write_batch_to_store
+from src.db.keyword_index import KeywordIndex
+from src.db.partitions import sync_partitions
+from src.db.pipeline import EmbeddingPipeline
+
+# --- 配置路径 ---
+BENCHMARK_DIR = Path(__file__).resolve().parent
+QUESTIONS_PATH = BENCHMARK_DIR / "questions.jsonl"
+
+# --- 配置参数 ---
+DEFAULT_DOCS = 2000  # 合成集合的总片段数 (含目标片段)
+DEFAULT_SEED = 42
+RECALL_AT = (1, 3, 5)
+# 目标片段名称出现在干扰片段中的比例，模拟 "参见火球术" 这类交叉引用
+NEAR_MISS_RATIO = 0.2
+
+BOOKS = [
+    "核心规则/玩家手册2024",
+    "核心规则/地下城主指南2024",
+    "核心规则/怪物图鉴2025",
+    "规则扩展/XGE",
+    "规则扩展/TCE",
+    "规则扩展/MPMM",
+    "战役设定/剑湾",
+    "战役设定/艾伯伦",
+    "冒险模组/龙枪",
+    "冒险模组/深渊",
+]
+
+# 生成干扰片段用的词表
+SUBJECTS = """
+冒险者 法师 牧师 游荡者 圣武士 德鲁伊 术士 邪术师 吟游诗人 游侠 矮人 精灵
+半身人 侏儒 提夫林 龙裔 兽人 巨人 亡灵 元素 构装体 魔鬼 恶魔 天界生物
+""".split()
+TOPICS = """
+先攻 掩护 坠落 窒息 视野 光照 旅行速度 负重 工具熟练 技能检定 被动检定 群体检定
+灵感 背景 语言 货币 生活开销 坐骑 载具 毒药 疾病 诅咒 卷轴 药水 传送门 位面 神祇
+阵营 派系 据点
+""".split()
+PHRASES = [
+    "在这种情况下需要进行一次{ability}检定，DC由地下城主决定。",
+    "如果{subject}在{topic}的过程中失败，会受到{dice}点{damage}伤害。",
+    "{subject}可以用一个动作尝试处理{topic}相关的问题。",
+    "关于{topic}的规则，地下城主可以根据战役需要进行调整。",
+    "当{subject}处于{condition}状态时，{topic}的判定具有劣势。",
+    "{topic}持续{duration}，期间{subject}无法进行长休。",
+    "每次完成长休后，{subject}恢复与{topic}相关的全部使用次数。",
+    "{subject}在{topic}中获得熟练加值，并且可以选择一项专精。",
+]
+ABILITIES = ["力量", "敏捷", "体质", "智力", "感知", "魅力"]
+DAMAGES = ["钝击", "穿刺", "挥砍", "火焰", "寒冷", "闪电", "毒素", "心灵", "死灵"]
+CONDITIONS = ["目盲", "魅惑", "耳聋", "恐慌", "受擒", "失能", "麻痹", "石化", "中毒"]
+DURATIONS = ["1分钟", "10分钟", "1小时", "8小时", "24小时", "直到解除"]
+DICE = ["1d4", "1d6", "1d8", "2d6", "2d8", "3d6", "4d10"]
+
+
+def load_questions(path=QUESTIONS_PATH):
+    """读取标注问题集，每行包含 question 和目标片段 (source_book/sub_topic/content)"""
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                questions.append(json.loads(line))
+    return questions
+
+
+def make_document(content, source_book, chapter, sub_topic):
+    metadata = {
+        "source_book": source_book,
+        "chapter": chapter,
+        "sub_topic": sub_topic,
+    }
+    return Document(page_content=content, metadata=metadata)
+
+
+def generate_corpus(questions, total_docs, seed=DEFAULT_SEED):
+    """
+    生成合成语料：所有目标片段 + 干扰片段，总数为 total_docs。
+    相同的 seed 永远生成相同的语料。
+    """
+    rng = random.Random(seed)
+    docs = [
+        make_document(q["content"], q["source_book"], "基准测试/目标", q["sub_topic"])
+        for q in questions
+    ]
+    gold_names = [q["sub_topic"] for q in questions]
+
+    for i in range(max(0, total_docs - len(docs))):
+        topic = rng.choice(TOPICS)
+        sentences = []
+        for _ in range(rng.randint(3, 7)):
+            sentences.append(
+                rng.choice(PHRASES).format(
+                    subject=rng.choice(SUBJECTS),
+                    topic=topic,
+                    ability=rng.choice(ABILITIES),
+                    damage=rng.choice(DAMAGES),
+                    condition=rng.choice(CONDITIONS),
+                    duration=rng.choice(DURATIONS),
+                    dice=rng.choice(DICE),
+                )
+            )
+        if rng.random() < NEAR_MISS_RATIO:
+            sentences.insert(
+                rng.randrange(len(sentences) + 1),
+                f"此规则不适用于{rng.choice(gold_names)}，详见对应章节。",
+            )
+        sub_topic = f"{topic}{i}"
+        content = f"### {sub_topic}\n" + "".join(sentences)
+        docs.append(
+            make_document(content, rng.choice(BOOKS), f"基准测试/{topic}", sub_topic)
+        )
+    return docs
+
+
+def build_index(docs, work_dir, embeddings, concurrency=4):
+    """把语料写入临时目录中的 Chroma 集合和关键词索引，返回 (向量库, 关键词索引, 入库统计)"""
+    # 延迟导入，与 tools.py 一致
+    from langchain_chroma import Chroma
+
+    vector_store = Chroma(
+        collection_name=COLLECTION_NAME,
+        embedding_function=embeddings,
+        persist_directory=str(work_dir / "chroma_db_data"),
+    )
+    keyword_index = KeywordIndex(work_dir / "keyword_index.sqlite3")
+
+    def write_batch(batch_docs, ids, vectors):
+        write_batch_to_store(vector_store, batch_docs, ids, vectors)
+        keyword_index.add(zip(ids, batch_docs))
+
+    batches = []
+    for i in range(0, len(docs), BATCH_SIZE):
+        batch = docs[i : i + BATCH_SIZE]
+        ids = [compute_chunk_id(doc.page_content, doc.metadata) for doc in batch]
+        batches.append((batch, ids))
+
+    # 本地 Embedding 没有配额限制，限流设为不起作用的大值
+    pipeline = EmbeddingPipeline(
+        embeddings,
+        write_batch=write_batch,
+        concurrency=concurrency,
+        qpm=10**9,
+        tpm=10**12,
+        max_retries=0,
+    )
+    stats = pipeline.run(batches)
+    return vector_store, keyword_index, stats
+
+
+def build_partitions(vector_store):
+    """与 ingest.py 一样从全局集合复制出按书分区，返回 {书: 分区集合}"""
+    client = vector_store._client
+    names = sync_partitions(client, COLLECTION_NAME, BOOKS)
+    return {
+        book: client.get_collection(name, embedding_function=None)
+        for book, name in names.items()
+    }
+
+
+def use_index(vector_store, keyword_index, partitions=None):
+    """让 tools.py 的检索改用基准测试的索引 (及按书分区)，并关闭检索缓存"""
+    with tools._init_lock:
+        tools._vector_store = vector_store
+        tools._keyword_index = keyword_index
+        tools._keyword_index_loaded = True
+        tools._partitions = (tools.read_ingest_version(), partitions or {})
+    tools.search_cache.maxsize = 0
+
+
+def filter_configs(question, rng):
+    """每个问题测试的书目过滤：不过滤、单本、三本、全部书目"""
+    others = [book for book in BOOKS if book != question["source_book"]]
+    return {
+        "none": None,
+        "1_book": [question["source_book"]],
+        "3_books": [question["source_book"]] + rng.sample(others, 2),
+        "all_books": list(BOOKS),
+    }
+
+
+def percentile(values, pct):
+    """线性插值的百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def run_queries(questions, rounds=1, seed=DEFAULT_SEED):
+    """
+    对每个问题、每种书目过滤执行检索，返回 {过滤名: {latencies, ranks}}。
+    延迟测量完整的 search_rules 工具调用 (检索 + 融合 + 重排 + 格式化)，
+    召回率根据 select_results 返回的片段顺序计算。
+    """
+    rng = random.Random(seed)
+    configs = {}
+    for question in questions:
+        gold = (question["source_book"], question["sub_topic"])
+        for name, book_filter in filter_configs(question, rng).items():
+            entry = configs.setdefault(name, {"latencies": [], "ranks": []})
+            args = {"query": question["question"]}
+            if book_filter is not None:
+                args["book_filter"] = book_filter
+            for _ in range(rounds):
+                start = time.perf_counter()
+                tools.search_rules.invoke(args)
+                entry["latencies"].append(time.perf_counter() - start)
+
+            results = tools.select_results(
+                question["question"], tools.retrieve(question["question"], book_filter)
+            )
+            rank = None
+            for position, (doc, _) in enumerate(results, start=1):
+                key = (doc.metadata.get("source_book"), doc.metadata.get("sub_topic"))
+                if key == gold:
+                    rank = position
+                    break
+            entry["ranks"].append(rank)
+    return configs
+
+
+def summarize(configs):
+    summary = {}
+    for name, entry in configs.items():
+        latencies_ms = [value * 1000 for value in entry["latencies"]]
+        ranks = entry["ranks"]
+        summary[name] = {
+            "queries": len(ranks),
+            "p50_ms": round(percentile(latencies_ms, 50), 2),
+            "p95_ms": round(percentile(latencies_ms, 95), 2),
+            "mean_ms": round(statistics.mean(latencies_ms), 2),
+            **{
+                f"recall@{k}": round(
+                    sum(1 for rank in ranks if rank is not None and rank <= k)
+                    / len(ranks),
+                    4,
+                )
+                for k in RECALL_AT
+            },
+            "mrr": round(
+                sum(1 / rank for rank in ranks if rank is not None) / len(ranks), 4
+            ),
+        }
+    return summary
+
+
+def directory_bytes(path):
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 的单位是 KB，macOS 上是字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_benchmark(
+    total_docs=DEFAULT_DOCS,
+    rounds=3,
+    seed=DEFAULT_SEED,
+    concurrency=4,
+    work_dir=None,
+    backend="hash",
+    partition=False,
+):
+    """执行完整的基准测试，返回报告字典"""
+    questions = load_questions()
+    docs = generate_corpus(questions, total_docs, seed)
+    embeddings = create_embeddings(backend)
+
+    with tempfile.TemporaryDirectory(prefix="dnd_benchmark_", dir=work_dir) as tmp:
+        tmp = Path(tmp)
+        rss_before = peak_rss_mb()
+        vector_store, keyword_index, ingest_stats = build_index(
+            docs, tmp, embeddings, concurrency
+        )
+        rss_after_ingest = peak_rss_mb()
+        partitions = build_partitions(vector_store) if partition else None
+
+        use_index(vector_store, keyword_index, partitions)
+        # 预热：第一次查询包含 Chroma 加载索引等一次性开销，不计入延迟
+        tools.search_rules.invoke({"query": questions[0]["question"]})
+        configs = run_queries(questions, rounds, seed)
+
+        report = {
+            "corpus": {
+                "docs": len(docs),
+                "questions": len(questions),
+                "books": len(BOOKS),
+                "seed": seed,
+                "embedding": f"{backend} / {DEFAULT_EMBEDDING_MODELS[backend]}",
+            },
+            "settings": {
+                "rounds": rounds,
+                "search_k": tools.SEARCH_K,
+                "hybrid": keyword_index is not None,
+                "rerank": tools.RERANK_ENABLED,
+                "partitions": len(partitions or {}),
+                "partition_fallback_ratio": tools.PARTITION_FALLBACK_RATIO,
+            },
+            "ingest": {
+                "written": ingest_stats["written"],
+                "failed": ingest_stats["failed"],
+                "elapsed_s": round(ingest_stats["elapsed"], 3),
+                "docs_per_sec": round(ingest_stats["docs_per_sec"], 1),
+            },
+            "search": summarize(configs),
+            "memory": {
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+                "ingest_rss_growth_mb": round(rss_after_ingest - rss_before, 1),
+                "chroma_bytes": directory_bytes(tmp / "chroma_db_data"),
+                "keyword_index_bytes": directory_bytes(tmp)
+                - directory_bytes(tmp / "chroma_db_data"),
+            },
+        }
+        # 释放引用，临时目录才能被删除
+        use_index(None, None)
+    return report
+
+
+def print_report(report):
+    corpus = report["corpus"]
+    ingest = report["ingest"]
+    memory = report["memory"]
+    print(
+        f"语料: {corpus['docs']} 条片段 | {corpus['questions']} 个问题 | "
+        f"{corpus['books']} 本书 | Embedding: {corpus['embedding']}"
+    )
+    print(
+        f"入库: {ingest['written']} 条，{ingest['elapsed_s']}s "
+        f"({ingest['docs_per_sec']} docs/s)"
+    )
+    print(
+        f"内存: 峰值 RSS {memory['peak_rss_mb']} MB | "
+        f"Chroma {memory['chroma_bytes'] / 1024 / 1024:.1f} MB | "
+        f"关键词索引 {memory['keyword_index_bytes'] / 1024 / 1024:.1f} MB"
+    )
+    if report["settings"]["partitions"]:
+        print(
+            f"按书分区: {report['settings']['partitions']} 个 "
+            f"(Chroma 大小包含分区中的向量副本)"
+        )
+    header = f"{'过滤':<10}{'p50(ms)':>10}{'p95(ms)':>10}"
+    header += "".join(f"{f'R@{k}':>8}" for k in RECALL_AT) + f"{'MRR':>8}"
+    print(header)
+    for name, row in report["search"].items():
+        line = f"{name:<10}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+        line += "".join(f"{row[f'recall@{k}']:>8}" for k in RECALL_AT)
+        line += f"{row['mrr']:>8}"
+        print(line)
+
+
+def check_gates(report, min_recall=None, max_p95_ms=None):
+    """检查回归门槛，返回不达标项的说明列表"""
+    failures = []
+    recall_key = f"recall@{report['settings']['search_k']}"
+    for name, row in report["search"].items():
+        if min_recall is not None and row.get(recall_key, 0.0) < min_recall:
+            failures.append(f"{name}: {recall_key}={row[recall_key]} < {min_recall}")
+        if max_p95_ms is not None and row["p95_ms"] > max_p95_ms:
+            failures.append(f"{name}: p95={row['p95_ms']}ms > {max_p95_ms}ms")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线检索基准测试")
+    parser.add_argument(
+        "--docs", type=int, default=DEFAULT_DOCS, help="合成集合的片段总数"
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="每个查询重复测量延迟的次数"
+    )
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="随机种子")
+    parser.add_argument("--concurrency", type=int, default=4, help="入库并发数")
+    parser.add_argument(
+        "--backend",
+        choices=["hash", "local"],
+        default="hash",
+        help="Embedding 后端：hash 完全确定；local 测量本地模型的真实延迟 (需先下载模型)",
+    )
+    parser.add_argument(
+        "--partition",
+        action="store_true",
+        help="入库后生成按书分区，过滤少数书目时只检索这几本书的分区",
+    )
+    parser.add_argument("--output", type=Path, help="把报告写入 JSON 文件")
+    parser.add_argument(
+        "--min-recall", type=float, help="recall@SEARCH_K 低于此值时失败"
+    )
+    parser.add_argument("--max-p95-ms", type=float, help="p95 延迟高于此值时失败")
+    args = parser.parse_args()
+
+    # 逐次检索的 span 日志会淹没报告
+    telemetry.logger.setLevel(logging.WARNING)
+
+    report = run_benchmark(
+        args.docs,
+        args.rounds,
+        args.seed,
+        args.concurrency,
+        backend=args.backend,
+        partition=args.partition,
+    )
+    print_report(report)
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入: {args.output}")
+
+    failures = check_gates(report, args.min_recall, args.max_p95_ms)
+    if failures:
+        print("❌ 未达到回归门槛:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
@@ -0,0 +1,258 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from src.agent import telemetry
+from src.db.ingest_version import read_ingest_version
+
+# --- 配置路径 ---
+BASE_DIR = Path(__file__).resolve().parents[2]
+ANSWER_CACHE_PATH = Path(
+    os.getenv("ANSWER_CACHE_PATH", BASE_DIR / "data" / "answer_cache.sqlite3")
+)
+
+# --- 配置参数 ---
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") != "0"
+# 问题向量的余弦相似度不低于此值才视为同一个问题
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.93"))
+# 最多缓存的回答数，超出后淘汰最久未命中的回答 (LRU)
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+
+# 与 tools.format_results 的来源标注格式对应
+SOURCE_PATTERN = re.compile(r"--- 来源: (.+?) ---")
+
+
+def books_key(selected_books):
+    """书目范围的缓存键：顺序和重复无关，空列表表示全部书目"""
+    return json.dumps(sorted(set(selected_books or [])), ensure_ascii=False)
+
+
+def extract_citations(tool_contents):
+    """从工具返回的检索结果中提取引用来源 (去重并保持顺序)"""
+    citations = []
+    for content in tool_contents:
+        for source in SOURCE_PATTERN.findall(content):
+            if source not in citations:
+                citations.append(source)
+    return citations
+
+
+class SemanticAnswerCache:
+    """
+    语义回答缓存：问题向量与已缓存问题的余弦相似度超过阈值、且书目范围相同时，
+    直接返回之前的最终回答 (及其引用来源)，不再调用 LLM 和检索。
+
+    - 回答与写入时的入库版本号绑定，版本变化后旧回答全部删除
+    - 条目数超过 max_entries 时按最近命中时间淘汰
+    - 数据保存在 SQLite 中，向量按书目范围在内存中组成矩阵，查找只需一次矩阵乘法
+    """
+
+    def __init__(
+        self,
+        path=ANSWER_CACHE_PATH,
+        threshold=ANSWER_CACHE_THRESHOLD,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    ):
+        self.path = Path(path)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                books TEXT NOT NULL,
+                ingest_version TEXT NOT NULL,
+                question TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                citations TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+            """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_answers_books ON answers(books)"
+        )
+        self._conn.commit()
+        self._version = None
+        # 书目范围 -> (id 列表, 归一化后的向量矩阵)，写入或淘汰后重建
+        self._matrices = {}
+        self._check_version()
+
+    def _check_version(self):
+        """入库版本变化时删除旧版本的回答 (调用方持有锁或在初始化中)"""
+        version = read_ingest_version() or ""
+        if version == self._version:
+            return
+        deleted = self._conn.execute(
+            "DELETE FROM answers WHERE ingest_version != ?", (version,)
+        ).rowcount
+        self._conn.commit()
+        if deleted:
+            telemetry.log_event(
+                "answer_cache.invalidated", deleted=deleted, ingest_version=version
+            )
+        self._version = version
+        self._matrices.clear()
+
+    def _matrix(self, books):
+        if books not in self._matrices:
+            rows = self._conn.execute(
+                "SELECT id, vector FROM answers WHERE books = ?", (books,)
+            ).fetchall()
+            ids = [row[0] for row in rows]
+            vectors = [np.frombuffer(row[1], dtype=np.float32) for row in rows]
+            if vectors and len({len(v) for v in vectors}) == 1:
+                matrix = np.vstack(vectors)
+            else:
+                # 更换 Embedding 模型后维度不一致，忽略旧向量直到被淘汰
+                ids, matrix = [], None
+            self._matrices[books] = (ids, matrix)
+        return self._matrices[books]
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, vector, selected_books):
+        """
+        返回最相似的缓存回答 {"question", "answer", "citations", "similarity"}，
+        没有超过阈值的回答时返回 None。
+        """
+        books = books_key(selected_books)
+        query = self._normalize(vector)
+        with self._lock:
+            self._check_version()
+            ids, matrix = self._matrix(books)
+            best = None
+            if matrix is not None and matrix.shape[1] == query.shape[0]:
+                scores = matrix @ query
+                index = int(np.argmax(scores))
+                if scores[index] >= self.threshold:
+                    best = (ids[index], float(scores[index]))
+            if best is None:
+                self.misses += 1
+                telemetry.incr("answer_cache_requests_total", result="miss")
+                return None
+
+            row = self._conn.execute(
+                "SELECT question, answer, citations FROM answers WHERE id = ?",
+                (best[0],),
+            ).fetchone()
+            self._conn.execute(
+                "UPDATE answers SET last_used = ?, hits = hits + 1 WHERE id = ?",
+                (time.time(), best[0]),
+            )
+            self._conn.commit()
+        self.hits += 1
+        telemetry.incr("answer_cache_requests_total", result="hit")
+        return {
+            "question": row[0],
+            "answer": row[1],
+            "citations": json.loads(row[2]),
+            "similarity": round(best[1], 4),
+        }
+
+    def store(self, question, vector, selected_books, answer, citations):
+        """缓存一个最终回答，超出容量时淘汰最久未命中的回答"""
+        if self.max_entries <= 0:
+            return
+        books = books_key(selected_books)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            self._conn.execute(
+                "INSERT INTO answers (books, ingest_version, question, vector, answer, "
+                "citations, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    books,
+                    self._version,
+                    question,
+                    self._normalize(vector).tobytes(),
+                    answer,
+                    json.dumps(citations, ensure_ascii=False),
+                    now,
+                    now,
+                ),
+            )
+            overflow = (
+                self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+                - self.max_entries
+            )
+            if overflow > 0:
+                self._conn.execute(
+                    """
+                    DELETE FROM answers WHERE id IN (
+                        SELECT id FROM answers ORDER BY last_used ASC LIMIT ?
+                    )
+                    """,
+                    (overflow,),
+                )
+                self._matrices.clear()
+            else:
+                self._matrices.pop(books, None)
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+            self._matrices.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+        }
+
+
+_answer_cache = None
+_init_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """返回进程级共享的回答缓存，关闭时返回 None"""
+    global _answer_cache
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    if _answer_cache is None:
+        with _init_lock:
+            if _answer_cache is None:
+                _answer_cache = SemanticAnswerCache()
+    return _answer_cache
+
+
+def collect_answer_cache_metrics():
+    """导出指标时采集回答缓存的现状"""
+    if _answer_cache is None:
+        return []
+    stats = _answer_cache.stats()
+    return [
+        ("answer_cache_entries", {}, stats["entries"]),
+        ("answer_cache_hit_rate", {}, stats["hit_rate"]),
+    ]
+
+
+telemetry.metrics.register_collector(collect_answer_cache_metrics)
@@ -0,0 +1,238 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from langgraph.checkpoint.memory import MemorySaver
+
+# --- 配置路径 ---
+BASE_DIR = Path(__file__).resolve().parents[2]
+SESSION_DB_PATH = Path(
+    os.getenv("SESSION_DB_PATH", BASE_DIR / "data" / "sessions.sqlite3")
+)
+
+# --- 配置参数 ---
+# memory: 进程内存 (重启后会话丢失)；sqlite: 保存到本地 SQLite 文件
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "memory")
+# 会话超过这么久没有访问即被删除
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+# 最多保留的会话数，超出后删除最久未访问的会话 (LRU)
+SESSION_MAX_THREADS = int(os.getenv("SESSION_MAX_THREADS", "500"))
+# 两次过期扫描之间的最短间隔 (秒)
+SESSION_SWEEP_INTERVAL = 60
+# 同一会话的访问时间最多每隔这么久持久化一次 (秒)；图的每一步都会刷新访问时间，
+# 逐次写库没有必要，TTL 以天计，这点误差可以忽略
+SESSION_ACCESS_WRITE_INTERVAL = 60
+
+
+class BoundedSessionsMixin:
+    """
+    给 LangGraph checkpointer 加上会话数量和存活时间的上限。
+
+    按 thread_id 记录最近访问时间：每次读写都会刷新，写入时淘汰
+    超过 ttl 未访问的会话，以及超出 max_threads 后最久未访问的会话 (delete_thread)。
+    子类可以覆盖 _load_access/_save_access/_forget_access 把访问时间持久化，
+    同一会话在 SESSION_ACCESS_WRITE_INTERVAL 内只写一次。
+    """
+
+    def _init_bounds(self, ttl_seconds, max_threads):
+        self.ttl_seconds = ttl_seconds
+        self.max_threads = max_threads
+        self.evicted = 0
+        self._access = OrderedDict(sorted(self._load_access(), key=lambda x: x[1]))
+        # thread_id -> 上次持久化的访问时间
+        self._persisted = dict(self._access)
+        self._access_lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def _load_access(self):
+        """返回已有会话的 [(thread_id, 最近访问时间)]"""
+        return []
+
+    def _save_access(self, thread_id, last_used):
+        pass
+
+    def _forget_access(self, thread_id):
+        pass
+
+    def _touch(self, config):
+        thread_id = config.get("configurable", {}).get("thread_id")
+        if thread_id is None:
+            return
+        thread_id = str(thread_id)
+        now = time.time()
+        with self._access_lock:
+            self._access[thread_id] = now
+            self._access.move_to_end(thread_id)
+            persist = (
+                now - self._persisted.get(thread_id, 0.0)
+                >= SESSION_ACCESS_WRITE_INTERVAL
+            )
+            if persist:
+                self._persisted[thread_id] = now
+        if persist:
+            self._save_access(thread_id, now)
+
+    def _evict(self):
+        """淘汰过期会话和超出数量上限的会话"""
+        now = time.time()
+        victims = []
+        with self._access_lock:
+            if now - self._last_sweep >= SESSION_SWEEP_INTERVAL:
+                self._last_sweep = now
+                # _access 按访问时间从旧到新排列，遇到未过期的即可停止
+                for thread_id, last_used in self._access.items():
+                    if now - last_used <= self.ttl_seconds:
+                        break
+                    victims.append(thread_id)
+                for thread_id in victims:
+                    del self._access[thread_id]
+            while len(self._access) > self.max_threads:
+                thread_id, _ = self._access.popitem(last=False)
+                victims.append(thread_id)
+
+        for thread_id in victims:
+            self.delete_thread(thread_id)
+        self.evicted += len(victims)
+
+    def get_tuple(self, config):
+        result = super().get_tuple(config)
+        # 只刷新真实存在的会话，读取不存在的 thread_id 不应占用名额
+        if result is not None:
+            self._touch(config)
+        return result
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        self._touch(config)
+        result = super().put(config, checkpoint, metadata, new_versions)
+        self._evict()
+        return result
+
+    def delete_thread(self, thread_id):
+        super().delete_thread(thread_id)
+        with self._access_lock:
+            self._access.pop(str(thread_id), None)
+            self._persisted.pop(str(thread_id), None)
+        self._forget_access(str(thread_id))
+
+    def storage_bytes(self):
+        """会话数据占用的字节数 (估算)"""
+        return 0
+
+    def stats(self):
+        """会话存储的用量指标，可用于监控面板或健康检查"""
+        with self._access_lock:
+            threads = len(self._access)
+        return {
+            "backend": self.backend,
+            "threads": threads,
+            "max_threads": self.max_threads,
+            "ttl_seconds": self.ttl_seconds,
+            "evicted": self.evicted,
+            "storage_bytes": self.storage_bytes(),
+        }
+
+
+class BoundedMemorySaver(BoundedSessionsMixin, MemorySaver):
+    """进程内存中的 checkpointer，带 TTL 和 LRU 上限"""
+
+    backend = "memory"
+
+    def __init__(
+        self, ttl_seconds=SESSION_TTL_SECONDS, max_threads=SESSION_MAX_THREADS
+    ):
+        super().__init__()
+        self._init_bounds(ttl_seconds, max_threads)
+
+    def storage_bytes(self):
+        # storage / writes / blobs 中保存的都是序列化后的 (类型, bytes)，统计其长度之和
+        def size(value):
+            if isinstance(value, (bytes, bytearray)):
+                return len(value)
+            if isinstance(value, dict):
+                return sum(size(item) for item in value.values())
+            if isinstance(value, (tuple, list)):
+                return sum(size(item) for item in value)
+            return 0
+
+        return size(dict(self.storage)) + size(self.writes) + size(self.blobs)
+
+
+def create_sqlite_saver(
+    path=SESSION_DB_PATH,
+    ttl_seconds=SESSION_TTL_SECONDS,
+    max_threads=SESSION_MAX_THREADS,
+):
+    """
+    创建保存到本地 SQLite 的 checkpointer，重启后会话仍然保留。
+    SqliteSaver 只实现了同步接口，astream_agent 不能使用这个后端。
+    """
+    # 延迟导入：只有选择 sqlite 后端时才需要安装 langgraph-checkpoint-sqlite
+    from langgraph.checkpoint.sqlite import SqliteSaver
+
+    class BoundedSqliteSaver(BoundedSessionsMixin, SqliteSaver):
+        """SQLite checkpointer，访问时间记录在同一个数据库的 session_access 表中"""
+
+        backend = "sqlite"
+
+        def __init__(self, conn):
+            super().__init__(conn)
+            self.path = Path(path)
+            with self.lock:
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS session_access "
+                    "(thread_id TEXT PRIMARY KEY, last_used REAL NOT NULL)"
+                )
+                self.conn.commit()
+            self._init_bounds(ttl_seconds, max_threads)
+
+        def _load_access(self):
+            with self.lock:
+                return self.conn.execute(
+                    "SELECT thread_id, last_used FROM session_access"
+                ).fetchall()
+
+        def _save_access(self, thread_id, last_used):
+            with self.lock:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO session_access (thread_id, last_used) "
+                    "VALUES (?, ?)",
+                    (thread_id, last_used),
+                )
+                self.conn.commit()
+
+        def _forget_access(self, thread_id):
+            with self.lock:
+                self.conn.execute(
+                    "DELETE FROM session_access WHERE thread_id = ?", (thread_id,)
+                )
+                self.conn.commit()
+
+        def storage_bytes(self):
+            # 数据库文件 + WAL 文件的大小
+            return sum(
+                candidate.stat().st_size
+                for candidate in (
+                    self.path,
+                    self.path.with_name(self.path.name + "-wal"),
+                )
+                if candidate.exists()
+            )
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Streamlit 的每个会话运行在不同线程中，SqliteSaver 内部用锁串行化访问
+    conn = sqlite3.connect(str(path), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return BoundedSqliteSaver(conn)
+
+
+def get_checkpointer(backend=CHECKPOINT_BACKEND):
+    """按配置创建图使用的 checkpointer"""
+    if backend == "memory":
+        return BoundedMemorySaver()
+    if backend == "sqlite":
+        return create_sqlite_saver()
+    raise ValueError(f"未知的 CHECKPOINT_BACKEND: {backend} (可选 memory / sqlite)")
@@ -4,6 +4,8 @@ from dotenv import load_dotenv
 
 import sys
 import os
+import logging
+import threading
 #os.environ["HTTP_PROXY"] = "http://127.0.0.1:7890"
 #os.environ["HTTPS_PROXY"] = "http://127.0.0.1:7890"
 from pathlib import Path
@@ -11,27 +13,50 @@ from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parents[2]))
 
 
-# 引入 Gemini 模型
-
-from langchain_google_genai import ChatGoogleGenerativeAI
-
-
 # 引入 LangGraph 组件
 
 from langgraph.graph import StateGraph, START, END
 
 from langgraph.graph.message import add_messages
 
-from langgraph.prebuilt import ToolNode, tools_condition
+from langgraph.prebuilt import tools_condition
+
+from langchain_core.messages import (
+    HumanMessage,
+    SystemMessage,
+    ToolMessage,
+    AnyMessage,
+    AIMessage,
+    AIMessageChunk,
+)
+
+from src.agent import telemetry
 
-from langchain_core.messages import HumanMessage, SystemMessage, AnyMessage, AIMessage
+from src.agent.telemetry import QuestionMetrics
 
-from langgraph.checkpoint.memory import MemorySaver
+from src.agent.checkpointer import get_checkpointer
 
 
 # 引入刚才定义的工具
 
-from src.agent.tools import search_rules
+from src.agent.tools import (
+    get_entity_index,
+    get_keyword_index,
+    get_vector_store,
+    lookup_entity,
+    search_rules,
+    search_rules_many,
+)
+
+from src.agent.history import compact_messages, message_text
+
+from src.agent.answer_cache import extract_citations, get_answer_cache
+
+from src.agent.tool_executor import (
+    earlier_results,
+    execute_tool_calls,
+    merge_timing,
+)
 
 
 load_dotenv()
@@ -52,25 +77,282 @@ class AgentState(TypedDict):
 
     selected_books: list[str]  # 用户勾选的规则书 (从前端传入)
 
+    tool_timing: dict  # 本轮工具执行的耗时统计 (并行/去重节省的时间等)
+
+    use_answer_cache: bool  # 本次请求是否使用语义回答缓存 (默认使用，传 False 跳过)
+
+    answer_cache: dict  # 本轮的回答缓存状态 (轮次 ID、是否独立问题、是否命中)
+
 
 # --- 2. 初始化模型与工具 ---
 
-tools = [search_rules]
+tools = [lookup_entity, search_rules, search_rules_many]
 
+tools_by_name = {t.name: t for t in tools}
 
-llm = ChatGoogleGenerativeAI(
-    model="gemini-3-flash-preview", temperature=0, max_retries=2  # 规则问题不需要太发散
-)
 
+# LLM 客户端和编译后的图都是延迟创建的进程级单例：
+# 导入本模块 (Streamlit 启动、CLI、测试) 时不会连接 Gemini，也不会编译图
+
+_llm = None
+
+_llm_with_tools = None
+
+_graph = None
+
+_init_lock = threading.Lock()
+
+
+def get_llm():
+    """返回共享的 Gemini 聊天模型 (首次调用时创建)"""
+
+    global _llm, _llm_with_tools
+
+    if _llm is None:
+
+        with _init_lock:
+
+            if _llm is None:
+
+                # 延迟导入 Gemini SDK，它的加载耗时占了冷启动的大头
+
+                from langchain_google_genai import ChatGoogleGenerativeAI
+
+                llm = ChatGoogleGenerativeAI(
+                    model="gemini-3-flash-preview",
+                    temperature=0,  # 规则问题不需要太发散
+                    max_retries=2,
+                )
+
+                # 将工具绑定给 LLM，让它知道自己能干什么
+
+                _llm_with_tools = llm.bind_tools(tools)
+
+                _llm = llm
+
+    return _llm
+
+
+def get_llm_with_tools():
+
+    get_llm()
+
+    return _llm_with_tools
+
+
+def invoke_llm(llm, messages):
+    """调用 LLM，并记录耗时和输入/输出 token 数"""
+
+    with telemetry.span("llm.invoke") as fields:
+
+        response = llm.invoke(messages)
+
+        usage = getattr(response, "usage_metadata", None) or {}
+
+        fields["input_tokens"] = usage.get("input_tokens", 0)
 
-# 将工具绑定给 LLM，让它知道自己能干什么
+        fields["output_tokens"] = usage.get("output_tokens", 0)
 
-llm_with_tools = llm.bind_tools(tools)
+        fields["tool_calls"] = len(response.tool_calls)
+
+    telemetry.incr("llm_tokens_total", fields["input_tokens"], direction="input")
+
+    telemetry.incr("llm_tokens_total", fields["output_tokens"], direction="output")
+
+    return response
 
 
 # --- 3. 定义节点 (Nodes) ---
 
 
+def compact_history(state: AgentState):
+    """
+
+    历史压缩节点：每轮开始时截断之前轮次的检索结果，并在超出 token 预算时丢弃最早的轮次。
+
+    前端每轮只发送新的问题，完整历史由 checkpointer 保存，这里控制真正发给 LLM 的长度。
+
+    """
+
+    updates = compact_messages(state["messages"])
+
+    if not updates:
+
+        return {}
+
+    return {"messages": updates}
+
+
+def current_turn(messages):
+    """返回本轮的用户提问 (最后一条 HumanMessage) 及其下标，没有时返回 (None, 0)"""
+
+    for index in range(len(messages) - 1, -1, -1):
+
+        if isinstance(messages[index], HumanMessage):
+
+            return messages[index], index
+
+    return None, 0
+
+
+def embed_question(text):
+    """问题向量，与检索共用同一个 Embedding 模型 (及其本地缓存)"""
+
+    return get_vector_store().embeddings.embed_query(text)
+
+
+def check_answer_cache(state: AgentState):
+    """
+
+    语义回答缓存节点：在调用 LLM 之前，查找书目范围相同、问法相近的已缓存回答。
+
+    命中时直接追加缓存的回答 (附带引用来源)，图随即结束，不再调用 LLM 和检索。
+
+    """
+
+    messages = state["messages"]
+
+    question, index = current_turn(messages)
+
+    if question is None:
+
+        return {}
+
+    # 只有会话中的第一个问题才是独立问题："那它呢？" 这类追问依赖上下文，回答不能复用
+
+    standalone = index == 0 and not state.get("answer_cache")
+
+    if not standalone:
+
+        # 追问不查缓存，否则可能命中与上下文无关的回答；remember_answer 也只缓存独立问题
+
+        return {}
+
+    info = {"turn_id": question.id, "standalone": standalone, "hit": False}
+
+    cache = get_answer_cache()
+
+    if cache is None or not state.get("use_answer_cache", True):
+
+        return {"answer_cache": info}
+
+    text = message_text(question.content)
+
+    try:
+
+        with telemetry.span("answer_cache.lookup") as fields:
+
+            cached = cache.lookup(embed_question(text), state.get("selected_books"))
+
+            fields["hit"] = cached is not None
+
+    except Exception as e:
+
+        # 缓存不可用时照常回答
+
+        telemetry.log_event("answer_cache.failed", logging.WARNING, error=str(e))
+
+        return {"answer_cache": info}
+
+    if cached is None:
+
+        return {"answer_cache": info}
+
+    info["hit"] = True
+
+    telemetry.log_event(
+        "answer_cache.hit",
+        similarity=cached["similarity"],
+        cached_question=cached["question"],
+    )
+
+    response = AIMessage(
+        content=cached["answer"],
+        response_metadata={"answer_cache": cached},
+    )
+
+    return {"messages": [response], "answer_cache": info}
+
+
+def remember_answer(state: AgentState):
+    """
+
+    把本轮的最终回答写入语义回答缓存。
+
+    只缓存独立问题、且本轮确实检索到了来源的回答，命中缓存的回答不再重复写入。
+
+    """
+
+    info = state.get("answer_cache") or {}
+
+    cache = get_answer_cache()
+
+    if (
+        cache is None
+        or not state.get("use_answer_cache", True)
+        or not info.get("standalone")
+        or info.get("hit")
+    ):
+
+        return {}
+
+    messages = state["messages"]
+
+    question, index = current_turn(messages)
+
+    if question is None or question.id != info.get("turn_id"):
+
+        return {}
+
+    answer = message_text(messages[-1].content).strip()
+
+    citations = extract_citations(
+        message_text(msg.content)
+        for msg in messages[index:]
+        if isinstance(msg, ToolMessage)
+    )
+
+    # 没有检索来源的回答 (查不到、被强制停止等) 不缓存
+
+    if not answer or not citations:
+
+        return {}
+
+    try:
+
+        text = message_text(question.content)
+
+        cache.store(
+            text, embed_question(text), state.get("selected_books"), answer, citations
+        )
+
+    except Exception as e:
+
+        telemetry.log_event("answer_cache.store_failed", logging.WARNING, error=str(e))
+
+    return {}
+
+
+def route_after_cache(state: AgentState) -> Literal["agent", "__end__"]:
+    """命中回答缓存时直接结束，否则交给 agent"""
+
+    if isinstance(state["messages"][-1], AIMessage):
+
+        return END
+
+    return "agent"
+
+
+def route_after_agent(state: AgentState) -> Literal["tools", "remember"]:
+    """LLM 调用工具时去 tools，给出最终回答时先写入回答缓存再结束"""
+
+    if tools_condition(state) == "tools":
+
+        return "tools"
+
+    return "remember"
+
+
 def reasoner(state: AgentState):
     """
 
@@ -96,15 +378,19 @@ def reasoner(state: AgentState):
 
     **你的行动准则**:
 
-    1. **必须查书**: 遇到规则问题，必须调用 `search_rules` 工具检索，严禁仅凭记忆或臆造回答。
+    1. **必须查书**: 遇到规则问题，必须调用检索工具，严禁仅凭记忆或臆造回答。
+
+    2. **一次多查**: 优先调用 `search_rules_many`，一次传入 2-5 个不同角度的关键词 (中文术语、同义词、英文原名、相关概念)，它会并行检索并合并结果；只有目标非常明确时才用 `search_rules` 查单个关键词。
 
-    2. **参数传递**: 调用工具时，必须将上面的规则书列表准确传递给 `book_filter` 参数。
+    3. **精确查询**: 问某个法术的环阶/学派/成分、某个怪物的 CR/AC/HP、某职业几级获得某特性等精确信息时，先用 `lookup_entity` 按名称 (中文名或英文名) 查询结构化数据；查不到或需要完整规则描述时再检索。
 
-    3. **具体胜过一般**: 如果检索结果中，职业特性/专长描述与通用战斗规则冲突，以具体的特性为准 (Specific Beats General)。
+    4. **参数传递**: 调用工具时，必须将上面的规则书列表准确传递给 `book_filter` 参数。
 
-    4. **引用来源**: 回答必须注明信息来源（例如：根据《玩家手册》第x章...）。
+    5. **具体胜过一般**: 如果检索结果中，职业特性/专长描述与通用战斗规则冲突，以具体的特性为准 (Specific Beats General)。
 
-    5. **诚实**: 如果查不到，就说查不到。
+    6. **引用来源**: 回答必须注明信息来源（例如：根据《玩家手册》第x章...）。
+
+    7. **诚实**: 如果查不到，就说查不到。
 
     """
 
@@ -139,7 +425,7 @@ def reasoner(state: AgentState):
         )
 
         # [关键] 调用 llm (原始模型) 而不是 llm_with_tools
-        response = llm.invoke(input_messages)
+        response = invoke_llm(get_llm(), input_messages)
 
         return {"messages": [response]}
 
@@ -162,6 +448,17 @@ def reasoner(state: AgentState):
                     if q:
                         previous_searches.append(q)
 
+                elif tc["name"] == "search_rules_many":
+
+                    previous_searches.extend(q for q in tc["args"].get("queries", []) if q)
+
+                elif tc["name"] == "lookup_entity":
+
+                    q = tc["args"].get("name", "")
+
+                    if q:
+                        previous_searches.append(q)
+
     # 如果有过往搜索记录，把它们加入到 Prompt 里警告 Agent
 
     history_warning = ""
@@ -176,9 +473,9 @@ def reasoner(state: AgentState):
 
     **严禁**再次使用完全相同的关键词进行搜索！
 
-    - 如果之前的搜索结果为空，说明该关键词无效。请必须更换**同义词**、**英文原名**或**更宽泛的概念**。
+    - 如果之前的搜索结果为空，说明该关键词无效。请必须更换**同义词**、**英文原名**或**更宽泛的概念**，并尽量用 `search_rules_many` 一次性提交。
 
-    - 如果你已经尝试了 3 次不同的搜索词仍然没有结果，请**立即停止搜索**，并诚实地告诉用户你在当前选定的规则书中找不到答案。
+    - 如果你已经尝试了 3 轮不同的搜索词仍然没有结果，请**立即停止搜索**，并诚实地告诉用户你在当前选定的规则书中找不到答案。
 
     """
 
@@ -192,50 +489,405 @@ def reasoner(state: AgentState):
 
     # 调用 LLM
 
-    response = llm_with_tools.invoke(messages)
+    response = invoke_llm(get_llm_with_tools(), messages)
 
     # 返回更新后的状态
 
     return {"messages": [response]}
 
 
+def run_tools(state: AgentState):
+    """
+
+    工具节点：并发执行最后一条 AIMessage 中的工具调用。
+
+    本轮已经执行过的相同调用 (工具名和参数都相同) 不再重复检索，直接返回对先前结果的引用。
+
+    """
+
+    messages = state["messages"]
+
+    # 找到本轮的起点 (最后一条 HumanMessage)
+
+    _, turn_start = current_turn(messages)
+
+    earlier = earlier_results(messages[turn_start:-1])
+
+    tool_messages, timing = execute_tool_calls(
+        messages[-1].tool_calls, tools_by_name, earlier
+    )
+
+    # 统计按轮累计，新的一轮从零开始
+
+    turn_id = messages[turn_start].id
+
+    previous = state.get("tool_timing") or {}
+
+    if previous.get("turn_id") != turn_id:
+
+        previous = {}
+
+    previous = {k: v for k, v in previous.items() if k != "turn_id"}
+
+    tool_timing = merge_timing(previous, timing)
+
+    tool_timing["turn_id"] = turn_id
+
+    return {"messages": tool_messages, "tool_timing": tool_timing}
+
+
 # --- 4. 构建图 (Workflow) ---
 
-workflow = StateGraph(AgentState)
 
+def build_graph():
+    """构建并编译 Agent 图"""
 
-# 添加节点
+    workflow = StateGraph(AgentState)
 
-workflow.add_node("agent", reasoner)  # 思考节点
+    # 添加节点
 
-workflow.add_node("tools", ToolNode(tools))  # 工具执行节点 (LangGraph 自带)
+    # 每个节点的执行耗时都记录为 span (node.*)
 
+    # 历史压缩节点
 
-# 添加边 (流程连线)
+    workflow.add_node("compact", telemetry.traced("node.compact", compact_history))
 
-workflow.add_edge(START, "agent")  # 启动 -> 思考
+    # 思考节点
 
+    workflow.add_node("agent", telemetry.traced("node.agent", reasoner))
 
-# 添加条件边: 思考后去哪？
+    # 语义回答缓存：查找 (调用 LLM 之前) 和写入 (得到最终回答之后)
 
-# 如果 LLM 决定调用工具 -> 去 "tools"
+    workflow.add_node(
+        "answer_cache", telemetry.traced("node.answer_cache", check_answer_cache)
+    )
 
-# 如果 LLM 决定直接说话 -> 结束 (END)
+    workflow.add_node("remember", telemetry.traced("node.remember", remember_answer))
 
-workflow.add_conditional_edges(
-    "agent",
-    tools_condition,
-)
+    # 工具执行节点 (并发执行 + 重复调用去重)
+
+    workflow.add_node("tools", telemetry.traced("node.tools", run_tools))
+
+    # 添加边 (流程连线)
+
+    workflow.add_edge(START, "compact")  # 启动 -> 压缩历史
+
+    workflow.add_edge("compact", "answer_cache")  # 压缩历史 -> 查回答缓存
+
+    # 命中缓存 -> 结束 (END)；未命中 -> 思考
+
+    workflow.add_conditional_edges("answer_cache", route_after_cache)
+
+    # 添加条件边: 思考后去哪？
+
+    # 如果 LLM 决定调用工具 -> 去 "tools"
+
+    # 如果 LLM 决定直接说话 -> 写入回答缓存 -> 结束 (END)
+
+    workflow.add_conditional_edges(
+        "agent",
+        route_after_agent,
+    )
+
+    workflow.add_edge("remember", END)
+
+    # 工具执行完后，把结果扔回给 agent 继续思考
+
+    workflow.add_edge("tools", "agent")
+
+    # 编译图 (checkpointer 用于记住上下文，后端、会话上限和过期时间见 checkpointer.py)
+
+    return workflow.compile(checkpointer=get_checkpointer())
+
+
+def get_graph():
+    """返回进程级共享的已编译图 (首次调用时编译)"""
+
+    global _graph
+
+    if _graph is None:
+
+        with _init_lock:
+
+            if _graph is None:
+
+                _graph = build_graph()
+
+    return _graph
+
+
+def __getattr__(name):
+
+    # 兼容旧写法 `from src.agent.graph import graph`：访问时才编译
+
+    if name == "graph":
+
+        return get_graph()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# --- 5. 预热与健康检查 ---
+
+
+def warm_up(background=True):
+    """
+    提前创建向量库连接、LLM 客户端并编译图，让第一个问题不必承担初始化开销。
+    background=True 时在守护线程中执行，立即返回。
+    """
+
+    # 配置了 METRICS_PORT 时顺便启动 /metrics 接口
+
+    telemetry.start_metrics_server()
+
+    def _warm():
+
+        try:
+
+            get_vector_store()
+
+            get_keyword_index()
+
+            get_entity_index()
+
+            get_llm()
+
+            get_graph()
+
+        except Exception as e:
+
+            telemetry.log_event("warm_up.failed", logging.WARNING, error=str(e))
+
+    if background:
+
+        thread = threading.Thread(target=_warm, name="agent-warm-up", daemon=True)
+
+        thread.start()
+
+        return thread
+
+    _warm()
+
+    return None
+
+
+def health_check():
+    """
+    检查各依赖是否可用 (会触发延迟初始化)。
+    返回 {"ok": bool, "checks": {组件: 状态说明}}，可用于容器的 readiness 探针。
+    """
+
+    checks = {}
+
+    try:
+
+        count = get_vector_store()._collection.count()
+
+        checks["vector_store"] = f"ok ({count} chunks)"
+
+    except Exception as e:
+
+        checks["vector_store"] = f"error: {e}"
+
+    keyword_index = get_keyword_index()
+
+    checks["keyword_index"] = "ok" if keyword_index is not None else "disabled"
+
+    try:
+
+        get_llm()
+
+        checks["llm"] = "ok"
+
+    except Exception as e:
+
+        checks["llm"] = f"error: {e}"
+
+    try:
+
+        get_graph()
+
+        checks["graph"] = "ok"
+
+    except Exception as e:
+
+        checks["graph"] = f"error: {e}"
 
+    try:
 
-# 工具执行完后，把结果扔回给 agent 继续思考
+        checks["sessions"] = f"ok ({get_graph().checkpointer.stats()})"
 
-workflow.add_edge("tools", "agent")
+    except Exception as e:
 
+        checks["sessions"] = f"error: {e}"
 
-# 编译图 (MemorySaver 用于记住上下文)
+    ok = all(not status.startswith("error") for status in checks.values())
 
-graph = workflow.compile(checkpointer=MemorySaver())
+    return {"ok": ok, "checks": checks}
+
+
+def collect_session_metrics():
+    """导出指标时采集会话存储的现状"""
+
+    samples = []
+
+    if _graph is not None:
+
+        sessions = _graph.checkpointer.stats()
+
+        samples += [
+            ("sessions", {"backend": sessions["backend"]}, sessions["threads"]),
+            ("sessions_evicted", {}, sessions["evicted"]),
+            ("sessions_storage_bytes", {}, sessions["storage_bytes"]),
+        ]
+
+    return samples
+
+
+telemetry.metrics.register_collector(collect_session_metrics)
+
+
+# --- 6. 流式输出 ---
+
+
+def _to_stream_events(mode, payload):
+    """
+    把 LangGraph 的 (stream_mode, payload) 转成前端关心的事件：
+
+    - ("token", 文本片段): agent 节点中 LLM 逐 token 生成的内容 (messages 模式)
+    - ("tool_call", tool_call): agent 决定调用工具 (此前推送的 token 应当作废)
+    - ("tool_result", 文本): 工具返回的结果
+    - ("tool_timing", 统计): 本轮工具执行的累计耗时，saved_time 为并行和去重节省的秒数
+    - ("cache_hit", 信息): 命中语义回答缓存，含原问题、相似度和引用来源
+    - ("answer", 文本): agent 的最终完整回复 (命中缓存时为缓存的回复)
+    """
+
+    if mode == "messages":
+
+        chunk, metadata = payload
+
+        # 只转发 agent 节点中 LLM 产生的增量片段，工具节点输出的完整消息走 updates
+
+        if (
+            isinstance(chunk, AIMessageChunk)
+            and metadata.get("langgraph_node") == "agent"
+        ):
+
+            text = message_text(chunk.content)
+
+            if text:
+
+                yield "token", text
+
+        return
+
+    for key, value in payload.items():
+
+        if not value or "messages" not in value:
+
+            continue
+
+        msg = value["messages"][-1]
+
+        if key == "agent":
+
+            if msg.tool_calls:
+
+                for tool_call in msg.tool_calls:
+
+                    yield "tool_call", tool_call
+
+            else:
+
+                yield "answer", message_text(msg.content)
+
+        elif key == "answer_cache":
+
+            yield "cache_hit", msg.response_metadata["answer_cache"]
+
+            yield "answer", message_text(msg.content)
+
+        elif key == "tools":
+
+            for tool_msg in value["messages"]:
+
+                yield "tool_result", message_text(tool_msg.content)
+
+            if value.get("tool_timing"):
+
+                yield "tool_timing", value["tool_timing"]
+
+
+def stream_agent(inputs, config=None):
+    """
+    同步流式运行 Agent，逐个 yield (事件类型, 数据)，见 _to_stream_events。
+    同时订阅 updates (节点完成) 和 messages (LLM token) 两种流，首个 token 生成后即可显示。
+    每次调用记录为一个 trace，结束后刷新指标文件。
+    """
+
+    thread_id = (config or {}).get("configurable", {}).get("thread_id")
+
+    question = QuestionMetrics()
+
+    try:
+
+        with telemetry.trace(thread_id=thread_id) as fields:
+
+            for mode, payload in get_graph().stream(
+                inputs, config=config, stream_mode=["updates", "messages"]
+            ):
+
+                for event in _to_stream_events(mode, payload):
+
+                    question.record(event[0])
+
+                    yield event
+
+            question.finish(fields)
+
+    finally:
+
+        telemetry.write_metrics()
+
+
+async def astream_agent(inputs, config=None):
+    """
+    stream_agent 的异步版本，供 FastAPI 等异步服务使用。
+    SQLite 会话后端 (SqliteSaver) 没有异步接口，此时直接报错，请改用 stream_agent。
+    """
+
+    backend = getattr(get_graph().checkpointer, "backend", None)
+
+    if backend == "sqlite":
+
+        raise RuntimeError(
+            "CHECKPOINT_BACKEND=sqlite 只支持同步调用，请使用 stream_agent，"
+            "或把 CHECKPOINT_BACKEND 设为 memory 后再使用 astream_agent。"
+        )
+
+    thread_id = (config or {}).get("configurable", {}).get("thread_id")
+
+    question = QuestionMetrics()
+
+    try:
+
+        with telemetry.trace(thread_id=thread_id) as fields:
+
+            async for mode, payload in get_graph().astream(
+                inputs, config=config, stream_mode=["updates", "messages"]
+            ):
+
+                for event in _to_stream_events(mode, payload):
+
+                    question.record(event[0])
+
+                    yield event
+
+            question.finish(fields)
+
+    finally:
+
+        telemetry.write_metrics()
 
 
 if __name__ == "__main__":
@@ -277,35 +929,53 @@ if __name__ == "__main__":
 
             print("\nThinking...", end="", flush=True)
 
-            # 运行图并流式输出事件
+            # 运行图并流式输出：token 边生成边打印，工具调用和结果单独成行
+
+            streaming = False
+
+            for kind, data in stream_agent(inputs, config=config):
+
+                if kind == "token":
+
+                    if not streaming:
+
+                        print("\n[Agent] 回复: ", end="", flush=True)
+
+                        streaming = True
+
+                    print(data, end="", flush=True)
 
-            for event in graph.stream(inputs, config=config):
+                elif kind == "tool_call":
 
-                for key, value in event.items():
+                    streaming = False
 
-                    if key == "agent":
+                    print(f"\n[Agent] 决定查阅规则: {data['name']} args={data['args']}")
 
-                        # 获取 Agent 的最后一条消息
+                elif kind == "tool_result":
 
-                        msg = value["messages"][-1]
+                    print(f"\n[Tool] 检索结果 (前100字符): {data[:100]}...")
 
-                        if msg.tool_calls:
+                elif kind == "tool_timing" and data["saved_time"] > 0:
 
-                            print(
-                                f"\n[Agent] 决定查阅规则: {msg.tool_calls[0]['name']} args={msg.tool_calls[0]['args']}"
-                            )
+                    print(
+                        f"\n[Tool] 本轮并行/去重节省 {data['saved_time']:.2f}s "
+                        f"(去重 {data['deduplicated']} 次)"
+                    )
 
-                        else:
+                elif kind == "cache_hit":
 
-                            print(f"\n[Agent] 回复: {msg.content}")
+                    print(
+                        f"\n[Cache] 命中回答缓存: {data['question']} "
+                        f"(相似度 {data['similarity']:.2f})"
+                    )
 
-                    elif key == "tools":
+                elif kind == "answer" and not streaming:
 
-                        # 获取工具的返回结果
+                    # 模型未以流式返回时，直接打印完整回复
 
-                        msg = value["messages"][-1]
+                    print(f"\n[Agent] 回复: {data}")
 
-                        print(f"\n[Tool] 检索结果 (前100字符): {msg.content[:100]}...")
+            print()
 
         except Exception as e:
 
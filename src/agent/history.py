@@ -0,0 +1,107 @@
+import os
+import json
+
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, ToolMessage
+
+from src.db.tokens import estimate_tokens
+
+# --- 配置参数 ---
+# 历史消息 (不含当前轮) 的 token 预算，超出后从最早的完整轮次开始丢弃
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))
+# 之前轮次的检索结果只保留开头这么多字符
+HISTORY_TOOL_STUB_CHARS = int(os.getenv("HISTORY_TOOL_STUB_CHARS", "200"))
+TOOL_STUB_MARKER = "\n...[早期检索结果已压缩]"
+
+
+def message_text(content):
+    """把消息内容转成纯文本 (Gemini 可能返回 [{"type": "text", "text": ...}] 形式的列表)"""
+    if isinstance(content, list):
+        return "".join(
+            item.get("text", "") if isinstance(item, dict) else str(item)
+            for item in content
+            if not isinstance(item, dict) or item.get("type") == "text"
+        )
+    return str(content)
+
+
+def message_tokens(msg):
+    """估算一条消息占用的 token 数 (工具调用的参数也计入)"""
+    tokens = estimate_tokens(message_text(msg.content))
+    if isinstance(msg, AIMessage) and msg.tool_calls:
+        tokens += sum(
+            estimate_tokens(json.dumps(tc["args"], ensure_ascii=False))
+            for tc in msg.tool_calls
+        )
+    return tokens
+
+
+def split_turns(messages):
+    """按 HumanMessage 把消息切成轮次，每一轮从用户提问开始，到下一次提问之前结束"""
+    turns = []
+    for msg in messages:
+        if isinstance(msg, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
+
+
+def compact_messages(
+    messages,
+    token_budget=HISTORY_TOKEN_BUDGET,
+    stub_chars=HISTORY_TOOL_STUB_CHARS,
+):
+    """
+    压缩对话历史，返回需要交给 add_messages 的更新列表：
+
+    1. 之前轮次的 ToolMessage 正文截断为前 stub_chars 个字符 (同 ID 的消息会被原地替换)，
+       最终回答里已经包含了从中得到的结论，完整检索结果没必要每轮重发
+    2. 之前轮次的总 token 数仍超过 token_budget 时，从最早的轮次开始整轮删除 (RemoveMessage)，
+       整轮删除可以保证工具调用和工具结果始终成对出现
+    当前轮 (最后一条 HumanMessage 之后) 的消息保持不变。
+    """
+    turns = split_turns(messages)
+    if len(turns) < 2:
+        return []
+
+    updates = []
+    history = turns[:-1]
+    turn_tokens = []
+    for turn in history:
+        tokens = 0
+        for msg in turn:
+            content = message_text(msg.content)
+            if (
+                isinstance(msg, ToolMessage)
+                and len(content) > stub_chars
+                and not content.endswith(TOOL_STUB_MARKER)
+            ):
+                stub = content[:stub_chars] + TOOL_STUB_MARKER
+                updates.append(
+                    ToolMessage(
+                        content=stub,
+                        id=msg.id,
+                        name=msg.name,
+                        tool_call_id=msg.tool_call_id,
+                    )
+                )
+                tokens += estimate_tokens(stub)
+            else:
+                tokens += message_tokens(msg)
+        turn_tokens.append(tokens)
+
+    total = sum(turn_tokens)
+    dropped = set()
+    for turn, tokens in zip(history, turn_tokens):
+        if total <= token_budget:
+            break
+        for msg in turn:
+            dropped.add(msg.id)
+            updates.append(RemoveMessage(id=msg.id))
+        total -= tokens
+
+    # 被删除的消息不必再替换
+    return [
+        msg
+        for msg in updates
+        if isinstance(msg, RemoveMessage) or msg.id not in dropped
+    ]
@@ -0,0 +1,171 @@
+import os
+import math
+import logging
+import threading
+
+from src.agent import telemetry
+from src.db.keyword_index import tokenize
+from src.db.tokens import estimate_tokens, split_sentences
+
+# --- 配置参数 ---
+# 可选的重排阶段 (默认关闭)：先宽召回 RERANK_CANDIDATES 个候选，重排后按 token 预算打包返回
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "0") != "0"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+# 设置为 sentence-transformers 的 CrossEncoder 模型名时使用模型打分，否则使用词法打分
+RERANK_MODEL = os.getenv("RERANK_MODEL", "")
+# 单次工具结果的 token 预算，以及每个片段最多占用的 token 数
+RESULT_TOKEN_BUDGET = int(os.getenv("RESULT_TOKEN_BUDGET", "1500"))
+RESULT_CHUNK_TOKENS = int(os.getenv("RESULT_CHUNK_TOKENS", "500"))
+# 剩余预算少于此值时不再追加片段
+MIN_EXCERPT_TOKENS = 60
+ELLIPSIS = "……"
+
+_cross_encoder = None
+_cross_encoder_lock = threading.Lock()
+
+
+def get_cross_encoder():
+    """按需加载 CrossEncoder (需要安装 sentence-transformers)，未配置或加载失败时返回 None"""
+    global _cross_encoder
+    if not RERANK_MODEL:
+        return None
+    if _cross_encoder is None:
+        with _cross_encoder_lock:
+            if _cross_encoder is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+
+                    _cross_encoder = CrossEncoder(RERANK_MODEL)
+                except Exception as e:
+                    telemetry.log_event(
+                        "rerank.model_load_failed",
+                        logging.WARNING,
+                        model=RERANK_MODEL,
+                        error=str(e),
+                    )
+                    _cross_encoder = False
+    return _cross_encoder or None
+
+
+def lexical_scores(query, docs):
+    """
+    词法相关度打分 (与关键词索引使用同一套分词)：
+    查询词覆盖率为主，按候选集内的 IDF 加权的词频为辅，长文档的词频按长度开方归一化。
+    """
+    query_tokens = set(tokenize(query))
+    if not query_tokens:
+        return [0.0] * len(docs)
+    doc_tokens = [tokenize(doc.page_content) for doc in docs]
+    df = {
+        token: sum(1 for tokens in doc_tokens if token in tokens)
+        for token in query_tokens
+    }
+    idf = {
+        token: math.log(1 + len(docs) / count) for token, count in df.items() if count
+    }
+    total_idf = sum(idf.values()) or 1.0
+
+    scores = []
+    for tokens in doc_tokens:
+        counts = {}
+        for token in tokens:
+            if token in query_tokens:
+                counts[token] = counts.get(token, 0) + 1
+        coverage = sum(idf[token] for token in counts) / total_idf
+        weighted_tf = sum(idf[token] * math.log(1 + n) for token, n in counts.items())
+        scores.append(
+            coverage + 0.5 * weighted_tf / total_idf / math.sqrt(1 + len(tokens) / 200)
+        )
+    return scores
+
+
+def rerank(query, docs):
+    """按与查询的相关度重排候选 (CrossEncoder 或词法打分)"""
+    if len(docs) < 2:
+        return list(docs)
+    model = get_cross_encoder()
+    if model is not None:
+        scores = list(model.predict([(query, doc.page_content) for doc in docs]))
+    else:
+        scores = lexical_scores(query, docs)
+    # 原始排名带一点先验权重，避免词法打分完全推翻语义检索的结果
+    ranked = sorted(
+        range(len(docs)),
+        key=lambda i: scores[i] + 0.1 / (i + 1),
+        reverse=True,
+    )
+    return [docs[i] for i in ranked]
+
+
+def excerpt(text, query, max_tokens):
+    """
+    文本超出 max_tokens 时，截取命中查询词最多的句子及其前后文作为摘录。
+    开头的标题行始终保留，被省略的部分用省略号标出。
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    header = ""
+    lines = text.split("\n", 1)
+    if lines[0].lstrip().startswith("#") and len(lines) > 1:
+        header, text = lines[0], lines[1]
+        max_tokens -= estimate_tokens(header) + 1
+
+    sentences = split_sentences(text)
+    if not sentences or max_tokens <= 0:
+        return header
+    query_tokens = set(tokenize(query))
+    hits = [len(query_tokens & set(tokenize(sentence))) for sentence in sentences]
+    sizes = [estimate_tokens(sentence) for sentence in sentences]
+
+    # 以命中查询词最多的句子为中心，向后、向前交替扩展，直到用完预算
+    anchor = max(range(len(sentences)), key=lambda i: hits[i])
+    if sizes[anchor] > max_tokens:
+        # 单个句子就超出预算，直接按字符截断
+        sentence = sentences[anchor]
+        body = sentence[: max(1, len(sentence) * max_tokens // sizes[anchor])]
+        first, last = anchor, anchor + 1
+    else:
+        first, last = anchor, anchor + 1
+        used = sizes[anchor]
+        grew = True
+        while grew:
+            grew = False
+            if last < len(sentences) and used + sizes[last] <= max_tokens:
+                used += sizes[last]
+                last += 1
+                grew = True
+            if first > 0 and used + sizes[first - 1] <= max_tokens:
+                first -= 1
+                used += sizes[first]
+                grew = True
+        body = "".join(sentences[first:last]).strip()
+    if first > 0:
+        body = ELLIPSIS + body
+    if last < len(sentences):
+        body = body + ELLIPSIS
+    return f"{header}\n{body}" if header else body
+
+
+def pack_results(
+    query,
+    docs,
+    token_budget=RESULT_TOKEN_BUDGET,
+    chunk_tokens=RESULT_CHUNK_TOKENS,
+):
+    """
+    按排名依次放入片段，直到用完 token 预算。
+    每个片段最多占 chunk_tokens，超长的片段截取与查询最相关的部分。
+    返回 [(Document, 摘录文本)]。
+    """
+    packed = []
+    remaining = token_budget
+    for doc in docs:
+        if remaining < MIN_EXCERPT_TOKENS:
+            break
+        text = excerpt(doc.page_content, query, min(chunk_tokens, remaining))
+        if not text.strip():
+            continue
+        packed.append((doc, text))
+        remaining -= estimate_tokens(text)
+    return packed
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# --- 配置路径 ---
+BASE_DIR = Path(__file__).resolve().parents[2]
+# Prometheus 文本格式的指标文件，每个问题处理完后刷新一次
+METRICS_PATH = Path(os.getenv("METRICS_PATH", BASE_DIR / "data" / "metrics.prom"))
+
+# --- 配置参数 ---
+# 结构化 JSON 日志的输出位置：留空输出到 stderr
+TELEMETRY_LOG_PATH = os.getenv("TELEMETRY_LOG_PATH", "")
+TELEMETRY_LOG_LEVEL = os.getenv("TELEMETRY_LOG_LEVEL", "INFO")
+# 设置端口后在后台线程提供 /metrics HTTP 接口
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRIC_PREFIX = "dnd_agent_"
+# 耗时直方图的桶 (秒)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13)
+
+# 当前问题的 trace ID，跨节点、跨工具调用关联同一个问题的所有日志
+current_trace = contextvars.ContextVar("trace_id", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record):
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": record.getMessage(),
+        }
+        data.update(getattr(record, "fields", {}))
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def _build_logger():
+    logger = logging.getLogger("dnd_agent")
+    if not logger.handlers:
+        if TELEMETRY_LOG_PATH:
+            Path(TELEMETRY_LOG_PATH).parent.mkdir(parents=True, exist_ok=True)
+            handler = logging.FileHandler(TELEMETRY_LOG_PATH, encoding="utf-8")
+        else:
+            handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(TELEMETRY_LOG_LEVEL)
+        logger.propagate = False
+    return logger
+
+
+logger = _build_logger()
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """输出一条结构化日志，自动带上当前 trace ID"""
+    trace_id = current_trace.get()
+    if trace_id:
+        fields["trace_id"] = trace_id
+    logger.log(level, event, extra={"fields": fields})
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表：计数器、直方图，以及在导出时才采集的外部指标 (collector)。
+    导出为 Prometheus 文本格式。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (名称, 标签) -> 值
+        self._histograms = {}  # (名称, 标签) -> [各桶计数, 总和, 次数, 桶]
+        self._collectors = []
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, self._labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(buckets), 0.0, 0, buckets]
+                self._histograms[key] = histogram
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def register_collector(self, collector):
+        """collector() 返回 [(名称, {标签}, 值)]，在导出时调用，用于缓存命中率等现成的统计"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """导出 Prometheus 文本格式"""
+
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            body = ",".join(
+                f'{key}="{value}"'.replace("\n", " ") for key, value in pairs
+            )
+            return "{" + body + "}"
+
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: (list(value[0]), value[1], value[2], value[3])
+                for key, value in self._histograms.items()
+            }
+            collectors = list(self._collectors)
+
+        described = set()
+
+        def describe(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            lines.append(f"# TYPE {METRIC_PREFIX}{name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, "counter")
+            lines.append(f"{METRIC_PREFIX}{name}{fmt_labels(labels)} {value}")
+
+        for (name, labels), (counts, total, count, buckets) in sorted(
+            histograms.items()
+        ):
+            describe(name, "histogram")
+            for bound, bucket_count in zip(buckets, counts):
+                lines.append(
+                    f"{METRIC_PREFIX}{name}_bucket"
+                    f"{fmt_labels(labels, [('le', bound)])} {bucket_count}"
+                )
+            lines.append(
+                f"{METRIC_PREFIX}{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {count}"
+            )
+            lines.append(f"{METRIC_PREFIX}{name}_sum{fmt_labels(labels)} {total}")
+            lines.append(f"{METRIC_PREFIX}{name}_count{fmt_labels(labels)} {count}")
+
+        for collector in collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                log_event("metrics.collector_failed", logging.WARNING, error=str(e))
+                continue
+            for name, labels, value in samples:
+                describe(name, "gauge")
+                lines.append(
+                    f"{METRIC_PREFIX}{name}{fmt_labels(self._labels(labels))} {value}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+def incr(name, value=1, **labels):
+    metrics.incr(name, value, **labels)
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    metrics.observe(name, value, buckets, **labels)
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    记录一段代码的耗时：写入 span_seconds{span=name} 直方图，并输出一条 JSON 日志。
+    yield 的字典可以在代码块内补充属性 (例如 token 数、命中数)。
+    """
+    fields = dict(attrs)
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield fields
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe("span_seconds", duration, span=name, status=status)
+        log_event(
+            "span",
+            logging.DEBUG if name.startswith("retrieve.") else logging.INFO,
+            span=name,
+            status=status,
+            duration_ms=round(duration * 1000, 2),
+            **fields,
+        )
+
+
+def traced(name, func):
+    """包装图节点等函数，每次调用记录一个 span"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class QuestionMetrics:
+    """
+    统计一次问答的端到端指标：首个 token 的延迟、工具调用轮数 (hops)、工具调用次数。
+    由 stream_agent 对每个流式事件调用 record()，结束时调用 finish()。
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.tool_hops = 0
+        self.tool_calls = 0
+
+    def record(self, kind):
+        if kind == "token" and self.first_token is None:
+            self.first_token = time.perf_counter() - self.start
+        elif kind == "tool_call":
+            self.tool_calls += 1
+        elif kind == "tool_timing":
+            # 每次工具节点执行完都会产生一次 tool_timing，即一次 LLM -> 工具 -> LLM 往返
+            self.tool_hops += 1
+
+    def finish(self, fields):
+        fields["tool_hops"] = self.tool_hops
+        fields["tool_calls"] = self.tool_calls
+        observe("question_tool_hops", self.tool_hops, buckets=COUNT_BUCKETS)
+        if self.first_token is not None:
+            fields["ttft_ms"] = round(self.first_token * 1000, 2)
+            observe("time_to_first_token_seconds", self.first_token)
+
+
+@contextmanager
+def trace(trace_id=None, **attrs):
+    """把一次问答作为一个 trace：其中所有 span 和日志共享同一个 trace ID"""
+    token = current_trace.set(trace_id or uuid.uuid4().hex[:16])
+    try:
+        with span("question", **attrs) as fields:
+            yield fields
+    finally:
+        try:
+            current_trace.reset(token)
+        except ValueError:
+            # 异步生成器可能在另一个 context 中被关闭，此时无需恢复
+            pass
+
+
+def write_metrics(path=METRICS_PATH):
+    """把当前指标写入 Prometheus 文本文件 (可配合 node_exporter 的 textfile collector)"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(metrics.render())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """在后台线程提供 http://0.0.0.0:port/metrics，port 为 0 时不启动；重复调用只启动一次"""
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            except OSError as e:
+                # Streamlit 多进程/重复启动时端口可能已被占用
+                log_event("metrics.server_failed", logging.WARNING, error=str(e))
+                return None
+            thread = threading.Thread(
+                target=_server.serve_forever, name="metrics-server", daemon=True
+            )
+            thread.start()
+            log_event("metrics.server_started", port=port)
+    return _server
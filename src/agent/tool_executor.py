@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, ToolMessage
+
+from src.agent import telemetry
+from src.db.embeddings import normalize_text
+
+# --- 配置参数 ---
+# 同一条 AIMessage 中多个工具调用的并发数
+TOOL_WORKERS = int(os.getenv("TOOL_WORKERS", "4"))
+
+# 进程级累计统计
+_totals = {"runs": 0, "calls": 0, "executed": 0, "deduplicated": 0, "saved_time": 0.0}
+_totals_lock = threading.Lock()
+
+
+def tool_call_key(tool_call):
+    """工具名 + 归一化后的参数，参数完全相同的调用视为重复"""
+
+    def normalize(value):
+        if isinstance(value, str):
+            return normalize_text(value).lower()
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        return value
+
+    args = json.dumps(normalize(tool_call["args"]), sort_keys=True, ensure_ascii=False)
+    return tool_call["name"], args
+
+
+def earlier_results(turn_messages):
+    """
+    当前轮中已经执行过的工具调用，返回 {调用键: (tool_call_id, 耗时)}。
+    turn_messages 为本轮 (最后一条 HumanMessage 之后) 的消息。
+    """
+    keys = {}
+    for msg in turn_messages:
+        if isinstance(msg, AIMessage):
+            for tool_call in msg.tool_calls:
+                keys[tool_call["id"]] = tool_call_key(tool_call)
+    found = {}
+    for msg in turn_messages:
+        if isinstance(msg, ToolMessage) and msg.tool_call_id in keys:
+            if msg.status == "error":
+                continue
+            elapsed = msg.response_metadata.get("elapsed", 0.0)
+            found.setdefault(keys[msg.tool_call_id], (msg.tool_call_id, elapsed))
+    return found
+
+
+def _invoke(tool, tool_call):
+    """执行单个工具调用，返回 (ToolMessage, 耗时)；异常转成错误消息交给 LLM 处理"""
+    start = time.perf_counter()
+    try:
+        content = tool.invoke(tool_call["args"])
+        status = "success"
+    except Exception as e:
+        content = f"工具调用出错: {e}"
+        status = "error"
+    elapsed = time.perf_counter() - start
+    telemetry.observe("tool_seconds", elapsed, tool=tool_call["name"], status=status)
+    telemetry.incr("tool_calls_total", tool=tool_call["name"], status=status)
+    message = ToolMessage(
+        content=content if isinstance(content, str) else json.dumps(content),
+        name=tool_call["name"],
+        tool_call_id=tool_call["id"],
+        status=status,
+        response_metadata={"elapsed": elapsed},
+    )
+    return message, elapsed
+
+
+def reference_message(tool_call, original_id):
+    """重复调用不再执行，返回指向先前结果的引用"""
+    return ToolMessage(
+        content=(
+            f"与本轮之前的调用 (tool_call_id={original_id}) 参数完全相同，"
+            "结果见上文对应的工具返回，未重复检索。"
+        ),
+        name=tool_call["name"],
+        tool_call_id=tool_call["id"],
+        response_metadata={"elapsed": 0.0, "duplicate_of": original_id},
+    )
+
+
+def execute_tool_calls(tool_calls, tools_by_name, earlier=None, workers=TOOL_WORKERS):
+    """
+    并发执行一条 AIMessage 中的工具调用，并跳过重复调用。
+
+    - 与本轮之前的调用 (earlier) 或同一批中更早的调用参数相同时，不再执行，
+      返回引用先前结果的 ToolMessage
+    - 其余调用在线程池中并发执行
+    返回 (按原顺序排列的 ToolMessage 列表, 耗时统计)。
+    saved_time = 各调用串行耗时之和 - 实际耗时 + 重复调用原本需要的耗时。
+    """
+    earlier = dict(earlier or {})
+    start = time.perf_counter()
+
+    unique = []  # 需要真正执行的调用
+    duplicate_of = {}  # 重复调用的 id -> 先前调用的 id
+    first_seen = {}  # 调用键 -> 本批第一次出现的 id
+    for tool_call in tool_calls:
+        key = tool_call_key(tool_call)
+        if key in earlier:
+            duplicate_of[tool_call["id"]] = earlier[key][0]
+        elif key in first_seen:
+            duplicate_of[tool_call["id"]] = first_seen[key]
+        else:
+            first_seen[key] = tool_call["id"]
+            unique.append(tool_call)
+
+    def run(tool_call):
+        tool = tools_by_name.get(tool_call["name"])
+        if tool is None:
+            message = ToolMessage(
+                content=f"未知的工具: {tool_call['name']}",
+                name=tool_call["name"],
+                tool_call_id=tool_call["id"],
+                status="error",
+            )
+            return message, 0.0
+        return _invoke(tool, tool_call)
+
+    if len(unique) > 1 and workers > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(unique))) as executor:
+            # 每个任务带上当前 context，子线程的日志仍归属同一个 trace
+            futures = [
+                executor.submit(contextvars.copy_context().run, run, tool_call)
+                for tool_call in unique
+            ]
+            outcomes = [future.result() for future in futures]
+    else:
+        outcomes = [run(tool_call) for tool_call in unique]
+
+    results = {}
+    elapsed_by_id = {}
+    for tool_call, (message, elapsed) in zip(unique, outcomes):
+        results[tool_call["id"]] = message
+        elapsed_by_id[tool_call["id"]] = elapsed
+    for original_id, elapsed in earlier.values():
+        elapsed_by_id.setdefault(original_id, elapsed)
+
+    messages = []
+    dedup_saved = 0.0
+    for tool_call in tool_calls:
+        if tool_call["id"] in results:
+            messages.append(results[tool_call["id"]])
+        else:
+            original_id = duplicate_of[tool_call["id"]]
+            messages.append(reference_message(tool_call, original_id))
+            dedup_saved += elapsed_by_id.get(original_id, 0.0)
+
+    wall_time = time.perf_counter() - start
+    tool_time = sum(elapsed for _, elapsed in outcomes)
+    timing = {
+        "calls": len(tool_calls),
+        "executed": len(unique),
+        "deduplicated": len(tool_calls) - len(unique),
+        "tool_time": tool_time,
+        "wall_time": wall_time,
+        "saved_time": max(0.0, tool_time - wall_time) + dedup_saved,
+    }
+
+    if timing["deduplicated"]:
+        telemetry.incr("tool_calls_deduplicated_total", timing["deduplicated"])
+    telemetry.observe("tool_saved_seconds", timing["saved_time"])
+    with _totals_lock:
+        _totals["runs"] += 1
+        for name in ("calls", "executed", "deduplicated", "saved_time"):
+            _totals[name] += timing[name]
+    return messages, timing
+
+
+def merge_timing(previous, timing):
+    """把一次工具执行的统计累加到本轮的统计上"""
+    merged = dict(previous or {})
+    for name, value in timing.items():
+        merged[name] = merged.get(name, 0) + value
+    return merged
+
+
+def tool_stats():
+    """进程启动以来的工具执行统计 (调用数、去重数、节省的秒数)"""
+    with _totals_lock:
+        return dict(_totals)
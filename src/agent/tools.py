@@ -1,10 +1,30 @@
 import os
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_chroma import Chroma
 from langchain_core.tools import tool
 
+from src.agent import telemetry
+from src.agent.rerank import RERANK_CANDIDATES, RERANK_ENABLED, pack_results, rerank
+from src.db.catalog import load_catalog
+from src.db.chunk_ids import compute_chunk_id
+from src.db.embeddings import (
+    check_collection_embedding,
+    embed_queries,
+    embedding_info,
+    get_embeddings,
+    normalize_text,
+)
+from src.db.entity_index import ENTITY_INDEX_PATH, ENTITY_KINDS, EntityIndex
+from src.db.ingest_version import read_ingest_version
+from src.db.keyword_index import KEYWORD_INDEX_PATH, KeywordIndex
+from src.db.partitions import plan_partitions, search_partitions
+
 load_dotenv()
 
 # --- 配置路径 (指向之前生成的 chroma_db_data) ---
@@ -12,18 +32,303 @@ BASE_DIR = Path(__file__).resolve().parents[2]
 CHROMA_DB_DIR = BASE_DIR / "chroma_db_data"
 COLLECTION_NAME = "dnd_rules"
 
-# --- 初始化向量库连接 ---
-# [重要] 必须使用和入库时 (src/db/ingest.py) 完全相同的模型名称
-embeddings = GoogleGenerativeAIEmbeddings(model="models/gemini-embedding-001")
+# --- 检索参数 ---
+SEARCH_K = 5  # 最终返回给 LLM 的片段数
+# 混合检索：向量检索 + BM25 关键词检索，用 RRF (倒数排名融合) 合并
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "1") != "0"
+HYBRID_CANDIDATES = 10  # 每一路检索召回的候选数
+RRF_K = 60  # RRF 平滑常数，越大则排名靠后的结果权重下降得越慢
+# 多查询检索：一次最多接受的查询数、并发检索线程数、最终返回的片段数
+MULTI_QUERY_MAX = 5
+MULTI_QUERY_WORKERS = int(os.getenv("MULTI_QUERY_WORKERS", "4"))
+MULTI_SEARCH_K = 8
+# 检索结果缓存：容量 (条) 和过期时间 (秒)
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+# 结构化条目查询：最多返回的条目数、每个条目附带的原文长度 (字符)
+ENTITY_LOOKUP_LIMIT = 3
+ENTITY_TEXT_CHARS = 600
+# 按书分区检索：选中的书不超过分区总数的这个比例时并发检索各书的分区，否则用全局集合 + 过滤
+PARTITION_FALLBACK_RATIO = float(os.getenv("PARTITION_FALLBACK_RATIO", "0.5"))
 
-if not CHROMA_DB_DIR.exists():
-    raise FileNotFoundError(f"未找到向量库数据: {CHROMA_DB_DIR}，请先运行入库脚本。")
+# --- 向量库连接 (延迟初始化) ---
+# 导入本模块时不创建任何客户端，第一次检索 (或 warm_up) 时才初始化，
+# 之后在整个进程内复用同一个实例。
+_vector_store = None
+_keyword_index = None
+_keyword_index_loaded = False
+_entity_index = None
+_entity_index_loaded = False
+_partitions = (None, {})  # (入库版本, {书: 分区集合})
+_init_lock = threading.Lock()
 
-vector_store = Chroma(
-    collection_name=COLLECTION_NAME,
-    embedding_function=embeddings,
-    persist_directory=str(CHROMA_DB_DIR),
-)
+
+def get_vector_store():
+    """返回进程级共享的 Chroma 向量库实例 (首次调用时创建)"""
+    global _vector_store
+    if _vector_store is None:
+        with _init_lock:
+            if _vector_store is None:
+                # 延迟导入：chromadb 和 Google SDK 的加载本身就要数秒
+                from langchain_chroma import Chroma
+
+                if not CHROMA_DB_DIR.exists():
+                    raise FileNotFoundError(
+                        f"未找到向量库数据: {CHROMA_DB_DIR}，请先运行入库脚本。"
+                    )
+                # [重要] 必须使用和入库时 (src/db/ingest.py) 完全相同的后端和模型
+                # get_embeddings() 与入库脚本共用本地缓存，重复的查询不再请求 API
+                embeddings = get_embeddings()
+                vector_store = Chroma(
+                    collection_name=COLLECTION_NAME,
+                    embedding_function=embeddings,
+                    persist_directory=str(CHROMA_DB_DIR),
+                )
+                # 与入库时记录的 Embedding 不一致时在启动阶段直接报错
+                check_collection_embedding(
+                    vector_store._collection, embedding_info(embeddings)
+                )
+                _vector_store = vector_store
+    return _vector_store
+
+
+def get_keyword_index():
+    """关键词索引由入库脚本生成，缺失或关闭混合检索时返回 None (退化为纯向量检索)"""
+    global _keyword_index, _keyword_index_loaded
+    if not _keyword_index_loaded:
+        with _init_lock:
+            if not _keyword_index_loaded:
+                if HYBRID_SEARCH_ENABLED and KEYWORD_INDEX_PATH.exists():
+                    _keyword_index = KeywordIndex()
+                _keyword_index_loaded = True
+    return _keyword_index
+
+
+def get_entity_index():
+    """结构化条目索引由入库脚本生成，缺失时返回 None (lookup_entity 提示改用 search_rules)"""
+    global _entity_index, _entity_index_loaded
+    if not _entity_index_loaded:
+        with _init_lock:
+            if not _entity_index_loaded:
+                if ENTITY_INDEX_PATH.exists():
+                    _entity_index = EntityIndex()
+                _entity_index_loaded = True
+    return _entity_index
+
+
+def get_partitions():
+    """
+    返回入库时生成的按书分区 {书: Chroma 集合}。
+    分区名记录在书目目录中，随入库版本重新加载；目录过期或分区缺失时返回空字典 (只用全局集合)。
+    """
+    global _partitions
+    version = read_ingest_version()
+    if _partitions[0] != version:
+        client = get_vector_store()._client
+        with _init_lock:
+            if _partitions[0] != version:
+                names = (load_catalog() or {}).get("partitions") or {}
+                collections = {}
+                try:
+                    for book, name in names.items():
+                        collections[book] = client.get_collection(
+                            name, embedding_function=None
+                        )
+                except Exception as e:
+                    telemetry.log_event("partitions.unavailable", error=str(e))
+                    collections = {}
+                _partitions = (version, collections)
+    return _partitions[1]
+
+
+class SearchResultCache:
+    """
+    检索结果缓存 (TTL + LRU)。
+    键为 (归一化查询, 排序后的书目过滤, k)；入库版本号变化时整体清空。
+    """
+
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (写入时间, 结果)
+        self._version = read_ingest_version()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query, book_filter, k):
+        books = tuple(sorted(set(book_filter))) if book_filter else ()
+        return normalize_text(query).lower(), books, k
+
+    def _check_version(self):
+        version = read_ingest_version()
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key):
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                telemetry.incr("search_cache_requests_total", result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            telemetry.incr("search_cache_requests_total", result="hit")
+            return entry[1]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._check_version()
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "maxsize": self.maxsize,
+            "ingest_version": self._version,
+        }
+
+
+search_cache = SearchResultCache()
+
+
+def search_cache_stats():
+    """检索结果缓存的命中统计，用于评估缓存容量"""
+    return search_cache.stats()
+
+
+def collect_cache_metrics():
+    """导出指标时采集检索缓存和 Embedding 缓存的现状"""
+    stats = search_cache.stats()
+    samples = [
+        ("search_cache_entries", {}, stats["entries"]),
+        ("search_cache_hit_rate", {}, stats["hit_rate"]),
+    ]
+    embeddings = _vector_store.embeddings if _vector_store is not None else None
+    embedding_stats = embeddings.stats() if hasattr(embeddings, "stats") else {}
+    if embedding_stats:
+        samples += [
+            ("embedding_cache_hits", {}, embedding_stats["hits"]),
+            ("embedding_cache_misses", {}, embedding_stats["misses"]),
+            ("embedding_cache_entries", {}, embedding_stats["entries"]),
+        ]
+    return samples
+
+
+telemetry.metrics.register_collector(collect_cache_metrics)
+
+
+def doc_key(doc):
+    """用于跨检索通道去重的 ID (与入库时的 chunk ID 一致)"""
+    return doc.id or compute_chunk_id(doc.page_content, doc.metadata)
+
+
+def reciprocal_rank_fusion(result_lists, k=SEARCH_K, rrf_k=RRF_K):
+    """
+    RRF 融合多路检索结果：每个文档的得分为各路排名的 1 / (rrf_k + rank) 之和。
+    只依赖排名，不需要把向量距离和 BM25 分数归一化到同一尺度。
+    """
+    scores = {}
+    docs = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            key = doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [docs[key] for key in ranked[:k]]
+
+
+def build_filter(book_filter):
+    """构建 ChromaDB 的 Metadata 过滤器"""
+    if not book_filter:
+        return None
+    if len(book_filter) == 1:
+        return {"source_book": book_filter[0]}
+    return {"source_book": {"$in": book_filter}}
+
+
+def retrieve(query, book_filter=None, embedding=None):
+    """
+    单个查询的检索，返回各路检索的结果列表 (尚未融合)。
+    混合检索时向量和关键词两路各召回 HYBRID_CANDIDATES 个候选，否则只有向量一路召回 SEARCH_K 个；
+    开启重排时每一路都宽召回 RERANK_CANDIDATES 个。
+    传入 embedding 时直接按向量检索，不再调用 Embedding API。
+    只选了少数几本书且入库时生成了按书分区时，向量检索只查这几本书的分区。
+    """
+    vector_store = get_vector_store()
+    keyword_index = get_keyword_index()
+    if RERANK_ENABLED:
+        k = RERANK_CANDIDATES
+    else:
+        k = SEARCH_K if keyword_index is None else HYBRID_CANDIDATES
+    if embedding is None:
+        with telemetry.span("retrieve.embed"):
+            embedding = vector_store.embeddings.embed_query(query)
+    partitions = get_partitions()
+    plan = plan_partitions(book_filter, partitions, PARTITION_FALLBACK_RATIO)
+    with telemetry.span("retrieve.vector", k=k) as fields:
+        if plan is None:
+            vector_results = vector_store.similarity_search_by_vector(
+                embedding, k=k, filter=build_filter(book_filter)
+            )
+        else:
+            fields["partitions"] = len(plan)
+            vector_results = search_partitions(
+                [partitions[book] for book in plan], embedding, k
+            )
+        fields["results"] = len(vector_results)
+    result_lists = [vector_results]
+    if keyword_index is not None:
+        with telemetry.span("retrieve.keyword", k=k) as fields:
+            keyword_results = keyword_index.search(query, k=k, book_filter=book_filter)
+            fields["results"] = len(keyword_results)
+        result_lists.append(keyword_results)
+    return result_lists
+
+
+def select_results(query, result_lists, k=SEARCH_K):
+    """
+    融合多路召回结果，返回 [(Document, 给 LLM 看的文本)]。
+    开启重排时先融合出 RERANK_CANDIDATES 个候选，重排后取前 k 个，
+    再按 token 预算打包 (超长片段只保留与查询最相关的部分)。
+    """
+    if not RERANK_ENABLED:
+        results = reciprocal_rank_fusion(result_lists, k=k)
+        return [(doc, doc.page_content) for doc in results]
+    candidates = reciprocal_rank_fusion(result_lists, k=RERANK_CANDIDATES)
+    with telemetry.span("retrieve.rerank", candidates=len(candidates)):
+        return pack_results(query, rerank(query, candidates)[:k])
+
+
+def format_results(results):
+    """格式化返回结果给 LLM 看，results 为 [(Document, 文本)]"""
+    formatted_results = []
+    for doc, text in results:
+        # header_path 为 "章节 > 上级标题 > 标题"，旧数据没有时退回章节名
+        location = doc.metadata.get("header_path") or doc.metadata.get(
+            "chapter", "Unknown"
+        )
+        source = f"{doc.metadata.get('source_book', 'Unknown')} > {location}"
+        # 在内容前加上来源标注，方便 LLM 引用
+        content = f"--- 来源: {source} ---\n{text}\n"
+        formatted_results.append(content)
+    return "\n".join(formatted_results)
 
 
 @tool
@@ -35,36 +340,203 @@ def search_rules(query: str, book_filter: list[str] = None):
         query: 具体的搜索关键词 (例如: "火球术 伤害", "野蛮人 狂暴 机制").
         book_filter: 限制搜索的规则书列表 (例如: ["PHB", "XGE"]). 如果为 None，则搜索所有书.
     """
-    print(
-        f"\n[Tool] 正在检索: {query} | 范围: {book_filter if book_filter else '全部'}"
+    telemetry.log_event("tool.search_rules", query=query, books=book_filter or "全部")
+
+    cache_key = SearchResultCache.make_key(query, book_filter, SEARCH_K)
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # 执行相似度搜索，混合检索时两路结果融合 (并重排) 后取前 SEARCH_K 个
+    try:
+        results = select_results(query, retrieve(query, book_filter))
+    except Exception as e:
+        telemetry.log_event("tool.search_failed", logging.ERROR, error=str(e))
+        return f"检索出错: {str(e)}"
+
+    if not results:
+        # 空结果同样缓存，避免 Agent 重复搜索同一个无效关键词
+        output = "未在指定的规则书中找到相关内容。"
+        search_cache.put(cache_key, output)
+        return output
+
+    output = format_results(results)
+    search_cache.put(cache_key, output)
+    return output
+
+
+@tool
+def search_rules_many(queries: list[str], book_filter: list[str] = None):
+    """
+    一次性用多个关键词检索 D&D 5E 规则书，结果去重合并后返回。
+    需要尝试同义词、英文原名或相关概念时，用它代替多次调用 search_rules。
+
+    Args:
+        queries: 2-5 个不同角度的搜索关键词 (例如: ["火球术 伤害", "Fireball", "三环 塑能 法术"]).
+        book_filter: 限制搜索的规则书列表 (例如: ["PHB", "XGE"]). 如果为 None，则搜索所有书.
+    """
+    # 去掉空白和重复的查询 (按归一化后的文本比较)，保持原有顺序
+    unique = {}
+    for query in queries or []:
+        normalized = normalize_text(query)
+        if normalized:
+            unique.setdefault(normalized.lower(), normalized)
+    queries = list(unique.values())[:MULTI_QUERY_MAX]
+    if not queries:
+        return "请至少提供一个搜索关键词。"
+
+    telemetry.log_event(
+        "tool.search_rules_many", queries=queries, books=book_filter or "全部"
     )
 
-    filter_dict = {}
-    # 构建 ChromaDB 的 Metadata 过滤器
-    if book_filter:
-        if len(book_filter) == 1:
-            filter_dict = {"source_book": book_filter[0]}
-        else:
-            filter_dict = {"source_book": {"$in": book_filter}}
+    cache_key = SearchResultCache.make_key(
+        " || ".join(sorted(query.lower() for query in queries)),
+        book_filter,
+        MULTI_SEARCH_K,
+    )
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
-    # 执行相似度搜索
-    # k=5 表示返回 5 个最相关的片段
     try:
-        results = vector_store.similarity_search(
-            query, k=5, filter=filter_dict if filter_dict else None
-        )
+        # 所有查询的向量在一次请求中生成，随后各查询并发检索
+        vector_store = get_vector_store()
+        with telemetry.span("retrieve.embed_batch", queries=len(queries)):
+            embeddings = embed_queries(vector_store.embeddings, queries)
+        workers = max(1, min(MULTI_QUERY_WORKERS, len(queries)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # 每个任务带上当前 context，子线程的日志仍归属同一个 trace
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    retrieve,
+                    query,
+                    book_filter,
+                    embedding,
+                )
+                for query, embedding in zip(queries, embeddings)
+            ]
+            per_query = [future.result() for future in futures]
+        # 所有查询、所有检索通道的结果一起做 RRF，同一片段被多个查询命中时排名更靠前
+        result_lists = [results for lists in per_query for results in lists]
+        results = select_results(" ".join(queries), result_lists, k=MULTI_SEARCH_K)
     except Exception as e:
+        telemetry.log_event("tool.search_failed", logging.ERROR, error=str(e))
         return f"检索出错: {str(e)}"
 
     if not results:
-        return "未在指定的规则书中找到相关内容。"
+        output = "未在指定的规则书中找到相关内容。"
+        search_cache.put(cache_key, output)
+        return output
 
-    # 格式化返回结果给 LLM 看
-    formatted_results = []
-    for doc in results:
-        source = f"{doc.metadata.get('source_book', 'Unknown')} > {doc.metadata.get('chapter', 'Unknown')}"
-        # 在内容前加上来源标注，方便 LLM 引用
-        content = f"--- 来源: {source} ---\n{doc.page_content}\n"
-        formatted_results.append(content)
+    output = format_results(results)
+    search_cache.put(cache_key, output)
+    return output
 
-    return "\n".join(formatted_results)
+
+ENTITY_KIND_LABELS = {
+    "spell": "法术",
+    "monster": "怪物",
+    "class": "职业",
+    "class_feature": "职业特性",
+}
+ENTITY_FIELD_LABELS = {
+    "school": "学派",
+    "ritual": "仪式",
+    "casting_time": "施法时间",
+    "range": "施法距离",
+    "components": "法术成分",
+    "duration": "持续时间",
+    "concentration": "专注",
+    "classes": "职业",
+    "size": "体型",
+    "type": "类型",
+    "alignment": "阵营",
+    "ac": "护甲等级",
+    "hp": "生命值",
+    "hit_dice": "生命骰",
+    "speed": "速度",
+    "abilities": "属性",
+    "cr": "挑战等级",
+    "xp": "经验值",
+    "class": "所属职业",
+}
+
+
+def format_entity(entity):
+    """格式化一个结构化条目给 LLM 看，来源标注与 format_results 一致"""
+    data = entity["data"]
+    title = entity["name"]
+    if entity["name_en"] and entity["name_en"] != entity["name"]:
+        title += f" ({entity['name_en']})"
+    lines = [
+        f"--- 来源: {entity['source_book']} > {entity['chapter']} ---",
+        f"【{ENTITY_KIND_LABELS.get(entity['kind'], entity['kind'])}】{title}",
+    ]
+    if entity["kind"] == "spell":
+        lines.append(
+            f"环阶: {'戏法' if data['level'] == 0 else str(data['level']) + '环'}"
+        )
+    elif entity["kind"] == "class_feature":
+        lines.append(f"获得等级: {data['level']}级")
+    for key, label in ENTITY_FIELD_LABELS.items():
+        value = data.get(key)
+        if value is None or value == "":
+            continue
+        if isinstance(value, bool):
+            value = "是" if value else "否"
+        elif isinstance(value, dict):
+            value = " / ".join(f"{name} {score}" for name, score in value.items())
+        lines.append(f"{label}: {value}")
+    # 职业成长表的内容就是原文中的表格
+    text = entity["text"]
+    if len(text) > ENTITY_TEXT_CHARS:
+        text = text[:ENTITY_TEXT_CHARS] + "..."
+    if text:
+        lines.append(text)
+    return "\n".join(lines) + "\n"
+
+
+@tool
+def lookup_entity(name: str, kind: str = None, book_filter: list[str] = None):
+    """
+    按名称查找法术、怪物、职业和职业特性的结构化数据 (中文名或英文名，支持名称前缀)。
+    问法术的环阶/学派/成分/持续时间、怪物的 CR/AC/HP/属性、职业几级获得某特性等精确信息时优先使用，
+    毫秒级返回；查不到时再用 search_rules_many 检索。
+
+    Args:
+        name: 条目名称 (例如: "火球术", "Fireball", "地精", "狂暴").
+        kind: 限定条目类型: "spell" (法术) / "monster" (怪物) / "class" (职业成长表) / "class_feature" (职业特性). 如果为 None，则不限类型.
+        book_filter: 限制搜索的规则书列表 (例如: ["PHB", "XGE"]). 如果为 None，则搜索所有书.
+    """
+    telemetry.log_event(
+        "tool.lookup_entity",
+        name=name,
+        kind=kind or "全部",
+        books=book_filter or "全部",
+    )
+    entity_index = get_entity_index()
+    if entity_index is None:
+        return "结构化条目索引尚未生成，请改用 search_rules 检索。"
+    if kind not in ENTITY_KINDS:
+        # 模型偶尔会传入中文类型名等无效值，按不限类型处理
+        kind = None
+
+    try:
+        with telemetry.span("retrieve.entity", kind=kind or "") as fields:
+            entities = entity_index.lookup(
+                name, kind, book_filter, limit=ENTITY_LOOKUP_LIMIT
+            )
+            fields["results"] = len(entities)
+            if entities:
+                fields["match"] = entities[0]["match"]
+    except Exception as e:
+        telemetry.log_event("tool.lookup_failed", logging.ERROR, error=str(e))
+        return f"查询出错: {str(e)}"
+
+    if not entities:
+        return f"没有找到名为「{name}」的条目，请改用 search_rules_many 检索。"
+    output = "\n".join(format_entity(entity) for entity in entities)
+    if entities[0]["match"] != "exact":
+        output = f"(没有名称完全一致的条目，以下为名称相近的结果)\n\n{output}"
+    return output
@@ -1,10 +1,10 @@
 import sys
 import os
+import time
 import uuid
 from pathlib import Path
 import streamlit as st
 from langchain_core.messages import HumanMessage, AIMessage
-import chromadb
 
 # --- [新增] 0. 网络代理配置 ---
 # os.environ["HTTP_PROXY"] = "http://127.0.0.1:7890"
@@ -21,42 +21,86 @@ except ImportError:
 BASE_DIR = Path(__file__).resolve().parents[1]
 sys.path.append(str(BASE_DIR))
 
-from src.agent.graph import graph
+from src.agent import telemetry
+from src.agent.graph import stream_agent, warm_up
+from src.db.catalog import load_catalog
+from src.db.ingest_version import read_ingest_version
 
+# 目录缺失时分页扫描元数据，每页条数
+CATALOG_SCAN_PAGE_SIZE = 5000
 
-@st.cache_data
-def get_book_tree_nodes():
+
+@st.cache_resource
+def start_warm_up():
     """
-    [核心修改]
-    不再扫描 data/raw (部署环境可能没有)，而是直接从 chroma_db_data 读取元数据。
-    这样能保证前端显示的目录与数据库实际内容完全一致。
+    每个 Streamlit 进程只执行一次：在后台线程中连接向量库、创建 LLM 客户端并编译图，
+    页面渲染不必等待初始化完成。
+    """
+    return warm_up(background=True)
+
+
+start_warm_up()
+
+
+def scan_book_paths():
+    """
+    兜底方案：分页读取 ChromaDB 的元数据，提取所有 source_book。
+    数据库不存在时返回空集合，读取失败时返回 None。
     """
     db_dir = BASE_DIR / "chroma_db_data"
 
     if not db_dir.exists():
         # 如果连数据库都没有，说明完全没初始化
-        return [], set()
+        return set()
 
     valid_books = set()
 
     try:
+        # 延迟导入：chromadb 加载要数秒，书目目录存在时根本用不到
+        import chromadb
+
         # 1. 连接本地 ChromaDB
         client = chromadb.PersistentClient(path=str(db_dir))
         # 获取集合 (名称必须与 ingest.py 中一致，默认为 'dnd_rules')
         collection = client.get_collection("dnd_rules")
 
-        # 2. 获取所有数据的元数据 (只拿 metadata，速度很快)
-        # include=["metadatas"] 避免加载庞大的向量数据
-        result = collection.get(include=["metadatas"])
-
-        # 3. 提取唯一的 source_book 字段
-        for meta in result["metadatas"]:
-            if "source_book" in meta:
-                valid_books.add(meta["source_book"])
+        # 2. 分页获取元数据 (只拿 metadata)，避免一次性加载整个集合
+        offset = 0
+        while True:
+            result = collection.get(
+                include=["metadatas"], limit=CATALOG_SCAN_PAGE_SIZE, offset=offset
+            )
+            # 3. 提取唯一的 source_book 字段
+            for meta in result["metadatas"]:
+                if meta and "source_book" in meta:
+                    valid_books.add(meta["source_book"])
+            if len(result["ids"]) < CATALOG_SCAN_PAGE_SIZE:
+                break
+            offset += CATALOG_SCAN_PAGE_SIZE
 
     except Exception as e:
         st.error(f"读取数据库目录失败: {e}")
-        return [], set()
+        return None
+
+    return valid_books
+
+
+@st.cache_data
+def get_book_tree_nodes(ingest_version=None):
+    """
+    [核心修改]
+    不再扫描 data/raw (部署环境可能没有)，优先读取入库时生成的书目目录 (index_data/catalog.json)，
+    启动时无需遍历向量库。目录缺失或已过期时，才分页扫描 chroma_db_data 的元数据。
+    这样能保证前端显示的目录与数据库实际内容完全一致。
+    ingest_version 仅作为缓存键：重新入库后自动刷新目录。
+    """
+    catalog = load_catalog()
+    if catalog is not None:
+        valid_books = set(catalog["books"])
+    else:
+        valid_books = scan_book_paths()
+        if valid_books is None:
+            return [], set()
 
     # 4. 将扁平的 source_book 列表转换为嵌套字典树
     # (后续逻辑保持不变，因为 source_book 的格式就是 'Category/Book')
@@ -97,7 +141,7 @@ st.title("🐉 D&D 5E 规则智能助手 (Agentic RAG)")
 with st.sidebar:
     st.header("📚 规则书库配置")
 
-    nodes, valid_book_paths = get_book_tree_nodes()
+    nodes, valid_book_paths = get_book_tree_nodes(read_ingest_version())
 
     if not nodes:
         st.warning("未检测到 data/raw 数据，请先运行 ETL 脚本。")
@@ -122,6 +166,11 @@ with st.sidebar:
             st.write(final_selected_books)
             st.write(f"共选中 {len(final_selected_books)} 本书")
 
+    # 关闭后本次提问不读取也不写入语义回答缓存 (需要重新检索时使用)
+    use_answer_cache = st.toggle(
+        "复用相似问题的回答", value=True, help="问法相近的问题直接返回之前的回答"
+    )
+
 # --- 5. 聊天界面逻辑 ---
 
 if "messages" not in st.session_state:
@@ -139,9 +188,12 @@ if prompt := st.chat_input("请问 Dungeon Master... (例如: 法师几级学火
     st.chat_message("user").write(prompt)
     st.session_state.messages.append(HumanMessage(content=prompt))
 
+    # 只发送本轮的新问题：完整对话历史由图的 checkpointer 按 thread_id 保存，
+    # st.session_state.messages 仅用于页面展示
     inputs = {
-        "messages": st.session_state.messages,
+        "messages": [HumanMessage(content=prompt)],
         "selected_books": final_selected_books,
+        "use_answer_cache": use_answer_cache,
     }
 
     config = {"configurable": {"thread_id": st.session_state.thread_id}}
@@ -150,66 +202,64 @@ if prompt := st.chat_input("请问 Dungeon Master... (例如: 法师几级学火
         status_container = st.status("🎲 DM 正在翻阅规则书...", expanded=True)
         response_placeholder = st.empty()
         full_response = ""
+        render_seconds = 0.0  # 逐 token 刷新页面的累计耗时
 
         try:
             # [修改] recursion_limit 设置为 30，给后端 5 次重试留足空间
-            for event in graph.stream(inputs, config={**config, "recursion_limit": 30}):
-                for key, value in event.items():
-                    if key == "agent":
-                        msg = value["messages"][-1]
-                        if msg.tool_calls:
-                            tool_args = msg.tool_calls[0]["args"]
-                            status_container.write(
-                                f"🔍 **检索请求**: `{tool_args.get('query', '')}`"
-                            )
-
-                            books_filter = tool_args.get("book_filter", [])
-                            if books_filter and len(books_filter) > 3:
-                                book_display = (
-                                    f"{books_filter[0]} 等 {len(books_filter)} 本书"
-                                )
-                            else:
-                                book_display = str(books_filter)
-                            status_container.write(f"📚 **范围**: `{book_display}`")
-                        else:
-                            content = msg.content
-                            if isinstance(content, list):
-                                full_response = "".join(
-                                    [
-                                        item.get("text", "")
-                                        for item in content
-                                        if isinstance(item, dict)
-                                        and item.get("type") == "text"
-                                    ]
-                                )
-                            else:
-                                full_response = str(content)
-
-                    elif key == "tools":
-                        msg = value["messages"][-1]
-                        tool_content = msg.content
-                        if isinstance(tool_content, list):
-                            tool_text = "".join(
-                                [
-                                    item.get("text", "")
-                                    for item in tool_content
-                                    if isinstance(item, dict)
-                                    and item.get("type") == "text"
-                                ]
-                            )
-                        else:
-                            tool_text = str(tool_content)
-                        preview = (
-                            tool_text[:200] + "..."
-                            if len(tool_text) > 200
-                            else tool_text
+            # stream_agent 同时订阅 LLM 的 token 流：回复边生成边渲染，不必等整张图跑完
+            for kind, data in stream_agent(
+                inputs, config={**config, "recursion_limit": 30}
+            ):
+                if kind == "token":
+                    full_response += data
+                    render_start = time.perf_counter()
+                    response_placeholder.markdown(full_response + "▌")
+                    render_seconds += time.perf_counter() - render_start
+                elif kind == "tool_call":
+                    # 调用工具前生成的文字只是中间思考，清空后等待最终回复
+                    full_response = ""
+                    response_placeholder.empty()
+                    tool_args = data["args"]
+                    # search_rules 传 query，search_rules_many 传 queries 列表，lookup_entity 传 name
+                    query_display = (
+                        tool_args.get("query")
+                        or tool_args.get("name")
+                        or " / ".join(tool_args.get("queries", []))
+                    )
+                    status_container.write(f"🔍 **检索请求**: `{query_display}`")
+
+                    books_filter = tool_args.get("book_filter", [])
+                    if books_filter and len(books_filter) > 3:
+                        book_display = f"{books_filter[0]} 等 {len(books_filter)} 本书"
+                    else:
+                        book_display = str(books_filter)
+                    status_container.write(f"📚 **范围**: `{book_display}`")
+                elif kind == "tool_result":
+                    preview = data[:200] + "..." if len(data) > 200 else data
+                    status_container.markdown(f"📄 **查阅结果**: \n> {preview}")
+                elif kind == "tool_timing":
+                    saved_time = data["saved_time"]
+                    if saved_time >= 0.05:
+                        status_container.write(
+                            f"⚡ **并行/去重节省**: {saved_time:.2f}s "
+                            f"(本轮去重 {data['deduplicated']} 次)"
                         )
-                        status_container.markdown(f"📄 **查阅结果**: \n> {preview}")
+                elif kind == "cache_hit":
+                    status_container.write(
+                        f"♻️ **命中回答缓存**: 相似问题 `{data['question']}` "
+                        f"(相似度 {data['similarity']:.2f})"
+                    )
+                    for source in data["citations"]:
+                        status_container.write(f"📖 {source}")
+                elif kind == "answer":
+                    # 以节点完成时的完整消息为准 (模型不支持流式时也能正常显示)
+                    full_response = data
 
             status_container.update(
                 label="✅ 回答生成完毕", state="complete", expanded=False
             )
             response_placeholder.markdown(full_response)
+            telemetry.observe("ui_render_seconds", render_seconds)
             st.session_state.messages.append(AIMessage(content=full_response))
 
         except Exception as e:
@@ -0,0 +1,51 @@
+import os
+import json
+import time
+
+from src.db.embeddings import INDEX_DATA_DIR
+from src.db.ingest_version import read_ingest_version
+
+CATALOG_PATH = INDEX_DATA_DIR / "catalog.json"
+
+
+def count_chunk(book_counts, metadata):
+    """把一个数据块计入 {书: {"chunks": n, "chapters": {章节: n}}}"""
+    book = book_counts.setdefault(
+        metadata.get("source_book", "Unknown"), {"chunks": 0, "chapters": {}}
+    )
+    book["chunks"] += 1
+    chapter = metadata.get("chapter", "Unknown")
+    book["chapters"][chapter] = book["chapters"].get(chapter, 0) + 1
+
+
+def write_catalog(book_counts, collection_name, ingest_version, partitions=None):
+    """入库结束时写出书目目录 (书、章节、数据块数、入库版本，以及按书分区的集合名)"""
+    data = {
+        "collection": collection_name,
+        "ingest_version": ingest_version,
+        "generated_at": time.time(),
+        "books": {book: book_counts[book] for book in sorted(book_counts)},
+        "partitions": partitions or {},
+    }
+    CATALOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = CATALOG_PATH.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, CATALOG_PATH)
+
+
+def load_catalog():
+    """
+    读取书目目录。文件缺失、损坏，或与当前入库版本不一致 (目录已过期) 时返回 None，
+    调用方应退回到扫描向量库元数据。
+    """
+    if not CATALOG_PATH.exists():
+        return None
+    try:
+        with open(CATALOG_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get("ingest_version") != read_ingest_version():
+        return None
+    return data
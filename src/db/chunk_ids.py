@@ -0,0 +1,18 @@
+import hashlib
+
+# 参与 ID 计算的元数据字段 (顺序固定，修改会导致全部 ID 变化)
+ID_METADATA_FIELDS = ("source_book", "chapter", "sub_topic")
+
+
+def compute_chunk_id(page_content, metadata):
+    """
+    根据正文和关键元数据计算确定性的 chunk ID。
+    同一段内容在同一位置 (书/章节/小节) 永远得到同一个 ID，
+    因此可以用来和向量库中已有的 ID 做差集，实现增量入库。
+    """
+    hasher = hashlib.sha256()
+    for field in ID_METADATA_FIELDS:
+        hasher.update(str(metadata.get(field, "")).encode("utf-8"))
+        hasher.update(b"\x1f")
+    hasher.update(page_content.encode("utf-8"))
+    return hasher.hexdigest()[:32]
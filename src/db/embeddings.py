@@ -0,0 +1,520 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import inspect
+import threading
+import unicodedata
+from array import array
+from pathlib import Path
+
+from langchain_core.embeddings import Embeddings
+
+from src.db.quantization import transform_vectors
+
+# --- 配置路径 ---
+BASE_DIR = Path(__file__).resolve().parents[2]
+INDEX_DATA_DIR = BASE_DIR / "index_data"  # 与 chroma_db_data 并列的辅助索引目录
+EMBEDDING_CACHE_PATH = INDEX_DATA_DIR / "embedding_cache.sqlite3"
+
+# --- 配置参数 ---
+# [重要] 入库 (src/db/ingest.py) 和检索 (src/agent/tools.py) 必须使用同一个后端和模型，
+# 入库时会把它们记录在集合的 metadata 中，检索时不一致会直接报错
+# gemini: Google Embedding API；local: 本地 CPU 模型 (sentence-transformers)；hash: 特征哈希 (仅测试用)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "gemini")
+DEFAULT_EMBEDDING_MODELS = {
+    "gemini": "models/gemini-embedding-001",
+    "local": "intfloat/multilingual-e5-small",
+    "hash": "hash-256",
+}
+# Gemini 模型不截断时的原生维度，embedding_info 据此补全维度，不必发起请求
+NATIVE_EMBEDDING_DIMS = {
+    "models/gemini-embedding-001": 3072,
+    "models/text-embedding-004": 768,
+}
+EMBEDDING_MODEL = os.getenv(
+    "EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODELS.get(EMBEDDING_BACKEND, "")
+)
+# 本地模型的推理设置：batch 越大吞吐越高，线程数默认使用全部 CPU 核心
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS", "0"))
+# torch 或 onnx (onnx 需要 sentence-transformers>=3.2 和 optimum[onnxruntime])
+LOCAL_EMBEDDING_RUNTIME = os.getenv("LOCAL_EMBEDDING_RUNTIME", "torch")
+# E5 系列模型要求查询和文档分别加上前缀，其他模型设为空字符串
+LOCAL_QUERY_PREFIX = os.getenv("LOCAL_QUERY_PREFIX", "query: ")
+LOCAL_DOCUMENT_PREFIX = os.getenv("LOCAL_DOCUMENT_PREFIX", "passage: ")
+# 入库和查询向量截断到前 N 维 (0 表示不截断)
+# 与后端、模型一起记录在集合 metadata 中，修改后需要重新入库
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "1") != "0"
+HASH_EMBEDDING_DIM = 256
+# 集合 metadata 中记录 Embedding 信息的键
+METADATA_PREFIX = "embedding_"
+
+CJK_RUN_PATTERN = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def normalize_text(text):
+    """缓存键使用的归一化：全角/半角统一、去首尾空白、合并连续空白"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class HashEmbeddings(Embeddings):
+    """
+    确定性的本地 Embedding (特征哈希)，不需要网络和 API Key。
+
+    汉字取单字和二元组、英文取单词作为特征，哈希到 dim 维并带符号累加，最后归一化。
+    语义能力远不如真实模型，只用于离线基准测试和开发调试：相同输入永远得到相同向量。
+    """
+
+    def __init__(self, dim=HASH_EMBEDDING_DIM):
+        self.dim = dim
+
+    @staticmethod
+    def features(text):
+        text = normalize_text(text).lower()
+        features = []
+        for run in CJK_RUN_PATTERN.findall(text):
+            features.extend(run)
+            features.extend(run[i : i + 2] for i in range(len(run) - 1))
+        features.extend(WORD_PATTERN.findall(CJK_RUN_PATTERN.sub(" ", text)))
+        return features
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        for feature in self.features(text):
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            # 二元组比单字更有区分度，权重更高
+            weight = 1.0 if len(feature) == 1 else 2.0
+            vector[value % self.dim] += weight if value >> 63 else -weight
+        norm = sum(x * x for x in vector) ** 0.5 or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    本地 CPU Embedding 模型 (sentence-transformers，可选 ONNX Runtime)，查询不再经过网络。
+
+    批量推理，推理本身由 torch / ONNX Runtime 的线程池并行；
+    入库线程池和 Streamlit 会跨线程调用，同一时刻只有一个批次在推理，避免线程数超卖。
+    """
+
+    def __init__(
+        self,
+        model_name,
+        batch_size=LOCAL_EMBEDDING_BATCH_SIZE,
+        threads=LOCAL_EMBEDDING_THREADS,
+        runtime=LOCAL_EMBEDDING_RUNTIME,
+        query_prefix=LOCAL_QUERY_PREFIX,
+        document_prefix=LOCAL_DOCUMENT_PREFIX,
+    ):
+        # 延迟导入：sentence-transformers (及 torch) 是可选依赖
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError(
+                "EMBEDDING_BACKEND=local 需要先安装 sentence-transformers: "
+                "pip install sentence-transformers"
+            ) from e
+
+        if threads > 0:
+            import torch
+
+            torch.set_num_threads(threads)
+        kwargs = {"backend": runtime} if runtime != "torch" else {}
+        self.model = SentenceTransformer(model_name, device="cpu", **kwargs)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.query_prefix = query_prefix
+        self.document_prefix = document_prefix
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self._lock = threading.Lock()
+
+    def _encode(self, texts):
+        with self._lock:
+            vectors = self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                normalize_embeddings=True,
+                convert_to_numpy=True,
+                show_progress_bar=False,
+            )
+        return vectors.tolist()
+
+    def embed_documents(self, texts):
+        return self._encode([self.document_prefix + text for text in texts])
+
+    def embed_query(self, text):
+        return self._encode([self.query_prefix + text])[0]
+
+    def embed_queries(self, texts):
+        """多个查询合并成一个批次推理"""
+        return self._encode([self.query_prefix + text for text in texts])
+
+
+def embed_query_batch(model, texts):
+    """
+    用一次请求生成多个查询向量。
+    Gemini 的 embed_documents 支持 task_type，指定 RETRIEVAL_QUERY 即可得到与 embed_query 相同的查询向量；
+    本地模型直接批量推理，不支持的模型退化为逐条调用 embed_query。
+    """
+    if not texts:
+        return []
+    if hasattr(model, "embed_queries"):
+        return model.embed_queries(list(texts))
+    if "task_type" in inspect.signature(model.embed_documents).parameters:
+        return model.embed_documents(list(texts), task_type="RETRIEVAL_QUERY")
+    return [model.embed_query(text) for text in texts]
+
+
+def embed_queries(embeddings, texts):
+    """批量生成查询向量，CachedEmbeddings 会先查缓存，只对未命中的查询发请求"""
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(texts)
+    return embed_query_batch(embeddings, texts)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    带本地 SQLite 持久化缓存的 Embedding 包装器。
+
+    缓存键 = 模型名 + 用途 (document/query) + 归一化后的文本，
+    命中时不再请求 Embedding API。条目数超过上限时按最近使用时间淘汰 (LRU)。
+    入库脚本和检索工具共用同一个缓存文件。
+    """
+
+    def __init__(
+        self,
+        underlying,
+        model_name,
+        db_path=EMBEDDING_CACHE_PATH,
+        max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+    ):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        db_path = Path(db_path)
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Streamlit 和入库线程池都会跨线程调用，由 self._lock 串行化访问
+        self._conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)"
+        )
+        self._conn.commit()
+
+    def _key(self, text, kind):
+        raw = f"{self.model_name}\x1f{kind}\x1f{normalize_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _count(self, hits, misses):
+        """累加命中统计：入库时由 EmbeddingPipeline 的多个工作线程同时调用"""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def _lookup(self, keys):
+        """批量查询缓存，返回 {key: vector}，并刷新命中条目的使用时间"""
+        found = {}
+        if not keys:
+            return found
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique_keys), 500):
+                part = unique_keys[i : i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    part,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+        return found
+
+    def _store(self, items):
+        """写入新向量，并在超出容量时淘汰最久未使用的条目"""
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items],
+            )
+            # 缓存文件由多个进程共享 (入库脚本、Streamlit)，内存计数会漂移；
+            # 在同一个写事务中重新统计，其他进程此时无法写入
+            size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            overflow = size - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    """
+                    DELETE FROM embeddings WHERE key IN (
+                        SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?
+                    )
+                    """,
+                    (overflow,),
+                )
+            self._conn.commit()
+
+    def embed_documents(self, texts):
+        keys = [self._key(text, "document") for text in texts]
+        cached = self._lookup(keys)
+
+        # 同一批次中重复的文本只请求一次
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        self._count(len(texts) - len(missing), len(missing))
+
+        if missing:
+            vectors = self.underlying.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._store(new_items)
+            cached.update(new_items)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(text, "query")
+        cached = self._lookup([key])
+        if key in cached:
+            self._count(1, 0)
+            return cached[key]
+
+        self._count(0, 1)
+        vector = self.underlying.embed_query(text)
+        self._store([(key, vector)])
+        return vector
+
+    def embed_queries(self, texts):
+        """批量版 embed_query：未命中缓存的查询合并成一次请求"""
+        keys = [self._key(text, "query") for text in texts]
+        cached = self._lookup(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        self._count(len(texts) - len(missing), len(missing))
+
+        if missing:
+            vectors = embed_query_batch(self.underlying, list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._store(new_items)
+            cached.update(new_items)
+
+        return [cached[key] for key in keys]
+
+    def stats(self):
+        """返回缓存命中统计，便于评估缓存容量"""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            (entries,) = self._conn.execute(
+                "SELECT COUNT(*) FROM embeddings"
+            ).fetchone()
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+        }
+
+
+class TruncatedEmbeddings(Embeddings):
+    """
+    在 Embedding 模型外面加一层维度截断 (Matryoshka)，见 quantization.transform_vectors。
+    放在缓存外层：缓存中保存的始终是完整维度的向量，调整维度不必重新请求 API。
+    """
+
+    def __init__(self, underlying, dimensions):
+        self.underlying = underlying
+        self.dimensions = dimensions
+
+    @property
+    def dim(self):
+        if self.dimensions:
+            return self.dimensions
+        inner = getattr(self.underlying, "underlying", self.underlying)
+        return getattr(inner, "dim", None)
+
+    def _transform(self, vectors):
+        if not vectors:
+            return []
+        return transform_vectors(vectors, self.dimensions).tolist()
+
+    def embed_documents(self, texts):
+        return self._transform(self.underlying.embed_documents(texts))
+
+    def embed_query(self, text):
+        return self._transform([self.underlying.embed_query(text)])[0]
+
+    def embed_queries(self, texts):
+        return self._transform(embed_queries(self.underlying, texts))
+
+    def stats(self):
+        """缓存统计 (内层没有缓存时为空)"""
+        if hasattr(self.underlying, "stats"):
+            return self.underlying.stats()
+        return {}
+
+
+def create_embeddings(backend=EMBEDDING_BACKEND, model=None):
+    """按后端名称创建 Embedding 模型 (不带缓存)"""
+    model = model or DEFAULT_EMBEDDING_MODELS.get(backend)
+    if backend == "gemini":
+        # 延迟导入：只使用缓存工具时不必加载 Google SDK
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+        return GoogleGenerativeAIEmbeddings(model=model)
+    if backend == "local":
+        return LocalEmbeddings(model)
+    if backend == "hash":
+        return HashEmbeddings(int(model.rsplit("-", 1)[-1]))
+    raise ValueError(
+        f"未知的 EMBEDDING_BACKEND: {backend} (可选 gemini / local / hash)"
+    )
+
+
+def cache_model_name(backend, model):
+    """缓存键中的模型名：Gemini 保持旧格式，已有的缓存仍然有效"""
+    return model if backend == "gemini" else f"{backend}:{model}"
+
+
+def get_embeddings(
+    backend=EMBEDDING_BACKEND,
+    model=EMBEDDING_MODEL,
+    dimensions=EMBEDDING_DIMENSIONS,
+):
+    """构建入库和检索共用的 Embedding 模型 (默认带本地缓存，按配置截断维度)"""
+    embeddings = create_embeddings(backend, model)
+    if EMBEDDING_CACHE_ENABLED and backend != "hash":
+        embeddings = CachedEmbeddings(embeddings, cache_model_name(backend, model))
+    if dimensions:
+        embeddings = TruncatedEmbeddings(embeddings, dimensions)
+    return embeddings
+
+
+def embedding_info(embeddings, backend=EMBEDDING_BACKEND, model=EMBEDDING_MODEL):
+    """
+    当前 Embedding 的后端、模型和维度。
+    本地模型和哈希的维度无需计算即可得到；Gemini 未截断时取 NATIVE_EMBEDDING_DIMS 中的原生维度，
+    未知模型用一次探测请求得到 (经过缓存，只请求一次)。维度始终参与一致性检查。
+    """
+    dim = getattr(embeddings, "dim", None)
+    if dim is None:
+        dim = getattr(getattr(embeddings, "underlying", None), "dim", None)
+    if dim is None:
+        dim = NATIVE_EMBEDDING_DIMS.get(model)
+    if dim is None:
+        try:
+            dim = len(embeddings.embed_query("dimension probe"))
+        except Exception as e:
+            # 探测失败时跳过维度检查，查询本身也会以同样的原因失败
+            print(f"无法确定 Embedding 维度: {e}")
+    return {
+        "backend": backend,
+        "model": model,
+        "dim": dim,
+    }
+
+
+def read_collection_embedding(collection):
+    """读取集合 metadata 中记录的 Embedding 信息，旧版本入库的集合没有记录时返回 None"""
+    metadata = collection.metadata or {}
+    if f"{METADATA_PREFIX}backend" not in metadata:
+        return None
+    return {
+        "backend": metadata[f"{METADATA_PREFIX}backend"],
+        "model": metadata.get(f"{METADATA_PREFIX}model"),
+        "dim": metadata.get(f"{METADATA_PREFIX}dim"),
+    }
+
+
+def record_collection_embedding(collection, info, dim=None):
+    """把 Embedding 信息写入集合 metadata (入库完成后调用)"""
+    metadata = {
+        key: value
+        for key, value in (collection.metadata or {}).items()
+        # hnsw 参数在创建集合后不允许再修改
+        if not key.startswith("hnsw:")
+    }
+    metadata.update(
+        {
+            f"{METADATA_PREFIX}backend": info["backend"],
+            f"{METADATA_PREFIX}model": info["model"],
+        }
+    )
+    dim = dim or info.get("dim")
+    if dim:
+        metadata[f"{METADATA_PREFIX}dim"] = int(dim)
+    collection.modify(metadata=metadata)
+
+
+def describe_embedding(info):
+    text = f"{info['backend']} / {info['model']}"
+    if info.get("dim"):
+        text += f" / {info['dim']} 维"
+    return text
+
+
+def check_collection_embedding(collection, info):
+    """
+    检查集合入库时使用的 Embedding 与当前配置是否一致，不一致时抛出 ValueError。
+    用不同模型生成的查询向量和文档向量不在同一个空间，检索结果没有意义。
+    没有记录的旧集合视为用默认的 Gemini 模型入库，空集合不做检查。
+    """
+    recorded = read_collection_embedding(collection)
+    if recorded is None:
+        if collection.count() == 0:
+            return
+        recorded = {
+            "backend": "gemini",
+            "model": DEFAULT_EMBEDDING_MODELS["gemini"],
+            "dim": NATIVE_EMBEDDING_DIMS[DEFAULT_EMBEDDING_MODELS["gemini"]],
+        }
+    mismatched = [
+        field
+        for field in ("backend", "model", "dim")
+        if recorded.get(field) and info.get(field) and recorded[field] != info[field]
+    ]
+    if mismatched:
+        raise ValueError(
+            f"向量库使用的 Embedding ({describe_embedding(recorded)}) 与当前配置 "
+            f"({describe_embedding(info)}) 不一致，请修改 EMBEDDING_BACKEND、EMBEDDING_MODEL、"
+            "EMBEDDING_DIMENSIONS 等配置，"
+            "或运行 python src/db/ingest.py --full 重新入库。"
+        )
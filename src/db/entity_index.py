@@ -0,0 +1,275 @@
+import re
+import sys
+import json
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from src.db.embeddings import INDEX_DATA_DIR
+from src.db.keyword_index import tokenize
+
+# --- 配置路径 ---
+BASE_DIR = Path(__file__).resolve().parents[2]
+ENTITIES_DATA_PATH = BASE_DIR / "data" / "processed" / "dnd_entities.jsonl"
+ENTITY_INDEX_PATH = INDEX_DATA_DIR / "entities.sqlite3"
+
+# 修改表结构或名称归一化规则后递增，旧索引需要重建
+SCHEMA_VERSION = "entities-v1"
+ENTITY_KINDS = ("spell", "monster", "class", "class_feature")
+
+# 名称比较时忽略的字符：空白、标点、间隔号等
+NAME_NOISE_PATTERN = re.compile(r"[\s'’‘\"“”·・\-_,，.。:：/()（）\[\]【】]+")
+
+
+def name_key(name):
+    """名称的归一化形式：全角转半角、小写、去掉空白和标点 ("Melf's Acid Arrow" -> "melfsacidarrow")"""
+    return NAME_NOISE_PATTERN.sub("", unicodedata.normalize("NFKC", name or "").lower())
+
+
+def file_digest(file_path):
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class EntityIndex:
+    """
+    法术、怪物、职业和职业特性的结构化条目索引 (SQLite)。
+
+    - 中文名和英文名的归一化形式各有一个 B 树索引，精确查找和前缀查找都只是一次索引扫描
+    - 名称另外按 keyword_index 的规则分词存入 FTS5，精确和前缀都未命中时做模糊匹配
+    - 条目由 ETL 生成的 dnd_entities.jsonl 整体重建 (条目数量级为数千，一次事务即可完成)
+    """
+
+    def __init__(self, path=ENTITY_INDEX_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'schema'"
+        ).fetchone()
+        if row is not None and row[0] != SCHEMA_VERSION:
+            # 结构变化，丢弃旧表，等待下一次 sync 重建
+            self._conn.execute("DROP TABLE IF EXISTS entities")
+            self._conn.execute("DROP TABLE IF EXISTS entity_names")
+            self._conn.execute("DELETE FROM meta")
+        self._conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('schema', ?)",
+            (SCHEMA_VERSION,),
+        )
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entities (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                name_en TEXT NOT NULL,
+                name_key TEXT NOT NULL,
+                name_en_key TEXT NOT NULL,
+                source_book TEXT NOT NULL,
+                chapter TEXT NOT NULL,
+                data TEXT NOT NULL,
+                text TEXT NOT NULL
+            )
+            """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_entities_name ON entities(name_key)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_entities_name_en ON entities(name_en_key)"
+        )
+        self._conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS entity_names USING fts5(
+                tokens,
+                entity_id UNINDEXED,
+                tokenize = 'unicode61'
+            )
+            """)
+        self._conn.commit()
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+
+    def rebuild(self, records):
+        """用 records (ETL 输出的条目字典) 整体替换索引内容，返回条目数"""
+        rows = []
+        for entity_id, record in enumerate(records, start=1):
+            name = record.get("name") or ""
+            name_en = record.get("name_en") or ""
+            rows.append(
+                (
+                    entity_id,
+                    record.get("kind", ""),
+                    name,
+                    name_en,
+                    name_key(name),
+                    name_key(name_en),
+                    record.get("source_book", "Unknown"),
+                    record.get("chapter", "Unknown"),
+                    json.dumps(record.get("data", {}), ensure_ascii=False),
+                    record.get("text", ""),
+                )
+            )
+        with self._lock:
+            with self._conn:
+                self._conn.execute("DELETE FROM entities")
+                self._conn.execute("DELETE FROM entity_names")
+                self._conn.executemany(
+                    "INSERT INTO entities VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+                )
+                self._conn.executemany(
+                    "INSERT INTO entity_names (tokens, entity_id) VALUES (?, ?)",
+                    [
+                        (" ".join(tokenize(f"{row[2]} {row[3]}")), row[0])
+                        for row in rows
+                    ],
+                )
+        return len(rows)
+
+    def sync(self, file_path=ENTITIES_DATA_PATH):
+        """
+        与 ETL 输出的条目文件同步：文件内容 (哈希) 变化时整体重建。
+        返回重建后的条目数，文件未变化或不存在时返回 None。
+        """
+        file_path = Path(file_path)
+        if not file_path.exists():
+            return None
+        digest = file_digest(file_path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM meta WHERE key = 'source_digest'"
+            ).fetchone()
+        if row is not None and row[0] == digest:
+            return None
+
+        with open(file_path, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        count = self.rebuild(records)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('source_digest', ?)",
+                (digest,),
+            )
+            self._conn.commit()
+        return count
+
+    def _select(
+        self,
+        where,
+        params,
+        kind,
+        book_filter,
+        order,
+        limit,
+        order_params=(),
+        source="entities",
+    ):
+        """在 SQL 中同时应用类型和书目过滤，再排序取前 limit 个 (过滤不会挤掉候选)"""
+        sql = (
+            "SELECT id, kind, name, name_en, source_book, chapter, data, text "
+            f"FROM {source} WHERE ({where})"
+        )
+        params = list(params)
+        if kind:
+            sql += " AND kind = ?"
+            params.append(kind)
+        if book_filter:
+            sql += f" AND source_book IN ({','.join('?' * len(book_filter))})"
+            params.extend(book_filter)
+        sql += f" ORDER BY {order} LIMIT ?"
+        params.extend(order_params)
+        params.append(limit)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def lookup(self, name, kind=None, book_filter=None, limit=5):
+        """
+        按中文名或英文名查找条目，依次尝试：
+        1. 精确匹配 (归一化后相等)
+        2. 前缀匹配 (按名称长度排序，越短越接近)
+        3. 名称的 FTS5 模糊匹配 (按 bm25 排序)
+        返回条目字典列表，"match" 字段标明命中方式。
+        """
+        key = name_key(name)
+        if not key:
+            return []
+        rows = self._select(
+            "name_key = ? OR name_en_key = ?",
+            (key, key),
+            kind,
+            book_filter,
+            "kind, id",
+            limit,
+        )
+        match = "exact"
+        if not rows:
+            # 用范围查询代替 LIKE，才能利用索引 (LIKE 默认不区分大小写，不走普通索引)
+            upper = key + "\U0010ffff"
+            # 按命中的 (中文或英文) 名称长度排序，越短与输入越接近；未命中的一侧不参与比较
+            rows = self._select(
+                "(name_key >= ? AND name_key < ?) OR (name_en_key >= ? AND name_en_key < ?)",
+                (key, upper, key, upper),
+                kind,
+                book_filter,
+                "min("
+                "CASE WHEN name_key >= ? AND name_key < ? THEN length(name_key) "
+                "ELSE 1000000 END, "
+                "CASE WHEN name_en_key >= ? AND name_en_key < ? THEN length(name_en_key) "
+                "ELSE 1000000 END), id",
+                limit,
+                order_params=(key, upper, key, upper),
+            )
+            match = "prefix"
+        if not rows:
+            rows = self._fuzzy(name, kind, book_filter, limit)
+            match = "fuzzy"
+        return [
+            {
+                "id": row[0],
+                "kind": row[1],
+                "name": row[2],
+                "name_en": row[3],
+                "source_book": row[4],
+                "chapter": row[5],
+                "data": json.loads(row[6]),
+                "text": row[7],
+                "match": match,
+            }
+            for row in rows
+        ]
+
+    def _fuzzy(self, name, kind, book_filter, limit):
+        tokens = list(dict.fromkeys(tokenize(name)))
+        if not tokens:
+            return []
+        match = " OR ".join('"' + token.replace('"', '""') + '"' for token in tokens)
+        # 与 entities 连接后在同一条查询中过滤，LIMIT 作用于过滤后的结果
+        return self._select(
+            "entity_names MATCH ?",
+            (match,),
+            kind,
+            book_filter,
+            "bm25(entity_names), id",
+            limit,
+            source="entity_names JOIN entities ON entities.id = entity_names.entity_id",
+        )
+
+
+if __name__ == "__main__":
+    index = EntityIndex()
+    count = index.sync()
+    if count is None:
+        print(f"结构化条目索引已是最新: {index.count()} 条 ({ENTITY_INDEX_PATH})")
+    else:
+        print(f"结构化条目索引已重建: {count} 条 ({ENTITY_INDEX_PATH})")
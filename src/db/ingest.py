@@ -1,16 +1,33 @@
 import os
+import sys
 import json
-import time
+import argparse
 from pathlib import Path
 from dotenv import load_dotenv
 from tqdm import tqdm
 
 # LangChain 依赖
-# [Change] 切换为 Google Gemini 的 Embeddings
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from src.db.catalog import count_chunk, load_catalog, write_catalog
+from src.db.chunk_ids import compute_chunk_id
+from src.db.embeddings import (
+    EMBEDDING_BACKEND,
+    EMBEDDING_MODEL,
+    check_collection_embedding,
+    embedding_info,
+    get_embeddings,
+    record_collection_embedding,
+)
+from src.db.ingest_version import bump_ingest_version, read_ingest_version
+from src.db.entity_index import EntityIndex
+from src.db.keyword_index import KeywordIndex
+from src.db.partitions import PARTITION_BY_BOOK, drop_partitions, sync_partitions
+from src.db.pipeline import EmbeddingPipeline
+
 # 加载环境变量 (确保 .env 里有 GOOGLE_API_KEY)
 load_dotenv()
 
@@ -18,55 +35,239 @@ load_dotenv()
 BASE_DIR = Path(__file__).resolve().parents[2]
 PROCESSED_DATA_PATH = BASE_DIR / "data" / "processed" / "dnd_knowledge_base.jsonl"
 CHROMA_DB_DIR = BASE_DIR / "chroma_db_data"  # 向量库本地存储路径
+DEAD_LETTER_PATH = BASE_DIR / "data" / "processed" / "ingest_dead_letter.jsonl"
+CHECKPOINT_PATH = BASE_DIR / "data" / "processed" / "ingest_checkpoint.json"
 
 # --- 配置参数 ---
-BATCH_SIZE = 20  # 每次批量写入 100 条，防止内存溢出
+BATCH_SIZE = 50  # 每个 Embedding 请求包含的片段数
 COLLECTION_NAME = "dnd_rules"
+# 并发与限流参数，按 Embedding 服务商的配额调整
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+EMBEDDING_QPM = int(os.getenv("EMBEDDING_QPM", "300"))  # 每分钟请求数上限
+EMBEDDING_TPM = int(os.getenv("EMBEDDING_TPM", "1000000"))  # 每分钟 token 数上限
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+ID_PAGE_SIZE = 5000  # 分页读取已有 ID 的每页条数
+DELETE_BATCH_SIZE = 500  # 分批删除过期 ID，避免单次请求过大
 
 
-def load_processed_data(file_path):
-    """从 JSONL 读取数据并转换为 LangChain Document 对象"""
-    documents = []
-    if not file_path.exists():
-        print(f"错误：找不到文件 {file_path}")
-        return []
-
-    print(f"正在读取数据: {file_path}...")
-    with open(file_path, "r", encoding="utf-8") as f:
-        for line in f:
+def iter_processed_records(file_path, start_offset=0, start_line=0):
+    """
+    逐行流式读取 JSONL，不把整个语料加载进内存。
+    yield (Document, chunk_id, 该行结束处的字节偏移, 行号)。
+    以二进制方式读取，保证字节偏移可以直接用于断点续传时 seek。
+    """
+    line_no = start_line
+    with open(file_path, "rb") as f:
+        f.seek(start_offset)
+        for raw_line in f:
+            line_no += 1
+            end_offset = f.tell()
+            line = raw_line.decode("utf-8")
             if not line.strip():
                 continue
             data = json.loads(line)
 
-            # 创建 Document 对象
             # page_content 是用于检索的文本
             # metadata 是用于过滤的标签 (书名, 章节等)
             doc = Document(page_content=data["page_content"], metadata=data["metadata"])
-            documents.append(doc)
+            yield doc, compute_chunk_id(
+                doc.page_content, doc.metadata
+            ), end_offset, line_no
+
+
+def scan_chunk_ids(file_path, book_counts=None):
+    """
+    第一遍扫描：只计算每个片段的 ID (不保留正文)，用于和向量库做差集。
+    传入 book_counts 时顺便按书/章节统计 (去重后的) 片段数，用于生成书目目录。
+    返回 (去重后的 ID 集合, 总片段数)。
+    """
+    ids = set()
+    total = 0
+    for doc, chunk_id, _, _ in iter_processed_records(file_path):
+        if book_counts is not None and chunk_id not in ids:
+            count_chunk(book_counts, doc.metadata)
+        ids.add(chunk_id)
+        total += 1
+    return ids, total
+
+
+def iter_pending_batches(file_path, pending_ids, batch_size, checkpoint):
+    """
+    第二遍扫描：只挑出需要入库的片段，凑满 batch_size 就 yield 一批。
+    同一 ID 只会出现一次 (重复片段只保留第一条)。
+    每一批的结束位置登记到 checkpoint，写入成功后才会推进断点。
+    """
+    start_offset, start_line = checkpoint.offset, checkpoint.line
+    docs, ids = [], []
+    end_offset, line_no = start_offset, start_line
+
+    for doc, chunk_id, end_offset, line_no in iter_processed_records(
+        file_path, start_offset, start_line
+    ):
+        if chunk_id not in pending_ids:
+            continue
+        pending_ids.discard(chunk_id)
+        docs.append(doc)
+        ids.append(chunk_id)
+        if len(docs) >= batch_size:
+            checkpoint.register(end_offset, line_no)
+            yield docs, ids
+            docs, ids = [], []
+
+    if docs:
+        checkpoint.register(end_offset, line_no)
+        yield docs, ids
+
+
+class IngestCheckpoint:
+    """
+    断点续传记录：保存最后一个"连续写入完成"的批次在 JSONL 中的字节偏移和行号。
+    并发写入时批次完成顺序不固定，只有当前面的批次全部完成后断点才会前移。
+    源文件的大小或修改时间变化后，旧断点自动失效。
+    """
+
+    def __init__(self, path, source_path):
+        self.path = path
+        self.source_path = source_path
+        self.offset = 0
+        self.line = 0
+        self._registered = []  # 按提交顺序排列的 (offset, line)
+        self._done = set()
+        self._next_seq = 0
+
+    def _source_signature(self):
+        stat = self.source_path.stat()
+        return {"source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+    def load(self):
+        """读取断点，源文件已变化时返回 False 并从头开始"""
+        if not self.path.exists():
+            return False
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if any(
+            data.get(key) != value for key, value in self._source_signature().items()
+        ):
+            return False
+        self.offset = data["offset"]
+        self.line = data["line"]
+        return True
+
+    def register(self, offset, line):
+        self._registered.append((offset, line))
+
+    def mark_done(self, seq):
+        self._done.add(seq)
+        advanced = False
+        while self._next_seq in self._done:
+            self._done.discard(self._next_seq)
+            self.offset, self.line = self._registered[self._next_seq]
+            self._next_seq += 1
+            advanced = True
+        if advanced:
+            self._save()
+
+    def _save(self):
+        data = {"offset": self.offset, "line": self.line, **self._source_signature()}
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+def fetch_existing_ids(vector_store):
+    """分页读取集合中已有的全部 ID (不加载向量和正文)"""
+    existing = set()
+    offset = 0
+    while True:
+        result = vector_store.get(include=[], limit=ID_PAGE_SIZE, offset=offset)
+        page_ids = result.get("ids", [])
+        existing.update(page_ids)
+        if len(page_ids) < ID_PAGE_SIZE:
+            break
+        offset += ID_PAGE_SIZE
+    return existing
+
+
+def delete_stale_ids(vector_store, stale_ids):
+    """分批删除数据源中已不存在的片段"""
+    stale_ids = sorted(stale_ids)
+    for i in range(0, len(stale_ids), DELETE_BATCH_SIZE):
+        vector_store.delete(ids=stale_ids[i : i + DELETE_BATCH_SIZE])
+
+
+def write_batch_to_store(vector_store, docs, ids, vectors):
+    """把已算好的向量直接写入 Chroma (不再触发 Embedding 调用)"""
+    vector_store._collection.upsert(
+        ids=ids,
+        embeddings=vectors,
+        documents=[doc.page_content for doc in docs],
+        metadatas=[doc.metadata for doc in docs],
+    )
+
 
-    print(f"成功加载 {len(documents)} 条文档片段。")
-    return documents
+def update_partitions(vector_store, books, enabled=PARTITION_BY_BOOK):
+    """
+    开启 PARTITION_BY_BOOK 时同步按书分区的集合，返回 {书: 分区集合名}；
+    未开启时删除遗留的分区 (它们不再随全局集合更新)。
+    """
+    client = vector_store._client
+    if not enabled:
+        if drop_partitions(client, COLLECTION_NAME):
+            print("已删除按书分区的集合 (PARTITION_BY_BOOK 未开启)。")
+        return {}
+    print(f"正在同步按书分区的集合 ({len(books)} 本书)...")
+    return sync_partitions(client, COLLECTION_NAME, books)
 
 
-def ingest_data():
-    """主入库流程"""
+def ingest_data(
+    full_rebuild=False,
+    concurrency=INGEST_CONCURRENCY,
+    qpm=EMBEDDING_QPM,
+    tpm=EMBEDDING_TPM,
+):
+    """
+    主入库流程
 
-    # 1. 准备数据
-    docs = load_processed_data(PROCESSED_DATA_PATH)
-    if not docs:
+    数据以流式方式读取：第一遍只计算 ID，第二遍边读边入库，
+    并把已连续写入完成的位置记录到断点文件，中断后重新运行会从断点继续。
+
+    默认为增量模式：根据内容哈希得到每个片段的 ID，与集合中已有的 ID 做差集，
+    只对新增片段调用 Embedding API，并删除数据源中已不存在的片段。
+    full_rebuild=True 时清空集合后全部重新入库。
+    Embedding 请求由 EmbeddingPipeline 并发执行并按 qpm/tpm 限流。
+    """
+
+    # 1. 第一遍扫描：只计算 ID，内存占用与正文大小无关
+    if not PROCESSED_DATA_PATH.exists():
+        print(f"错误：找不到文件 {PROCESSED_DATA_PATH}")
         print("未找到数据，请先运行数据清洗脚本。")
         return
 
-    # 2. 初始化 Embedding 模型
-    # [Change] 使用 Google Gemini 的 embedding 模型
+    print(f"正在扫描数据: {PROCESSED_DATA_PATH}...")
+    book_counts = {}
+    current_ids, total_records = scan_chunk_ids(PROCESSED_DATA_PATH, book_counts)
+    if not current_ids:
+        print("未找到数据，请先运行数据清洗脚本。")
+        return
+    print(f"共 {total_records} 条文档片段 (去重后 {len(current_ids)} 条)。")
+
+    # 2. 初始化 Embedding 模型 (后端由 EMBEDDING_BACKEND 选择，默认 Gemini API)
     # models/gemini-embedding-001 是目前 Google 最新的嵌入模型，支持多语言
-    print("正在初始化 Gemini Embedding 模型 (models/gemini-embedding-001)...")
+    # get_embeddings() 外面包了一层本地缓存，内容未变的片段不会重复计算
+    print(f"正在初始化 Embedding 模型 ({EMBEDDING_BACKEND} / {EMBEDDING_MODEL})...")
     try:
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/gemini-embedding-001")
+        embeddings = get_embeddings()
     except Exception as e:
         print(f"初始化模型失败: {e}")
-        print("请检查 GOOGLE_API_KEY 是否正确配置，并确保已开通 Gemini API 权限。")
+        if EMBEDDING_BACKEND == "gemini":
+            print("请检查 GOOGLE_API_KEY 是否正确配置，并确保已开通 Gemini API 权限。")
         return
+    info = embedding_info(embeddings)
 
     # 3. 初始化/连接 Chroma 向量库
     # persist_directory 指定数据存在本地哪里
@@ -77,33 +278,137 @@ def ingest_data():
         persist_directory=str(CHROMA_DB_DIR),
     )
 
-    # 4. 批量写入
-    print(f"开始向量化并写入数据库 (Collection: {COLLECTION_NAME})...")
-    total_docs = len(docs)
+    checkpoint = IngestCheckpoint(CHECKPOINT_PATH, PROCESSED_DATA_PATH)
+    if full_rebuild:
+        print("全量模式：清空现有集合...")
+        vector_store.reset_collection()
+        checkpoint.clear()
+    else:
+        # 已有数据用其他 Embedding 模型生成时，增量写入会混入不同空间的向量
+        try:
+            check_collection_embedding(vector_store._collection, info)
+        except ValueError as e:
+            print(f"错误：{e}")
+            return
+        if checkpoint.load():
+            print(f"检测到上次中断的断点，从第 {checkpoint.line} 行继续...")
 
-    # 我们可以把 batch size 稍微调大一点，Gemini 的速率限制通常比较宽容
-    batch_size = 50
+    # 4. 计算增量
+    # 旧版本入库时没有传 ID (随机 UUID)，第一次增量同步会把它们全部视为过期并替换
+    existing_ids = fetch_existing_ids(vector_store)
+    stale_ids = existing_ids - current_ids
+    pending_ids = current_ids - existing_ids
 
-    for i in tqdm(range(0, total_docs, batch_size)):
-        batch = docs[i : i + batch_size]
+    print(
+        f"增量同步: 新增 {len(pending_ids)} 条 | 删除 {len(stale_ids)} 条 | "
+        f"未变化 {len(current_ids) - len(pending_ids)} 条"
+    )
 
-        try:
-            # add_documents 会自动调用 Embedding API 并存储
-            vector_store.add_documents(batch)
-            # Gemini 的 QPM (每分钟查询数) 限制，稍微 sleep 一下比较稳妥
-            time.sleep(1)
-        except Exception as e:
-            print(f"写入批次 {i} 时出错: {e}")
-            # 简单的重试逻辑或跳过
-            continue
+    if stale_ids:
+        delete_stale_ids(vector_store, stale_ids)
+
+    # 关键词 (BM25) 索引是纯本地计算，每次都与 JSONL 完整同步
+    added, removed = KeywordIndex().sync(PROCESSED_DATA_PATH)
+    print(f"关键词索引已同步: 新增 {added} 条 | 删除 {removed} 条")
+    # 结构化条目 (法术、怪物、职业特性) 同样是纯本地数据，条目文件变化时整体重建
+    entities = EntityIndex().sync()
+    if entities is not None:
+        print(f"结构化条目索引已重建: {entities} 条")
+
+    if not pending_ids:
+        checkpoint.clear()
+        partitions = update_partitions(vector_store, book_counts)
+        previous = (load_catalog() or {}).get("partitions", {})
+        version = read_ingest_version()
+        if (
+            stale_ids
+            or added
+            or removed
+            or entities is not None
+            or version is None
+            or partitions != previous
+        ):
+            version = bump_ingest_version({"deleted": len(stale_ids)})
+        # 书目目录与入库版本绑定，版本不一致时前端会退回扫描元数据
+        write_catalog(book_counts, COLLECTION_NAME, version, partitions)
+        # 旧版本入库的集合补上 Embedding 记录 (上面的检查已确认与当前配置一致)
+        record_collection_embedding(vector_store._collection, info)
+        print("\n✅ 向量库已是最新，无需写入。")
+        return
 
-    print(f"\n✅ 入库完成！共 {total_docs} 条数据已存入 ChromaDB。")
+    # 5. 并发向量化并写入
+    print(
+        f"开始向量化并写入数据库 (Collection: {COLLECTION_NAME}) | "
+        f"并发 {concurrency} | QPM {qpm} | TPM {tpm}..."
+    )
+    dims = set()  # 实际写入的向量维度，记录到集合 metadata 中
+
+    def write_batch(docs, ids, vectors):
+        write_batch_to_store(vector_store, docs, ids, vectors)
+        dims.update(len(vector) for vector in vectors[:1])
+
+    pipeline = EmbeddingPipeline(
+        embeddings,
+        write_batch=write_batch,
+        concurrency=concurrency,
+        qpm=qpm,
+        tpm=tpm,
+        max_retries=EMBEDDING_MAX_RETRIES,
+        dead_letter_path=DEAD_LETTER_PATH,
+    )
+    # 第二遍扫描：边读边入库，内存占用只与批次大小和并发数有关
+    total_pending = len(pending_ids)
+    batches = iter_pending_batches(
+        PROCESSED_DATA_PATH, pending_ids, BATCH_SIZE, checkpoint
+    )
+    with tqdm(total=total_pending, unit="doc") as progress:
+        stats = pipeline.run(
+            batches, progress=progress, on_batch_done=checkpoint.mark_done
+        )
+    checkpoint.clear()
+    record_collection_embedding(vector_store._collection, info, dim=max(dims or {0}))
+    partitions = update_partitions(vector_store, book_counts)
+    # 内容有变化，更新入库版本号，使检索缓存失效
+    version = bump_ingest_version(
+        {"written": stats["written"], "deleted": len(stale_ids)}
+    )
+    write_catalog(book_counts, COLLECTION_NAME, version, partitions)
+
+    print(
+        f"\n✅ 入库完成！写入 {stats['written']} 条，失败 {stats['failed']} 条，"
+        f"重试 {stats['retries']} 次，耗时 {stats['elapsed']:.1f}s "
+        f"({stats['docs_per_sec']:.1f} docs/s)。"
+    )
+    if stats["failed"]:
+        print(f"失败的片段已写入死信文件: {DEAD_LETTER_PATH}，重新运行即可补齐。")
+    if hasattr(embeddings, "stats") and embeddings.stats():
+        print(f"Embedding 缓存统计: {embeddings.stats()}")
 
 
 if __name__ == "__main__":
-    # 检查 Key 是否存在
-    if not os.getenv("GOOGLE_API_KEY"):
+    parser = argparse.ArgumentParser(description="将清洗后的 JSONL 数据写入 ChromaDB")
+    parser.add_argument(
+        "--full", action="store_true", help="清空集合后全量重建 (默认增量同步)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=INGEST_CONCURRENCY, help="并发请求数"
+    )
+    parser.add_argument(
+        "--qpm", type=int, default=EMBEDDING_QPM, help="Embedding 每分钟请求数上限"
+    )
+    parser.add_argument(
+        "--tpm", type=int, default=EMBEDDING_TPM, help="Embedding 每分钟 token 上限"
+    )
+    args = parser.parse_args()
+
+    # 检查 Key 是否存在 (本地 Embedding 不需要)
+    if EMBEDDING_BACKEND == "gemini" and not os.getenv("GOOGLE_API_KEY"):
         print("错误：未找到 GOOGLE_API_KEY，请检查 .env 文件。")
         print("提示：你需要去 Google AI Studio 申请一个 API Key。")
     else:
-        ingest_data()
+        ingest_data(
+            full_rebuild=args.full,
+            concurrency=args.concurrency,
+            qpm=args.qpm,
+            tpm=args.tpm,
+        )
@@ -0,0 +1,39 @@
+import os
+import json
+import time
+import uuid
+
+from src.db.embeddings import INDEX_DATA_DIR
+
+INGEST_VERSION_PATH = INDEX_DATA_DIR / "ingest_version.json"
+
+# (mtime, version)：文件未变化时直接返回缓存值，每次检索只多一次 stat
+_cached = (None, None)
+
+
+def read_ingest_version():
+    """返回当前向量库的入库版本号，从未入库时返回 None"""
+    global _cached
+    try:
+        mtime = INGEST_VERSION_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _cached[0] != mtime:
+        with open(INGEST_VERSION_PATH, "r", encoding="utf-8") as f:
+            _cached = (mtime, json.load(f)["version"])
+    return _cached[1]
+
+
+def bump_ingest_version(summary=None):
+    """
+    入库内容发生变化后生成新的版本号，
+    检索缓存等依赖向量库内容的组件据此自动失效。
+    """
+    version = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    data = {"version": version, "updated_at": time.time(), **(summary or {})}
+    INGEST_VERSION_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = INGEST_VERSION_PATH.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, INGEST_VERSION_PATH)
+    return version
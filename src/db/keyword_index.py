@@ -0,0 +1,179 @@
+import re
+import sys
+import json
+import sqlite3
+import threading
+import unicodedata
+from pathlib import Path
+
+from langchain_core.documents import Document
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from src.db.embeddings import INDEX_DATA_DIR
+
+# --- 配置路径 ---
+BASE_DIR = Path(__file__).resolve().parents[2]
+PROCESSED_DATA_PATH = BASE_DIR / "data" / "processed" / "dnd_knowledge_base.jsonl"
+KEYWORD_INDEX_PATH = INDEX_DATA_DIR / "keyword_index.sqlite3"
+
+# 修改分词规则后递增，旧索引需要重建
+TOKENIZER_VERSION = "cjk-bigram-v1"
+WRITE_BATCH_SIZE = 1000
+
+CJK_RUN_PATTERN = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]+")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """
+    中文友好的分词：连续的汉字切成字二元组 (单字保留为一元)，英文和数字按单词切分。
+    例如 "火球术 8d6" -> ["火球", "球术", "8d6"]。
+    不依赖 jieba 等分词词典，建索引和查询使用同一规则即可。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for run in CJK_RUN_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i : i + 2] for i in range(len(run) - 1))
+    tokens.extend(WORD_PATTERN.findall(CJK_RUN_PATTERN.sub(" ", text)))
+    return tokens
+
+
+class KeywordIndex:
+    """
+    基于 SQLite FTS5 的 BM25 关键词索引，与 Chroma 中的数据块一一对应 (ID 相同)。
+    文本预先分词为空格分隔的 token 存入 FTS5，检索时用 bm25() 排序。
+    """
+
+    def __init__(self, path=KEYWORD_INDEX_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+                tokens,
+                id UNINDEXED,
+                source_book UNINDEXED,
+                page_content UNINDEXED,
+                metadata UNINDEXED,
+                tokenize = 'unicode61'
+            )
+            """)
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'tokenizer'"
+        ).fetchone()
+        if row is None:
+            self._conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('tokenizer', ?)",
+                (TOKENIZER_VERSION,),
+            )
+        elif row[0] != TOKENIZER_VERSION:
+            # 分词规则变化，清空旧数据，等待下一次 sync 重建
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.execute(
+                "UPDATE meta SET value = ? WHERE key = 'tokenizer'",
+                (TOKENIZER_VERSION,),
+            )
+        self._conn.commit()
+
+    def ids(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT id FROM chunks")}
+
+    def add(self, items):
+        """items: 可迭代的 (chunk_id, Document)"""
+        rows = [
+            (
+                " ".join(tokenize(doc.page_content)),
+                chunk_id,
+                doc.metadata.get("source_book", ""),
+                doc.page_content,
+                json.dumps(doc.metadata, ensure_ascii=False),
+            )
+            for chunk_id, doc in items
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO chunks (tokens, id, source_book, page_content, metadata) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def delete(self, ids):
+        ids = list(ids)
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                part = ids[i : i + 500]
+                placeholders = ",".join("?" * len(part))
+                self._conn.execute(
+                    f"DELETE FROM chunks WHERE id IN ({placeholders})", part
+                )
+            self._conn.commit()
+
+    def search(self, query, k=10, book_filter=None):
+        """BM25 检索，返回按相关度排序的 Document 列表 (Document.id 为 chunk ID)"""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+        # 每个 token 加引号，避免被 FTS5 当成语法关键字 (AND/OR/NOT 等)
+        match = " OR ".join('"' + token.replace('"', '""') + '"' for token in tokens)
+        sql = "SELECT id, page_content, metadata FROM chunks " "WHERE chunks MATCH ?"
+        params = [match]
+        if book_filter:
+            sql += f" AND source_book IN ({','.join('?' * len(book_filter))})"
+            params.extend(book_filter)
+        sql += " ORDER BY bm25(chunks) LIMIT ?"
+        params.append(k)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [
+            Document(id=chunk_id, page_content=content, metadata=json.loads(metadata))
+            for chunk_id, content, metadata in rows
+        ]
+
+    def sync(self, file_path=PROCESSED_DATA_PATH):
+        """
+        与清洗后的 JSONL 同步：插入新增的数据块，删除已不存在的数据块。
+        纯本地计算，不调用任何 API。返回 (新增数, 删除数)。
+        """
+        # 延迟导入，避免检索时加载入库脚本的依赖
+        from src.db.ingest import iter_processed_records, scan_chunk_ids
+
+        current_ids, _ = scan_chunk_ids(file_path)
+        existing_ids = self.ids()
+        stale_ids = existing_ids - current_ids
+        pending_ids = current_ids - existing_ids
+
+        if stale_ids:
+            self.delete(stale_ids)
+
+        batch = []
+        for doc, chunk_id, _, _ in iter_processed_records(file_path):
+            if chunk_id not in pending_ids:
+                continue
+            pending_ids.discard(chunk_id)
+            batch.append((chunk_id, doc))
+            if len(batch) >= WRITE_BATCH_SIZE:
+                self.add(batch)
+                batch = []
+        if batch:
+            self.add(batch)
+
+        return len(current_ids - existing_ids), len(stale_ids)
+
+
+if __name__ == "__main__":
+    added, removed = KeywordIndex().sync()
+    print(
+        f"关键词索引已同步: 新增 {added} 条 | 删除 {removed} 条 ({KEYWORD_INDEX_PATH})"
+    )
@@ -0,0 +1,153 @@
+import os
+import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.documents import Document
+
+# --- 配置参数 ---
+# 入库时是否按 source_book 额外维护分区集合 (每本书一个 Chroma 集合)
+PARTITION_BY_BOOK = os.getenv("PARTITION_BY_BOOK", "0") != "0"
+# 从全局集合复制到分区时每页读取的条数 (含向量)
+PARTITION_COPY_PAGE_SIZE = 1000
+PARTITION_ID_PAGE_SIZE = 5000
+# 检索时并发查询的分区数
+PARTITION_SEARCH_WORKERS = int(os.getenv("PARTITION_SEARCH_WORKERS", "8"))
+
+
+def partition_name(collection_name, book):
+    """
+    分区集合名。书名含中文和斜杠，不符合 Chroma 的命名规则 (字母数字、._-)，
+    因此用书名的哈希；书名到集合名的映射记录在书目目录 (catalog.json) 中。
+    """
+    digest = hashlib.sha1(book.encode("utf-8")).hexdigest()[:16]
+    return f"{collection_name}_book_{digest}"
+
+
+def list_partition_names(client, collection_name):
+    prefix = f"{collection_name}_book_"
+    # chromadb 0.6 之前返回 Collection 对象，之后返回名称
+    names = [getattr(c, "name", c) for c in client.list_collections()]
+    return [name for name in names if name.startswith(prefix)]
+
+
+def drop_partitions(client, collection_name, keep=()):
+    """删除分区集合 (keep 中的除外)，返回删除的个数"""
+    dropped = 0
+    for name in list_partition_names(client, collection_name):
+        if name not in keep:
+            client.delete_collection(name)
+            dropped += 1
+    return dropped
+
+
+def _paged_ids(collection, where=None):
+    ids = set()
+    offset = 0
+    while True:
+        result = collection.get(
+            where=where, include=[], limit=PARTITION_ID_PAGE_SIZE, offset=offset
+        )
+        page = result.get("ids", [])
+        ids.update(page)
+        if len(page) < PARTITION_ID_PAGE_SIZE:
+            return ids
+        offset += PARTITION_ID_PAGE_SIZE
+
+
+def sync_partitions(client, collection_name, books):
+    """
+    让每本书的分区集合与全局集合中该书的数据保持一致，返回 {书: 分区集合名}。
+
+    直接从全局集合复制向量，不再调用 Embedding API：
+    分区中缺少的 ID 从全局集合读取后写入，多出的 ID (全局集合中已删除) 从分区删除。
+    不在 books 中的旧分区一并删除。
+    """
+    source = client.get_collection(collection_name, embedding_function=None)
+    partitions = {}
+    for book in sorted(books):
+        name = partition_name(collection_name, book)
+        partition = client.get_or_create_collection(
+            name,
+            metadata={"partition_of": collection_name, "source_book": book},
+            embedding_function=None,
+        )
+        expected = _paged_ids(source, where={"source_book": book})
+        current = _paged_ids(partition)
+
+        stale = sorted(current - expected)
+        for i in range(0, len(stale), PARTITION_COPY_PAGE_SIZE):
+            partition.delete(ids=stale[i : i + PARTITION_COPY_PAGE_SIZE])
+
+        missing = sorted(expected - current)
+        for i in range(0, len(missing), PARTITION_COPY_PAGE_SIZE):
+            page = source.get(
+                ids=missing[i : i + PARTITION_COPY_PAGE_SIZE],
+                include=["embeddings", "documents", "metadatas"],
+            )
+            partition.upsert(
+                ids=page["ids"],
+                embeddings=page["embeddings"],
+                documents=page["documents"],
+                metadatas=page["metadatas"],
+            )
+        partitions[book] = name
+
+    drop_partitions(client, collection_name, keep=set(partitions.values()))
+    return partitions
+
+
+def plan_partitions(book_filter, partitions, fallback_ratio):
+    """
+    查询规划：返回需要检索的分区 (书名列表)，返回 None 表示使用全局集合 + 书目过滤。
+    partitions 为 {书: 分区}，选中但没有分区的书在库中没有数据，直接跳过。
+
+    - 没有分区、不过滤书目时用全局集合
+    - 选中的书超过分区总数的 fallback_ratio 时，过滤后剩下的数据占大头，
+      单次全局检索比并发检索多个分区更划算
+    """
+    if not partitions or not book_filter:
+        return None
+    books = set(book_filter)
+    if len(books) > fallback_ratio * len(partitions):
+        return None
+    return [book for book in sorted(books) if book in partitions]
+
+
+def search_partitions(collections, embedding, k, workers=PARTITION_SEARCH_WORKERS):
+    """
+    在多个分区中并发检索，按距离合并后取前 k 个，返回 Document 列表 (Document.id 为 chunk ID)。
+    各分区使用同一个 Embedding 和距离函数，距离可以直接比较。
+    """
+
+    def query(collection):
+        result = collection.query(
+            query_embeddings=[embedding],
+            n_results=k,
+            include=["documents", "metadatas", "distances"],
+        )
+        return list(
+            zip(
+                result["distances"][0],
+                result["ids"][0],
+                result["documents"][0],
+                result["metadatas"][0],
+            )
+        )
+
+    if len(collections) > 1 and workers > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(collections))) as pool:
+            # 带上当前 context，子线程的日志仍归属同一个 trace
+            futures = [
+                pool.submit(contextvars.copy_context().run, query, collection)
+                for collection in collections
+            ]
+            hits = [hit for future in futures for hit in future.result()]
+    else:
+        hits = [hit for collection in collections for hit in query(collection)]
+
+    hits.sort(key=lambda hit: hit[0])
+    return [
+        Document(id=chunk_id, page_content=content, metadata=metadata or {})
+        for _, chunk_id, content, metadata in hits[:k]
+    ]
@@ -0,0 +1,168 @@
+import json
+import time
+import random
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from src.db.tokens import estimate_tokens
+
+
+class TokenBucket:
+    """
+    令牌桶限流器：每分钟补充 rate_per_minute 个令牌，桶容量为一分钟的额度。
+    acquire() 在令牌不足时阻塞，线程安全。
+    """
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        # 单次请求超过桶容量时按容量计，否则永远拿不到令牌
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_seconds = (amount - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class EmbeddingPipeline:
+    """
+    并发入库引擎。
+
+    - 线程池并发调用 Embedding API (concurrency 个请求同时在途)
+    - 按 QPM (每分钟请求数) 和 TPM (每分钟 token 数) 双令牌桶限流
+    - 失败的批次按指数退避重试，最终仍失败的片段写入死信文件
+    - 主线程负责写入 Chroma，与后台的 Embedding 请求重叠进行
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        write_batch,
+        concurrency=4,
+        qpm=300,
+        tpm=1_000_000,
+        max_retries=5,
+        backoff_base=2.0,
+        backoff_max=60.0,
+        dead_letter_path=None,
+    ):
+        self.embeddings = embeddings
+        self.write_batch = write_batch  # write_batch(docs, ids, vectors)
+        self.concurrency = max(1, concurrency)
+        self.request_bucket = TokenBucket(qpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.dead_letter_path = dead_letter_path
+
+        self.written = 0
+        self.failed = 0
+        self.retries = 0
+        # retries 在工作线程中累加，written/failed 只在主线程修改
+        self._retries_lock = threading.Lock()
+
+    def _embed_with_retry(self, texts):
+        """限流 + 指数退避重试，超过重试次数后抛出最后一次的异常"""
+        tokens = sum(estimate_tokens(text) for text in texts)
+        attempt = 0
+        while True:
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(tokens)
+            try:
+                return self.embeddings.embed_documents(texts)
+            except Exception:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                with self._retries_lock:
+                    self.retries += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                # 加入随机抖动，避免多个线程同时重试撞上限流
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _dead_letter(self, docs, ids, error):
+        self.failed += len(docs)
+        print(f"批次失败 ({len(docs)} 条)，已放弃重试: {error}")
+        if not self.dead_letter_path:
+            return
+        self.dead_letter_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            for doc, chunk_id in zip(docs, ids):
+                record = {
+                    "id": chunk_id,
+                    "page_content": doc.page_content,
+                    "metadata": doc.metadata,
+                    "error": str(error),
+                }
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _handle_done(self, future, seq, docs, ids, progress, on_batch_done):
+        try:
+            vectors = future.result()
+        except Exception as e:
+            self._dead_letter(docs, ids, e)
+        else:
+            try:
+                self.write_batch(docs, ids, vectors)
+                self.written += len(docs)
+            except Exception as e:
+                self._dead_letter(docs, ids, e)
+        if progress is not None:
+            progress.update(len(docs))
+        # 失败的批次已写入死信文件，同样视为"已处理"
+        if on_batch_done is not None:
+            on_batch_done(seq)
+
+    def run(self, batches, progress=None, on_batch_done=None):
+        """
+        batches: 可迭代的 (docs, ids) 批次，可以是生成器 (按需读取)。
+        在途批次数限制为 concurrency 的两倍，内存占用与批次大小成正比。
+        on_batch_done(seq): 第 seq 个批次 (从 0 开始) 处理完毕后回调，完成顺序不固定。
+        返回统计信息字典。
+        """
+        start = time.perf_counter()
+        max_in_flight = self.concurrency * 2
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for seq, (docs, ids) in enumerate(batches):
+                texts = [doc.page_content for doc in docs]
+                future = executor.submit(self._embed_with_retry, texts)
+                in_flight[future] = (seq, docs, ids)
+
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._handle_done(
+                            future, *in_flight.pop(future), progress, on_batch_done
+                        )
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._handle_done(
+                        future, *in_flight.pop(future), progress, on_batch_done
+                    )
+
+        elapsed = time.perf_counter() - start
+        return {
+            "written": self.written,
+            "failed": self.failed,
+            "retries": self.retries,
+            "elapsed": elapsed,
+            "docs_per_sec": self.written / elapsed if elapsed > 0 else 0.0,
+        }
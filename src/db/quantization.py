@@ -0,0 +1,68 @@
+import numpy as np
+
+# 量化精度模拟：Chroma 内部始终以 float32 存储向量，这里的量化只用于基准测试，
+# 复现量化存储的数值误差，评估换用支持量化的向量库后的召回变化，并不缩小索引
+# none 保持 float32；float16 半精度；int8 每个向量按最大绝对值对称量化
+QUANTIZATION_MODES = ("none", "float16", "int8")
+# 每个分量占用的字节数，用于估算真正量化存储时的向量数据体积
+BYTES_PER_COMPONENT = {"none": 4, "float16": 2, "int8": 1}
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def quantize(matrix, quantization):
+    """
+    把 float32 矩阵量化为存储格式，返回 (量化后的矩阵, 每行的缩放系数或 None)。
+    int8 每行单独取缩放系数 max|x| / 127，避免少数大分量拖累整体精度。
+    """
+    if quantization == "none":
+        return matrix.astype(np.float32), None
+    if quantization == "float16":
+        return matrix.astype(np.float16), None
+    if quantization == "int8":
+        scales = np.abs(matrix).max(axis=1, keepdims=True) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(matrix / scales), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(
+        f"未知的量化方式: {quantization} (可选 {' / '.join(QUANTIZATION_MODES)})"
+    )
+
+
+def dequantize(codes, scales=None):
+    matrix = codes.astype(np.float32)
+    return matrix * scales if scales is not None else matrix
+
+
+def transform_vectors(vectors, dimensions=0, quantization="none"):
+    """
+    向量变换：
+
+    1. 截断维度 (Matryoshka)：只保留前 dimensions 维并重新归一化，
+       gemini-embedding-001 等 MRL 训练的模型截断后仍保持大部分检索效果。入库和查询共用这一步
+    2. 精度模拟 (仅基准测试使用)：量化后再还原为 float32，得到与量化存储相同的数值，
+       结果仍是 float32，不节省任何存储
+
+    dimensions 为 0 或不小于原维度时不截断。返回 float32 的二维 numpy 数组。
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix[None, :]
+    if dimensions and dimensions < matrix.shape[1]:
+        matrix = matrix[:, :dimensions]
+    matrix = normalize_rows(matrix)
+    if quantization != "none":
+        matrix = normalize_rows(dequantize(*quantize(matrix, quantization)))
+    return matrix
+
+
+def vector_bytes(count, dimensions, quantization="none"):
+    """count 个向量真正以给定格式存储时的理论数据体积 (不含索引结构)，int8 另加每行一个 float32 缩放系数"""
+    size = count * dimensions * BYTES_PER_COMPONENT[quantization]
+    if quantization == "int8":
+        size += count * 4
+    return size
@@ -0,0 +1,30 @@
+import re
+
+# 中日韩文字及全角符号：Gemini 的分词器大约 1 个字符 1 个 token
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+# 句子边界：中文句末标点之后，或英文句号后面跟空白
+SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？!?；;])|(?<=\.)(?=\s)")
+
+
+def estimate_tokens(text):
+    """
+    粗略估算文本的 token 数 (不依赖具体模型的分词器)。
+    中文按 1 字 1 token，其余字符按 4 个字符 1 token 计算。
+    """
+    if not text:
+        return 0
+    cjk_count = len(CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + (other_count + 3) // 4
+
+
+def split_sentences(text):
+    """按句子切分，保留原有的换行 (拼接回去时直接 "".join 即可还原)"""
+    sentences = []
+    lines = text.split("\n")
+    for index, line in enumerate(lines):
+        parts = [part for part in SENTENCE_BOUNDARY.split(line) if part.strip()]
+        if parts and index < len(lines) - 1:
+            parts[-1] += "\n"
+        sentences.extend(parts)
+    return sentences
@@ -0,0 +1,326 @@
+import os
+import re
+
+from src.db.tokens import estimate_tokens, split_sentences
+
+# --- 切分参数 (按估算的 token 数计算) ---
+# 单个数据块上限
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "600"))
+# 小于此值的小节尝试与相邻小节合并
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "80"))
+# 同一小节切开后，相邻块之间重叠的 token 数
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "60"))
+
+HEADER_PATTERN = re.compile(r"^(#{1,3})\s+(.*)$")
+TABLE_SEPARATOR_PATTERN = re.compile(r"^\|?\s*:?-{3,}")
+
+
+def parse_sections(markdown_text, chapter):
+    """
+    按 #/##/### 标题把 Markdown 切成小节，并记录每个小节的上级标题路径。
+    返回 [{"parent": (上级标题, ...), "title": 标题, "header": 标题行, "text": 全文}]。
+    """
+    sections = []
+    stack = []  # [(级别, 标题)]
+    current = {"parent": (), "title": chapter, "header": None, "lines": []}
+
+    def flush():
+        text = "\n".join(current["lines"]).strip()
+        if text:
+            sections.append(
+                {
+                    "parent": current["parent"],
+                    "title": current["title"],
+                    "header": current["header"],
+                    "text": text,
+                    "tokens": estimate_tokens(text),
+                }
+            )
+
+    for line in markdown_text.split("\n"):
+        match = HEADER_PATTERN.match(line.strip())
+        if not match:
+            current["lines"].append(line)
+            continue
+
+        flush()
+        level = len(match.group(1))
+        title = match.group(2).strip()
+        while stack and stack[-1][0] >= level:
+            stack.pop()
+        parent = tuple(name for _, name in stack)
+        stack.append((level, title))
+        current = {
+            "parent": parent,
+            "title": title,
+            "header": line.strip(),
+            "lines": [line],
+        }
+
+    flush()
+    return sections
+
+
+def same_family(prev, section):
+    """section 与 prev 同属一个上级 (同级或是它的下级)"""
+    return section["parent"][: len(prev["parent"])] == prev["parent"]
+
+
+def is_ancestor(prev, section):
+    """prev 是 section 的上级标题 (例如 "# 法术" 之于 "## 火球术")"""
+    path = (*prev["parent"], prev["title"])
+    return section["parent"][: len(path)] == path
+
+
+def join_sections(first, second, keep_first=True):
+    """拼接两个相邻小节，标题信息取自 first (keep_first=False 时取自 second)"""
+    joined = dict(first if keep_first else second)
+    joined["text"] = first["text"] + "\n\n" + second["text"]
+    joined["tokens"] = first["tokens"] + second["tokens"]
+    return joined
+
+
+def merge_small_sections(sections, min_tokens, max_tokens):
+    """
+    把过小的小节与相邻小节合并，避免出现只有标题或一两句话的碎片。
+
+    1. 优先与同一上级下的相邻小节合并，合并后不超过 max_tokens
+    2. 做不到时碎片不单独成块：与下一个小节同属一个上级时并入下一个小节，
+       否则并入上一个小节 (没有上一个小节时仍并入下一个)；
+       合并后超过 max_tokens 的小节由 pack_section 重新切分
+    """
+    merged = []
+    carry = None  # 等待并入下一个小节的碎片
+    for section in sections:
+        section = dict(section)
+        if carry is not None:
+            if same_family(carry, section) or not merged:
+                # 上级标题的碎片并入下级小节时，标题信息取更深的下级，保留 sub_topic 和完整路径
+                keep_first = same_family(carry, section) and not is_ancestor(
+                    carry, section
+                )
+                section = join_sections(carry, section, keep_first=keep_first)
+            else:
+                merged[-1] = join_sections(merged[-1], carry)
+            carry = None
+        if merged:
+            prev = merged[-1]
+            undersized = prev["tokens"] < min_tokens or section["tokens"] < min_tokens
+            if (
+                same_family(prev, section)
+                and undersized
+                and prev["tokens"] + section["tokens"] <= max_tokens
+            ):
+                merged[-1] = join_sections(prev, section)
+                continue
+        if section["tokens"] < min_tokens:
+            carry = section
+            continue
+        merged.append(section)
+
+    if carry is not None:
+        # 最后一个碎片并入上一个小节
+        if merged:
+            merged[-1] = join_sections(merged[-1], carry)
+        else:
+            merged.append(carry)
+    return merged
+
+
+def split_blocks(text):
+    """把小节正文拆成段落块和表格块 (表格的连续行作为一个整体)"""
+    blocks = []
+    paragraph = []
+    table = []
+
+    def flush_paragraph():
+        if paragraph:
+            content = "\n".join(paragraph).strip()
+            if content:
+                blocks.append(("text", content))
+            paragraph.clear()
+
+    def flush_table():
+        if table:
+            blocks.append(("table", "\n".join(table)))
+            table.clear()
+
+    for line in text.split("\n"):
+        if line.strip().startswith("|"):
+            flush_paragraph()
+            table.append(line)
+        elif not line.strip():
+            flush_paragraph()
+            flush_table()
+        else:
+            flush_table()
+            paragraph.append(line)
+
+    flush_paragraph()
+    flush_table()
+    return blocks
+
+
+def hard_split(text, max_tokens):
+    """没有任何句子边界的超长文本，按字符数硬切"""
+    pieces = []
+    while estimate_tokens(text) > max_tokens:
+        cut = max(1, len(text) * max_tokens // estimate_tokens(text))
+        pieces.append(text[:cut])
+        text = text[cut:]
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def split_long_paragraph(text, max_tokens):
+    """按句子把超长段落拆成若干不超过 max_tokens 的部分"""
+    pieces = []
+    current = ""
+    for sentence in split_sentences(text):
+        if estimate_tokens(sentence) > max_tokens:
+            if current:
+                pieces.append(current.strip())
+                current = ""
+            pieces.extend(hard_split(sentence.strip(), max_tokens))
+            continue
+        if current and estimate_tokens(current + sentence) > max_tokens:
+            pieces.append(current.strip())
+            current = sentence
+        else:
+            current += sentence
+    if current.strip():
+        pieces.append(current.strip())
+    return pieces
+
+
+def split_long_table(table_text, max_tokens):
+    """按行拆分超长表格，每一部分都重复表头"""
+    lines = table_text.split("\n")
+    if len(lines) > 2 and TABLE_SEPARATOR_PATTERN.match(lines[1].strip()):
+        header, rows = lines[:2], lines[2:]
+    else:
+        header, rows = [], lines
+
+    header_tokens = estimate_tokens("\n".join(header))
+    pieces = []
+    current = []
+    current_tokens = header_tokens
+    for row in rows:
+        row_tokens = estimate_tokens(row)
+        if current and current_tokens + row_tokens > max_tokens:
+            pieces.append("\n".join(header + current))
+            current = []
+            current_tokens = header_tokens
+        current.append(row)
+        current_tokens += row_tokens
+    if current:
+        pieces.append("\n".join(header + current))
+    return pieces
+
+
+def overlap_tail(units, overlap_tokens):
+    """取上一块末尾不超过 overlap_tokens 的句子作为下一块的开头 (表格不参与重叠)"""
+    if overlap_tokens <= 0 or not units or units[-1][0] != "text":
+        return []
+    tail = []
+    tokens = 0
+    for sentence in reversed(split_sentences(units[-1][1])):
+        sentence_tokens = estimate_tokens(sentence)
+        if tokens + sentence_tokens > overlap_tokens:
+            break
+        tail.insert(0, sentence)
+        tokens += sentence_tokens
+    return [("text", "".join(tail).strip())] if tail else []
+
+
+def pack_section(section, max_tokens, overlap_tokens):
+    """把一个小节打包成若干不超过 max_tokens 的数据块"""
+    if section["tokens"] <= max_tokens:
+        return [section["text"]]
+
+    # 续块开头重复标题行，保证每一块都有上下文
+    continuation = f"{section['header']} (续)" if section["header"] else ""
+    # 预留续块标题和块之间空行的开销
+    budget = max_tokens - estimate_tokens(continuation) - 1
+
+    units = []
+    for kind, block in split_blocks(section["text"]):
+        if estimate_tokens(block) <= budget:
+            units.append((kind, block))
+        elif kind == "table":
+            units.extend(("table", part) for part in split_long_table(block, budget))
+        else:
+            units.extend(("text", part) for part in split_long_paragraph(block, budget))
+
+    pieces = []
+    current = []
+    current_tokens = 0
+    for kind, unit in units:
+        unit_tokens = estimate_tokens(unit)
+        if current and current_tokens + unit_tokens > budget:
+            pieces.append(current)
+            current = overlap_tail(current, overlap_tokens)
+            current_tokens = sum(estimate_tokens(text) for _, text in current)
+            if current_tokens + unit_tokens > budget:
+                current, current_tokens = [], 0
+        current.append((kind, unit))
+        current_tokens += unit_tokens
+    if current:
+        pieces.append(current)
+
+    texts = []
+    for index, piece in enumerate(pieces):
+        body = "\n\n".join(text for _, text in piece)
+        if index > 0 and continuation:
+            body = f"{continuation}\n\n{body}"
+        texts.append(body)
+    return texts
+
+
+def has_body(section):
+    """小节除了标题行之外是否还有正文"""
+    lines = section["text"].split("\n")
+    return any(
+        line.strip() and not HEADER_PATTERN.match(line.strip()) for line in lines
+    )
+
+
+def split_markdown_by_headers(
+    markdown_text,
+    metadata,
+    max_tokens=CHUNK_MAX_TOKENS,
+    min_tokens=CHUNK_MIN_TOKENS,
+    overlap_tokens=CHUNK_OVERLAP_TOKENS,
+):
+    """
+    按标题层级切分 Markdown，并保证每个数据块的大小在 token 预算之内。
+
+    1. 按 #/##/### 切成小节，记录 "章节 > 上级标题 > 标题" 的路径
+    2. 过小的相邻小节合并，只有标题没有正文的碎片被丢弃
+    3. 超过 max_tokens 的小节按段落/句子切分，表格按行切分并重复表头，
+       相邻块之间保留 overlap_tokens 的重叠
+    """
+    chapter = metadata.get("chapter", "Unknown")
+    sections = parse_sections(markdown_text, chapter)
+    sections = merge_small_sections(sections, min_tokens, max_tokens)
+
+    chunks = []
+    for section in sections:
+        if not has_body(section):
+            continue
+        header_path = " > ".join((chapter, *section["parent"], section["title"]))
+        if not section["parent"] and section["title"] == chapter:
+            header_path = chapter
+        for text in pack_section(section, max_tokens, overlap_tokens):
+            chunks.append(
+                {
+                    "page_content": text,
+                    "metadata": {
+                        **metadata,
+                        "sub_topic": section["title"],
+                        "header_path": header_path,
+                    },
+                }
+            )
+    return chunks
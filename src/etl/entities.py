@@ -0,0 +1,351 @@
+import re
+
+# --- 抽取参数 ---
+# 每个条目保存的原文上限 (字符)，检索结果只需要条目本身，不需要整个章节
+ENTITY_TEXT_MAX_CHARS = 2000
+# 判断法术/怪物时只看标题下的前几行
+HEAD_LINES = 12
+
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.*)$")
+# "火球术（Fireball）"、"火球术 (Fireball)"
+NAME_WITH_PARENS = re.compile(r"^(.*?)\s*[（(]\s*([A-Za-z][^()（）]*?)\s*[)）]\s*$")
+# "火球术 Fireball"
+NAME_ZH_EN = re.compile(
+    r"^([^A-Za-z]*[\u3400-\u9fff][^A-Za-z]*?)\s+([A-Za-z][A-Za-z0-9'’:,/\- ]*)$"
+)
+# "Fireball 火球术"
+NAME_EN_ZH = re.compile(r"^([A-Za-z][A-Za-z0-9'’:,/\- ]*?)\s+([\u3400-\u9fff].*)$")
+ENGLISH_NAME = re.compile(r"^[A-Za-z][A-Za-z0-9'’:,/\- ]*$")
+# 职业特性标题前的等级："1级：狂暴"、"Level 3: Primal Path"
+FEATURE_LEVEL_PREFIX = re.compile(
+    r"^(?:(\d{1,2})\s*级|level\s*(\d{1,2}))\s*[:：]?\s*", re.IGNORECASE
+)
+
+SCHOOLS = {
+    "防护": "abjuration",
+    "咒法": "conjuration",
+    "预言": "divination",
+    "惑控": "enchantment",
+    "塑能": "evocation",
+    "幻术": "illusion",
+    "死灵": "necromancy",
+    "变化": "transmutation",
+}
+SCHOOL_PATTERN = re.compile(
+    "(" + "|".join(list(SCHOOLS) + [s.capitalize() for s in SCHOOLS.values()]) + ")"
+)
+SPELL_LEVEL_PATTERN = re.compile(
+    r"(\d)\s*环|(\d)(?:st|nd|rd|th)[- ]level|level\s*(\d)", re.IGNORECASE
+)
+CANTRIP_PATTERN = re.compile(r"戏法|cantrip", re.IGNORECASE)
+SPELL_FIELDS = {
+    "施法时间": "casting_time",
+    "施法距离": "range",
+    "射程": "range",
+    "法术成分": "components",
+    "成分": "components",
+    "持续时间": "duration",
+    "职业": "classes",
+}
+# 一行里可能有多个字段，按字段名切开；长的字段名放在前面优先匹配
+SPELL_FIELD_PATTERN = re.compile(
+    r"(" + "|".join(sorted(SPELL_FIELDS, key=len, reverse=True)) + r")\s*[:：]\s*"
+)
+
+SIZES = ("超微型", "微型", "小型", "中型", "大型", "巨型", "超巨型")
+CREATURE_LINE = re.compile(
+    r"^(" + "|".join(sorted(SIZES, key=len, reverse=True)) + r")\s*(.+?)[，,]\s*(.+)$"
+)
+ABILITIES = ("力量", "敏捷", "体质", "智力", "感知", "魅力")
+MONSTER_PATTERNS = {
+    "ac": re.compile(r"(?:护甲等级|AC)\s*[:：]?\s*(\d+)"),
+    "hp": re.compile(r"(?:生命值|HP)\s*[:：]?\s*(\d+)"),
+    "hit_dice": re.compile(
+        r"(?:生命值|HP)\s*[:：]?\s*\d+\s*[（(]\s*([0-9d+\-− ]+?)\s*[)）]"
+    ),
+    "speed": re.compile(r"速度\s*[:：]?\s*([^\n|]+)"),
+    "cr": re.compile(r"(?:挑战等级|挑战|CR)\s*[:：]?\s*(\d+/\d+|\d+)"),
+    "xp": re.compile(r"(\d[\d,]*)\s*(?:XP|经验)|XP\s*(\d[\d,]*)"),
+}
+INLINE_ABILITY = re.compile(r"(力量|敏捷|体质|智力|感知|魅力)\s*[:：]?\s*(\d{1,2})\b")
+
+# 成长表 "特性" 列中多个特性之间的分隔符
+FEATURE_SPLIT = re.compile(r"\s*[,，、;；]\s*")
+
+
+def clean_line(line):
+    """去掉 Markdown 的强调、引用和列表标记，方便按字段名匹配"""
+    line = line.replace("**", "").replace("__", "")
+    return re.sub(r"^[>\-*+_\s]+", "", line).rstrip("*_ ").strip()
+
+
+def parse_name(title):
+    """把标题拆成 (中文名, 英文名)，没有英文名时英文名为空字符串"""
+    title = clean_line(title).strip("*_ ")
+    for pattern, zh_first in (
+        (NAME_WITH_PARENS, True),
+        (NAME_ZH_EN, True),
+        (NAME_EN_ZH, False),
+    ):
+        match = pattern.match(title)
+        if match:
+            first, second = match.group(1).strip(), match.group(2).strip()
+            return (first, second) if zh_first else (second, first)
+    # 只有英文名的条目，中英文名相同
+    return title, title if ENGLISH_NAME.match(title) else ""
+
+
+def parse_sections(markdown_text):
+    """
+    按 1-6 级标题切分，返回 [{"level", "title", "own", "body"}]：
+    own 为标题到第一个子标题之间的正文，body 为包括全部子标题在内的正文。
+    """
+    lines = markdown_text.split("\n")
+    headings = []
+    for index, line in enumerate(lines):
+        match = HEADING_PATTERN.match(line.strip())
+        if match:
+            headings.append((index, len(match.group(1)), match.group(2).strip()))
+
+    sections = []
+    for position, (index, level, title) in enumerate(headings):
+        own_end = body_end = len(lines)
+        for next_index, next_level, _ in headings[position + 1 :]:
+            own_end = min(own_end, next_index)
+            if next_level <= level:
+                body_end = next_index
+                break
+        sections.append(
+            {
+                "level": level,
+                "title": title,
+                "own": "\n".join(lines[index + 1 : own_end]).strip(),
+                "body": "\n".join(lines[index + 1 : body_end]).strip(),
+            }
+        )
+    return sections
+
+
+def head_lines(text, limit=HEAD_LINES):
+    return [clean_line(line) for line in text.split("\n") if line.strip()][:limit]
+
+
+def parse_table(lines):
+    """解析 Markdown 表格，返回 (表头, 行列表)；不是表格时返回 None"""
+    rows = [
+        [cell.strip() for cell in line.strip().strip("|").split("|")]
+        for line in lines
+        if line.strip().startswith("|")
+    ]
+    rows = [row for row in rows if not all(re.fullmatch(r":?-{3,}:?", c) for c in row)]
+    if len(rows) < 2:
+        return None
+    return rows[0], rows[1:]
+
+
+def iter_tables(text):
+    """按连续的 | 开头的行切出表格"""
+    block = []
+    for line in text.split("\n") + [""]:
+        if line.strip().startswith("|"):
+            block.append(line)
+            continue
+        if block:
+            table = parse_table(block)
+            if table:
+                yield table
+            block = []
+
+
+def extract_spell(section):
+    """标题下的前几行有 "N环 学派" (或 "学派 戏法") 且有施法时间时视为法术"""
+    lines = head_lines(section["own"])
+    text = "\n".join(lines)
+    if "施法时间" not in text and "casting time" not in text.lower():
+        return None
+    level = school = None
+    ritual = False
+    for line in lines[:3]:
+        school_match = SCHOOL_PATTERN.search(line)
+        if not school_match:
+            continue
+        level_match = SPELL_LEVEL_PATTERN.search(line)
+        if level_match:
+            level = int(next(g for g in level_match.groups() if g))
+        elif CANTRIP_PATTERN.search(line):
+            level = 0
+        else:
+            continue
+        school = school_match.group(1)
+        school = next(
+            (zh for zh, en in SCHOOLS.items() if en == school.lower()), school
+        )
+        ritual = "仪式" in line or "ritual" in line.lower()
+        break
+    if level is None:
+        return None
+
+    data = {"level": level, "school": school, "ritual": ritual}
+    for line in lines:
+        parts = SPELL_FIELD_PATTERN.split(line)
+        # split 结果为 [前缀, 字段名, 值, 字段名, 值, ...]
+        for label, value in zip(parts[1::2], parts[2::2]):
+            key = SPELL_FIELDS[label]
+            if value.strip() and key not in data:
+                data[key] = value.strip()
+    data["concentration"] = "专注" in data.get("duration", "")
+    return data
+
+
+def extract_monster(section):
+    """同时有 AC、生命值和挑战等级的小节视为怪物数据卡"""
+    text = "\n".join(clean_line(line) for line in section["own"].split("\n"))
+    found = {}
+    for key, pattern in MONSTER_PATTERNS.items():
+        match = pattern.search(text)
+        if match:
+            found[key] = next(g for g in match.groups() if g).strip()
+    if not {"ac", "hp", "cr"} <= set(found):
+        return None
+
+    data = {"ac": int(found["ac"]), "hp": int(found["hp"]), "cr": found["cr"]}
+    for key in ("hit_dice", "speed"):
+        if key in found:
+            data[key] = found[key]
+    if "xp" in found:
+        data["xp"] = int(found["xp"].replace(",", ""))
+    for line in head_lines(section["own"], 3):
+        match = CREATURE_LINE.match(line)
+        if match:
+            data["size"], data["type"], data["alignment"] = match.groups()
+            break
+
+    abilities = {}
+    for header, rows in iter_tables(section["own"]):
+        if "力量" in header and "敏捷" in header:
+            for name, cell in zip(header, rows[0]):
+                score = re.match(r"\s*(\d+)", cell)
+                if name in ABILITIES and score:
+                    abilities[name] = int(score.group(1))
+            break
+    if not abilities:
+        for name, score in INLINE_ABILITY.findall(text):
+            abilities.setdefault(name, int(score))
+    if abilities:
+        data["abilities"] = abilities
+    return data
+
+
+def extract_class_table(text):
+    """
+    职业成长表：返回 (每级数据 {等级: {列名: 值}}, 特性名 -> 获得等级)。
+    没有表头同时含 "等级" 和 "特性" 的表格时返回 None。
+    """
+    for header, rows in iter_tables(text):
+        level_column = next((i for i, h in enumerate(header) if "等级" in h), None)
+        feature_column = next((i for i, h in enumerate(header) if "特性" in h), None)
+        if level_column is None or feature_column is None:
+            continue
+        levels = {}
+        features = {}
+        for row in rows:
+            if len(row) != len(header):
+                continue
+            level = re.match(r"\s*(\d{1,2})", row[level_column])
+            if not level:
+                continue
+            level = int(level.group(1))
+            levels[level] = dict(zip(header, row))
+            for feature in FEATURE_SPLIT.split(clean_line(row[feature_column])):
+                name, _ = parse_name(feature)
+                if name and name not in ("—", "-"):
+                    features.setdefault(name, level)
+        if levels:
+            return levels, features
+    return None
+
+
+def make_entity(kind, title, section, metadata, data, **extra):
+    name, name_en = parse_name(title)
+    return {
+        "kind": kind,
+        "name": name,
+        "name_en": name_en,
+        "source_book": metadata.get("source_book", "Unknown"),
+        "chapter": metadata.get("chapter", "Unknown"),
+        "data": {**data, **extra},
+        "text": section["body"][:ENTITY_TEXT_MAX_CHARS],
+    }
+
+
+def extract_entities(markdown_text, metadata):
+    """
+    从一个文件清洗后的 Markdown 中抽取结构化条目：
+
+    - spell: 环阶、学派、仪式、施法时间、距离、成分、持续时间、专注
+    - monster: 体型、类型、阵营、AC、HP (生命骰)、速度、六项属性、CR、XP
+    - class: 职业成长表 (每级的熟练加值、特性及其他列)
+    - class_feature: 成长表中列出的特性 (或带 "N级：" 前缀的小节) 及获得等级
+
+    返回条目列表，每个条目带 source_book / chapter 和小节原文 (截断)。
+    """
+    sections = parse_sections(markdown_text)
+    entities = []
+
+    class_table = extract_class_table(markdown_text)
+    features = {}
+    class_name = ""
+    if class_table:
+        levels, features = class_table
+        # 职业名取文件中级别最高的标题，没有标题时取章节名的最后一段
+        top = min(sections, key=lambda s: s["level"]) if sections else None
+        title = top["title"] if top else metadata.get("chapter", "").split("/")[-1]
+        class_name = parse_name(title)[0]
+        header = list(next(iter(levels.values())))
+        table_text = "\n".join(
+            "| " + " | ".join(row) + " |"
+            for row in [header, ["---"] * len(header)]
+            + [list(row.values()) for row in levels.values()]
+        )
+        entities.append(
+            make_entity(
+                "class", title, {"body": table_text}, metadata, {"levels": levels}
+            )
+        )
+
+    for section in sections:
+        spell = extract_spell(section)
+        if spell:
+            entities.append(
+                make_entity("spell", section["title"], section, metadata, spell)
+            )
+            continue
+        monster = extract_monster(section)
+        if monster:
+            entities.append(
+                make_entity("monster", section["title"], section, metadata, monster)
+            )
+            continue
+        if not class_table:
+            continue
+        # 在去掉强调标记后的标题上匹配和切片，"**1级：狂暴**" 才能得到 "狂暴"
+        cleaned = clean_line(section["title"])
+        prefix = FEATURE_LEVEL_PREFIX.match(cleaned)
+        title = cleaned[prefix.end() :] if prefix else cleaned
+        name, _ = parse_name(title)
+        if prefix:
+            level = int(prefix.group(1) or prefix.group(2))
+        elif name in features:
+            level = features[name]
+        else:
+            continue
+        entities.append(
+            make_entity(
+                "class_feature",
+                title,
+                section,
+                metadata,
+                {"class": class_name, "level": level},
+            )
+        )
+    return entities
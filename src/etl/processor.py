@@ -1,11 +1,23 @@
 import os
+import sys
 import json
 import re
+import time
+import hashlib
+import argparse
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup
-from markdownify import markdownify as md
+from markdownify import MarkdownConverter, markdownify as md
 from dotenv import load_dotenv
 
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from src.db.chunk_ids import compute_chunk_id
+from src.etl.chunker import split_markdown_by_headers
+from src.etl.entities import extract_entities
+
 # 加载环境变量
 load_dotenv()
 
@@ -14,10 +26,29 @@ BASE_DIR = Path(__file__).resolve().parents[2]  # 回退两级到项目根目录
 RAW_DATA_DIR = BASE_DIR / "data" / "raw"
 PROCESSED_DATA_DIR = BASE_DIR / "data" / "processed"
 OUTPUT_FILE = PROCESSED_DATA_DIR / "dnd_knowledge_base.jsonl"
+# 法术、怪物、职业特性等结构化条目 (由 src/db/entity_index.py 建索引)
+ENTITIES_FILE = PROCESSED_DATA_DIR / "dnd_entities.jsonl"
+MANIFEST_FILE = PROCESSED_DATA_DIR / "etl_manifest.json"
+
+# 修改 HTML 清洗或切分逻辑后递增，使旧清单失效并触发全量重新处理
+ETL_VERSION = 5
+
+# 耗时统计中展示的文件数
+TIMING_TOP_N = 15
 
+# HTML -> Markdown 的转换后端
+# - "bs4": html.parser 解析，再把 soup 序列化成字符串交给 markdownify 重新解析 (解析两次)
+# - "lxml": lxml (C 实现) 解析一次，markdownify 直接遍历清洗后的 soup
+# 两个后端对残缺 HTML 的容错不同，在全部 raw 数据上用 --compare-backends 确认输出一致之前，
+# 默认仍使用 bs4 旧管线，lxml 需要通过 --backend lxml 显式启用
+DEFAULT_BACKEND = "bs4"
+BACKENDS = ("lxml", "bs4")
+MARKDOWN_OPTIONS = {"strip": ["a", "img"], "heading_style": "ATX"}
 
-def clean_html(html_content):
-    soup = BeautifulSoup(html_content, "html.parser")
+
+def clean_html(html_content, backend="bs4"):
+    parser = "lxml" if backend == "lxml" else "html.parser"
+    soup = BeautifulSoup(html_content, parser)
     for tag in soup(["script", "style", "meta", "link", "noscript", "iframe"]):
         tag.decompose()
     for div in soup.find_all("div", class_="footer"):
@@ -36,43 +67,17 @@ def post_process_markdown(text):
     return text.strip()
 
 
-def convert_to_markdown(soup):
-    markdown_text = md(str(soup), strip=["a", "img"], heading_style="ATX")
+def convert_to_markdown(soup, backend="bs4"):
+    if backend == "lxml":
+        # 直接转换已解析好的 soup，省去 str(soup) 后的第二次解析
+        markdown_text = MarkdownConverter(**MARKDOWN_OPTIONS).convert_soup(soup)
+    else:
+        markdown_text = md(str(soup), **MARKDOWN_OPTIONS)
     return post_process_markdown(markdown_text)
 
 
-def split_markdown_by_headers(markdown_text, metadata):
-    chunks = []
-    lines = markdown_text.split("\n")
-    current_chunk = []
-    current_header = metadata.get("chapter", "Unknown")
-
-    for line in lines:
-        if line.strip().startswith(("# ", "## ", "### ")):
-            if current_chunk:
-                text_content = "\n".join(current_chunk).strip()
-                if len(text_content) > 50:
-                    chunks.append(
-                        {
-                            "page_content": text_content,
-                            "metadata": {**metadata, "sub_topic": current_header},
-                        }
-                    )
-            current_header = line.strip().lstrip("#").strip()
-            current_chunk = [line]
-        else:
-            current_chunk.append(line)
-
-    if current_chunk:
-        text_content = "\n".join(current_chunk).strip()
-        if len(text_content) > 50:
-            chunks.append(
-                {
-                    "page_content": text_content,
-                    "metadata": {**metadata, "sub_topic": current_header},
-                }
-            )
-    return chunks
+def html_to_markdown(html_content, backend=DEFAULT_BACKEND):
+    return convert_to_markdown(clean_html(html_content, backend), backend)
 
 
 def read_file_content(file_path):
@@ -88,87 +93,362 @@ def read_file_content(file_path):
         return f.read()
 
 
-def process_all_files():
+def build_file_metadata(file_path):
+    """根据文件在 raw 目录下的位置计算 source_book 和 chapter"""
+    try:
+        # 获取相对于 raw 的完整路径，例如 "核心规则/玩家手册2024/03_职业/野蛮人.htm"
+        relative_file_path = file_path.relative_to(RAW_DATA_DIR)
+        full_parts = relative_file_path.parts
+
+        # 分离目录部分
+        dir_parts = full_parts[:-1]
+
+        # 1. 计算 source_book (前两级目录)
+        if len(dir_parts) >= 2:
+            source_book = f"{dir_parts[0]}/{dir_parts[1]}"
+            book_depth = 2
+        elif len(dir_parts) == 1:
+            source_book = dir_parts[0]
+            book_depth = 1
+        else:
+            source_book = "Uncategorized"
+            book_depth = 0
+
+        # 2. 计算 chapter (剩余路径 + 文件名Stem)
+        # [核心修改] 逻辑：full_parts[book_depth:] 就是被 source_book 截断剩下的部分
+        # 例如：full_parts = ("核心规则", "玩家手册2024", "03_职业", "野蛮人.htm")
+        # source_book 占了前2个
+        # chapter_parts = ("03_职业", "野蛮人.htm")
+
+        chapter_parts = list(full_parts[book_depth:])
+
+        if chapter_parts:
+            # 将最后一部分 (文件名) 替换为不带后缀的 Stem，如 "野蛮人.htm" -> "野蛮人"
+            chapter_parts[-1] = file_path.stem
+            # 用 "/" 拼接，变成 "03_职业/野蛮人"
+            chapter = "/".join(chapter_parts)
+        else:
+            chapter = file_path.stem
+
+    except ValueError:
+        source_book = "Unknown"
+        chapter = file_path.stem
+
+    return {
+        "source_book": source_book,
+        "chapter": chapter,  # [修改点] 这里现在包含了完整的子路径信息
+        "filename": file_path.name,
+    }
+
+
+def process_file(file_path, backend=DEFAULT_BACKEND):
+    """
+    处理单个 HTML 文件 (可在子进程中运行)。
+    返回 (file_path, base_metadata, chunks, entities, 耗时秒数, 错误信息或 None)。
+    """
+    start = time.perf_counter()
+    base_metadata = build_file_metadata(file_path)
+    try:
+        content = read_file_content(file_path)
+        if not content:
+            return file_path, base_metadata, [], [], time.perf_counter() - start, None
+
+        md_text = html_to_markdown(content, backend)
+        chunks = split_markdown_by_headers(md_text, base_metadata)
+        entities = extract_entities(md_text, base_metadata)
+    except Exception as e:
+        return file_path, base_metadata, [], [], time.perf_counter() - start, str(e)
+
+    return file_path, base_metadata, chunks, entities, time.perf_counter() - start, None
+
+
+def list_raw_files():
+    """递归列出 raw 下的所有 htm 文件，排序保证输出顺序稳定"""
+    return sorted(
+        file_path
+        for file_path in RAW_DATA_DIR.rglob("**/*.htm*")
+        if not file_path.is_dir()
+    )
+
+
+def print_timing_summary(timings, top_n=TIMING_TOP_N):
+    """打印耗时最长的文件，便于定位拖慢 ETL 的页面"""
+    if not timings:
+        return
+    total = sum(elapsed for _, elapsed, _ in timings)
+    print(
+        f"\n--- 单文件耗时 Top {min(top_n, len(timings))} (CPU 总计 {total:.1f}s) ---"
+    )
+    for file_path, elapsed, chunk_count in sorted(
+        timings, key=lambda item: item[1], reverse=True
+    )[:top_n]:
+        relative_path = file_path.relative_to(RAW_DATA_DIR)
+        print(f"{elapsed:8.2f}s  {chunk_count:5d} 块  {relative_path}")
+
+
+def file_sha256(file_path):
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def load_manifest(backend):
+    """
+    读取上次运行的清单 {相对路径: {mtime, size, sha256, chunk_ids}}。
+    输出文件缺失、ETL 版本变化 (切分逻辑改动) 或转换后端变化时返回空清单，
+    触发全量处理。
+    """
+    if not (MANIFEST_FILE.exists() and OUTPUT_FILE.exists() and ENTITIES_FILE.exists()):
+        return {}
+    with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("etl_version") != ETL_VERSION:
+        print("ETL 版本已变化，将全量重新处理。")
+        return {}
+    if data.get("backend") != backend:
+        print(f"转换后端已变化 ({data.get('backend')} -> {backend})，将全量重新处理。")
+        return {}
+    return data.get("files", {})
+
+
+def save_manifest(files_manifest, backend):
+    data = {"etl_version": ETL_VERSION, "backend": backend, "files": files_manifest}
+    tmp_path = MANIFEST_FILE.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, MANIFEST_FILE)
+
+
+def plan_changes(files, manifest):
+    """
+    对比清单，找出需要重新解析的文件。
+    先比较 mtime + size，不一致时再比较内容哈希 (只是被 touch 过的文件不会重新解析)。
+    返回 (未变化的 {相对路径: 清单条目}, 需要处理的 {相对路径: 新的文件信息})。
+    """
+    unchanged = {}
+    changed = {}
+    for file_path in files:
+        relative_path = file_path.relative_to(RAW_DATA_DIR).as_posix()
+        stat = file_path.stat()
+        entry = manifest.get(relative_path)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            unchanged[relative_path] = entry
+            continue
+
+        digest = file_sha256(file_path)
+        info = {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": digest}
+        if entry and entry["sha256"] == digest:
+            unchanged[relative_path] = {**entry, **info}
+        else:
+            changed[relative_path] = info
+    return unchanged, changed
+
+
+def load_unchanged_chunks(unchanged):
+    """从上次的输出文件中按文件取回未变化文件的数据块 (原始 JSON 行)"""
+    id_to_path = {
+        chunk_id: relative_path
+        for relative_path, entry in unchanged.items()
+        for chunk_id in entry["chunk_ids"]
+    }
+    lines_by_path = {relative_path: [] for relative_path in unchanged}
+    with open(OUTPUT_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            chunk_id = compute_chunk_id(chunk["page_content"], chunk["metadata"])
+            relative_path = id_to_path.get(chunk_id)
+            if relative_path is not None:
+                lines_by_path[relative_path].append(line)
+    return lines_by_path
+
+
+def load_unchanged_entities(unchanged):
+    """从上次的条目文件中按来源文件取回未变化文件的结构化条目 (原始 JSON 行)"""
+    lines_by_path = {relative_path: [] for relative_path in unchanged}
+    with open(ENTITIES_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            relative_path = json.loads(line).get("file")
+            if relative_path in lines_by_path:
+                lines_by_path[relative_path].append(line)
+    return lines_by_path
+
+
+def process_all_files(workers=1, full=False, backend=DEFAULT_BACKEND):
+    """
+    处理 raw 下的全部文件。
+
+    默认增量处理：根据清单 (etl_manifest.json) 只重新解析新增或修改过的文件，
+    未变化文件的数据块从上次的输出中原样保留，已删除文件的数据块被丢弃。
+    full=True 时忽略清单全部重新解析。
+
+    workers > 1 时使用多进程并行解析，主进程按文件排序后的顺序写出，
+    保证不同并行度下输出文件内容完全一致。
+    """
     if not RAW_DATA_DIR.exists():
         print(f"错误: 找不到原始数据目录 {RAW_DATA_DIR}")
         return
 
     PROCESSED_DATA_DIR.mkdir(parents=True, exist_ok=True)
-    total_chunks = 0
+    files = list_raw_files()
+    start = time.perf_counter()
+
+    manifest = {} if full else load_manifest(backend)
+    unchanged, changed = plan_changes(files, manifest)
+    removed = set(manifest) - set(unchanged) - set(changed)
+    added = [path for path in changed if path not in manifest]
+    print(
+        f"文件变化: 新增 {len(added)} | 修改 {len(changed) - len(added)} | "
+        f"删除 {len(removed)} | 未变化 {len(unchanged)}"
+    )
+    if not changed and not removed:
+        # 仍然保存一次清单，记录只被 touch 过的文件的新 mtime
+        save_manifest(unchanged, backend)
+        print("没有需要处理的文件，输出已是最新。")
+        return
 
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f_out:
-        # 递归遍历 raw 下的所有 htm 文件
-        for file_path in RAW_DATA_DIR.rglob("**/*.htm*"):
-            if file_path.is_dir():
-                continue
+    unchanged_lines = load_unchanged_chunks(unchanged) if unchanged else {}
+    unchanged_entities = load_unchanged_entities(unchanged) if unchanged else {}
+    changed_files = [
+        file_path
+        for file_path in files
+        if file_path.relative_to(RAW_DATA_DIR).as_posix() in changed
+    ]
 
-            try:
-                # 获取相对于 raw 的完整路径，例如 "核心规则/玩家手册2024/03_职业/野蛮人.htm"
-                relative_file_path = file_path.relative_to(RAW_DATA_DIR)
-                full_parts = relative_file_path.parts
-
-                # 分离目录部分
-                dir_parts = full_parts[:-1]
-
-                # 1. 计算 source_book (前两级目录)
-                if len(dir_parts) >= 2:
-                    source_book = f"{dir_parts[0]}/{dir_parts[1]}"
-                    book_depth = 2
-                elif len(dir_parts) == 1:
-                    source_book = dir_parts[0]
-                    book_depth = 1
-                else:
-                    source_book = "Uncategorized"
-                    book_depth = 0
-
-                # 2. 计算 chapter (剩余路径 + 文件名Stem)
-                # [核心修改] 逻辑：full_parts[book_depth:] 就是被 source_book 截断剩下的部分
-                # 例如：full_parts = ("核心规则", "玩家手册2024", "03_职业", "野蛮人.htm")
-                # source_book 占了前2个
-                # chapter_parts = ("03_职业", "野蛮人.htm")
-
-                chapter_parts = list(full_parts[book_depth:])
-
-                if chapter_parts:
-                    # 将最后一部分 (文件名) 替换为不带后缀的 Stem，如 "野蛮人.htm" -> "野蛮人"
-                    chapter_parts[-1] = file_path.stem
-                    # 用 "/" 拼接，变成 "03_职业/野蛮人"
-                    chapter = "/".join(chapter_parts)
-                else:
-                    chapter = file_path.stem
-
-            except ValueError:
-                source_book = "Unknown"
-                chapter = file_path.stem
-
-            # 调试打印 (可选)
-            print(f"Book: {source_book} | Chapter: {chapter}")
-
-            try:
-                content = read_file_content(file_path)
-                if not content:
+    total_chunks = 0
+    total_entities = 0
+    timings = []
+    new_manifest = {}
+
+    if workers > 1 and len(changed_files) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        # map 按提交顺序返回结果，子进程可以乱序完成
+        results = executor.map(
+            partial(process_file, backend=backend), changed_files, chunksize=4
+        )
+    else:
+        executor = None
+        results = map(partial(process_file, backend=backend), changed_files)
+
+    # 先写临时文件再替换，中途失败不会破坏上一次的输出
+    tmp_output = OUTPUT_FILE.with_suffix(".jsonl.tmp")
+    tmp_entities = ENTITIES_FILE.with_suffix(".jsonl.tmp")
+    try:
+        with open(tmp_output, "w", encoding="utf-8") as f_out, open(
+            tmp_entities, "w", encoding="utf-8"
+        ) as f_entities:
+            for file_path in files:
+                relative_path = file_path.relative_to(RAW_DATA_DIR).as_posix()
+                if relative_path in unchanged:
+                    lines = unchanged_lines[relative_path]
+                    f_out.writelines(lines)
+                    total_chunks += len(lines)
+                    f_entities.writelines(unchanged_entities[relative_path])
+                    total_entities += len(unchanged_entities[relative_path])
+                    new_manifest[relative_path] = unchanged[relative_path]
                     continue
 
-                base_metadata = {
-                    "source_book": source_book,
-                    "chapter": chapter,  # [修改点] 这里现在包含了完整的子路径信息
-                    "filename": file_path.name,
-                }
-
-                soup = clean_html(content)
-                md_text = convert_to_markdown(soup)
-                chunks = split_markdown_by_headers(md_text, base_metadata)
+                _, base_metadata, chunks, entities, elapsed, error = next(results)
+                # 调试打印 (可选)
+                print(
+                    f"Book: {base_metadata['source_book']} | "
+                    f"Chapter: {base_metadata['chapter']}"
+                )
+                if error:
+                    # 失败的文件不写入清单，下次运行会重试
+                    print(f"处理文件 {file_path.name} 失败: {error}")
+                    continue
 
                 for chunk in chunks:
                     f_out.write(json.dumps(chunk, ensure_ascii=False) + "\n")
-                    total_chunks += 1
-
-            except Exception as e:
-                print(f"处理文件 {file_path.name} 失败: {str(e)}")
-
-    print(f"\n处理完成! 共生成 {total_chunks} 个数据块。")
+                total_chunks += len(chunks)
+                # 记录来源文件，增量处理时按文件保留未变化的条目
+                for entity in entities:
+                    entity = {**entity, "file": relative_path}
+                    f_entities.write(json.dumps(entity, ensure_ascii=False) + "\n")
+                total_entities += len(entities)
+                timings.append((file_path, elapsed, len(chunks)))
+                new_manifest[relative_path] = {
+                    **changed[relative_path],
+                    "chunk_ids": [
+                        compute_chunk_id(chunk["page_content"], chunk["metadata"])
+                        for chunk in chunks
+                    ],
+                }
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    os.replace(tmp_output, OUTPUT_FILE)
+    os.replace(tmp_entities, ENTITIES_FILE)
+    save_manifest(new_manifest, backend)
+
+    print_timing_summary(timings)
+    print(
+        f"\n处理完成! 解析 {len(changed_files)} 个文件 (共 {len(files)} 个)，"
+        f"输出 {total_chunks} 个数据块、{total_entities} 个结构化条目，耗时 {time.perf_counter() - start:.1f}s "
+        f"(workers={workers}, backend={backend})。"
+    )
     print(f"输出文件: {OUTPUT_FILE}")
+    print(f"条目文件: {ENTITIES_FILE}")
+
+
+def compare_backends(limit=None):
+    """
+    对比两个转换后端在 raw 数据上的输出 (以 bs4 旧管线为基准)。
+    打印每个后端的总耗时，以及输出不一致的文件，用于切换后端前的回归检查。
+    """
+    files = list_raw_files()[:limit] if limit else list_raw_files()
+    elapsed = {backend: 0.0 for backend in BACKENDS}
+    mismatched = []
+
+    for file_path in files:
+        content = read_file_content(file_path)
+        outputs = {}
+        for backend in BACKENDS:
+            start = time.perf_counter()
+            outputs[backend] = html_to_markdown(content, backend)
+            elapsed[backend] += time.perf_counter() - start
+        if outputs["lxml"] != outputs["bs4"]:
+            mismatched.append(file_path.relative_to(RAW_DATA_DIR))
+
+    for backend in BACKENDS:
+        print(f"{backend:5s}: {elapsed[backend]:.2f}s")
+    print(f"共 {len(files)} 个文件，输出不一致 {len(mismatched)} 个。")
+    for relative_path in mismatched[:TIMING_TOP_N]:
+        print(f"  {relative_path}")
+    return mismatched
 
 
 if __name__ == "__main__":
-    process_all_files()
+    parser = argparse.ArgumentParser(description="将 raw 下的 HTML 清洗为 JSONL")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="并行解析的进程数 (1 表示单进程)",
+    )
+    parser.add_argument("--full", action="store_true", help="忽略清单，全部重新解析")
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default=DEFAULT_BACKEND,
+        help="HTML -> Markdown 转换后端 (默认 bs4 旧管线；lxml 更快，需先用 --compare-backends 确认)",
+    )
+    parser.add_argument(
+        "--compare-backends",
+        action="store_true",
+        help="不生成输出，只对比两个后端的转换结果和耗时",
+    )
+    args = parser.parse_args()
+    if args.compare_backends:
+        compare_backends()
+    else:
+        process_all_files(
+            workers=max(1, args.workers), full=args.full, backend=args.backend
+        )
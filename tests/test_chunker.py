@@ -0,0 +1,21 @@
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.etl.chunker import split_markdown_by_headers
+
+
+def test_header_only_parent_merges_into_first_child():
+    """只有标题的上级小节并入第一个下级小节时，保留下级的标题和完整路径"""
+    body = "火球术造成8d6火焰伤害，豁免成功则伤害减半。" * 80
+    markdown = f"# 法术\n\n## 火球术\n\n{body}"
+    chunks = split_markdown_by_headers(markdown, {"chapter": "c"}, max_tokens=200)
+
+    assert len(chunks) > 1
+    assert chunks[0]["page_content"].startswith("# 法术\n\n## 火球术")
+    for chunk in chunks:
+        assert chunk["metadata"]["sub_topic"] == "火球术"
+        assert chunk["metadata"]["header_path"] == "c > 法术 > 火球术"
+    for chunk in chunks[1:]:
+        assert chunk["page_content"].startswith("## 火球术 (续)")